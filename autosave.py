@@ -0,0 +1,236 @@
+"""Saves the model in the background, shortly after it has been changed
+
+Small edits are appended to a journal next to the config file, full snapshots
+of the model are written only when the model has been left alone for a while.
+After a crash, the edits in the journal are replayed on top of the last
+snapshot.
+"""
+from __future__ import annotations
+
+from collections.abc import Callable
+import hashlib
+import json
+import logging
+import os
+import os.path as p
+import tempfile
+import threading
+
+import space
+from distractors import Distractor
+
+
+# the suffix of the temporary files of atomic_write, a crash may leave them
+TEMP_SUFFIX = ".tmp"
+
+
+def atomic_write(fn: str, data: bytes):
+    """Writes data to fn via a temporary file, so fn is either the old or
+    the new file, but never a partially written one.
+    """
+    directory = p.dirname(p.abspath(fn))
+    fd, tmp_name = tempfile.mkstemp(
+        prefix=p.basename(fn), suffix=TEMP_SUFFIX, dir=directory
+    )
+    try:
+        with os.fdopen(fd, "wb") as tmp:
+            tmp.write(data)
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        os.replace(tmp_name, fn)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+
+
+def _digest(data: bytes) -> str:
+    return hashlib.sha1(data).hexdigest()
+
+
+class Journal:
+    """An append-only file with one json encoded edit per line
+
+    The first line contains the digest of the snapshot the edits apply to.
+    """
+
+    def __init__(self, fn: str):
+        self.fn = fn
+        self._file = None
+
+    def read(self) -> tuple[str | None, list[dict]]:
+        """Returns the digest of the base snapshot and the edits"""
+        if not p.exists(self.fn):
+            return None, []
+        base = None
+        entries = []
+        with open(self.fn, "r", encoding="utf8") as content:
+            for i, line in enumerate(content):
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # an edit that was being appended during a crash
+                    logging.warning(f"Skipping corrupt line {i} in {self.fn}")
+                    continue
+                if i == 0:
+                    base = entry.get("base")
+                else:
+                    entries.append(entry)
+        return base, entries
+
+    def reset(self, base: str, entries: list[dict] = []):
+        """Starts a new journal for the snapshot with digest base"""
+        self.close()
+        lines = [json.dumps({"base": base})] + [json.dumps(e) for e in entries]
+        atomic_write(self.fn, ("\n".join(lines) + "\n").encode("utf8"))
+        self._file = open(self.fn, "a", encoding="utf8")
+
+    def append(self, entry: dict):
+        self._file.write(json.dumps(entry) + "\n")
+        self._file.flush()
+
+    def remove(self):
+        """Closes and deletes the journal"""
+        self.close()
+        if p.exists(self.fn):
+            os.unlink(self.fn)
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+def replay(model, entry: dict):
+    """Applies an edit from the journal to the model"""
+    op = entry["op"]
+    if op == "set":
+        setattr(model, entry["field"], entry["value"])
+    elif op == "add_distractor":
+        point = space.Point2D(entry["x"], entry["y"])
+        model.append_distractor(Distractor(entry["string"], point))
+    elif op == "remove_distractor":
+        model.remove_distractor(entry["index"])
+    elif op == "remove_distractors":
+        model.remove_distractors(entry["indices"])
+    elif op == "move_distractor":
+        point = space.Point2D(entry["x"], entry["y"])
+        model.move_distractor(model.distractors[entry["index"]], point)
+    elif op == "replace_distractors":
+        model.replace_distractors(
+            [Distractor(s, space.Point2D(x, y)) for s, x, y in entry["distractors"]]
+        )
+    elif op == "add_path_point":
+        model.add_path_point(space.Point2D(entry["x"], entry["y"]))
+    elif op == "clear_path":
+        model.clear_path()
+    elif op == "replace_path":
+        model.replace_path([space.Point2D(x, y) for x, y in entry["points"]])
+    else:
+        raise ValueError(f"Unknown journal operation: {op}")
+
+
+def call_later(delay: float, function: Callable[[], None]) -> Callable[[], None]:
+    """Calls function on a timer thread after delay seconds, returns a
+    function that cancels the call.
+    """
+    timer = threading.Timer(delay, function)
+    timer.daemon = True
+    timer.start()
+    return timer.cancel
+
+
+class AutoSaver:
+    """Journals the edits of a model and saves it once it isn't changed for
+    delay seconds.
+
+    The model should implement serialize() returning the contents of its
+    file, and report its edits by calling changed(). The snapshot is
+    scheduled with schedule(delay, function), which returns a function that
+    cancels it. It must call function on the thread that edits the model,
+    otherwise an edit can end up in both the snapshot and the journal, and
+    be replayed twice. The default runs it on a timer thread, for models that
+    aren't edited concurrently.
+    """
+
+    def __init__(
+        self,
+        model,
+        fn: str = "",
+        delay: float = 2.0,
+        schedule: Callable[[float, Callable[[], None]], Callable[[], None]] = (
+            call_later
+        ),
+    ):
+        self.model = model
+        self.fn = fn if fn else model.config_name
+        self.delay = delay
+        self.schedule = schedule
+        self.journal = Journal(self.fn + ".journal")
+        self._lock = threading.Lock()
+        self._cancel: Callable[[], None] | None = None
+        self._pending = 0  # number of edits since the last snapshot
+
+    def recover(self) -> int:
+        """Replays the journal when it belongs to the current config file,
+        returns the number of replayed edits.
+        """
+        base, entries = self.journal.read()
+        if not entries or not p.exists(self.fn):
+            return 0
+        with open(self.fn, "rb") as content:
+            if _digest(content.read()) != base:
+                logging.warning(f"{self.journal.fn} doesn't belong to {self.fn}")
+                return 0
+        for entry in entries:
+            replay(self.model, entry)
+        return len(entries)
+
+    def start(self):
+        """Recover from the journal and start listening to the model, the file
+        is only written when it doesn't exist or edits were recovered.
+        """
+        if self.recover() or not p.exists(self.fn):
+            self.snapshot()
+        else:
+            with open(self.fn, "rb") as content:
+                self.journal.reset(_digest(content.read()))
+        self.model.autosaver = self
+
+    def stop(self):
+        """Stop listening to the model and save pending edits, the journal is
+        deleted as the file contains all edits.
+        """
+        self.model.autosaver = None
+        self.flush()
+        self.journal.remove()
+
+    def changed(self, entry: dict):
+        """Journals an edit and (re)schedules the next snapshot"""
+        with self._lock:
+            self.journal.append(entry)
+            self._pending += 1
+            if self._cancel:
+                self._cancel()
+            self._cancel = self.schedule(self.delay, self.snapshot)
+
+    def flush(self):
+        """Writes a snapshot now if there are pending edits"""
+        with self._lock:
+            if self._cancel:
+                self._cancel()
+                self._cancel = None
+            pending = self._pending
+        if pending:
+            self.snapshot()
+
+    def snapshot(self):
+        """Writes the complete model and starts a new journal"""
+        with self._lock:
+            self._cancel = None
+            data = self.model.serialize()
+            self._pending = 0
+        atomic_write(self.fn, data)
+        with self._lock:
+            # keep the edits that were made while writing the snapshot
+            _, entries = self.journal.read()
+            self.journal.reset(_digest(data), entries[len(entries) - self._pending :])
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+"""Benchmarks the stages of making a worksheet
+
+A set of reference worksheets is generated, with images that are drawn with
+PIL so no files are needed:
+
+    small       a small RGB image without distractors
+    photo       a large detailed RGB image, 500 distractors and a long path
+    lineart     a bilevel line drawing
+    clipart     an RGBA image with transparency
+
+For each worksheet the stages are timed separately: loading and converting
+the image, RecImage.draw for the export and for the preview, painting the
+preview, in_exclusion_path, loading and saving the config and exporting the
+png. The results are written as
+json. Comparing two result files fails when a stage became slower than the
+threshold allows, so it can gate changes.
+"""
+from __future__ import annotations
+
+import argparse as ap
+from collections.abc import Callable
+import io
+import json
+import math as m
+import os
+import os.path as p
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from PIL import Image, ImageDraw
+
+import lineart
+import space
+from distractors import Distractor
+
+REPEATS = 5
+THRESHOLD = 0.2  # the fraction a stage may become slower
+PREVIEW_WIDTH = 594  # the width of the preview in the GUI
+PATH_QUERIES = 10_000
+
+
+def _small_image(fn: str):
+    Image.radial_gradient("L").convert("RGB").resize((400, 300)).save(fn)
+
+
+def _photo_image(fn: str):
+    size = 4000, 3000
+    # only deterministic content, so the renders can be compared (see golden)
+    detail = Image.effect_mandelbrot(size, (-2.2, -1.2, 1.0, 1.2), 100)
+    zoomed = Image.effect_mandelbrot(size, (-0.8, 0.0, -0.6, 0.15), 200)
+    gradient = Image.linear_gradient("L").resize(size)
+    Image.merge("RGB", (detail, zoomed, gradient)).save(fn)
+
+
+def _lineart_image(fn: str):
+    im = Image.new("1", (2000, 1500), 1)
+    draw = ImageDraw.Draw(im)
+    rng = random.Random(1)
+    for _ in range(200):
+        points = [(rng.randrange(2000), rng.randrange(1500)) for _ in range(2)]
+        draw.line(points, fill=0, width=3)
+    im.save(fn)
+
+
+def _clipart_image(fn: str):
+    im = Image.new("RGBA", (1200, 1200), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(im)
+    for i, color in enumerate([(255, 0, 0, 255), (0, 160, 0, 200), (0, 0, 255, 128)]):
+        offset = 100 + 300 * i
+        draw.ellipse((offset, offset, offset + 500, offset + 500), fill=color)
+    im.save(fn)
+
+
+def _star(center: space.Point2D, radius: float, n: int) -> list[space.Point2D]:
+    """Returns a closed star shaped path of n points"""
+    points = []
+    for i in range(n):
+        r = radius * (1.0 if i % 2 else 0.8)
+        angle = 2 * m.pi * i / n
+        points.append(
+            space.Point2D(center.x + r * m.cos(angle), center.y + r * m.sin(angle))
+        )
+    return points
+
+
+def reference_configs(directory: str) -> dict[str, str]:
+    """Writes the reference worksheets and their images to directory,
+    returns the configs by name.
+    """
+    images = {
+        "small": ("small.png", _small_image, 0, 0),
+        "photo": ("photo.jpg", _photo_image, 500, 400),
+        "lineart": ("lineart.png", _lineart_image, 100, 0),
+        "clipart": ("clipart.png", _clipart_image, 50, 40),
+    }
+    # comparing results doesn't need cairo and GTK, running benchmarks does
+    from model import Model
+
+    configs = {}
+    rng = random.Random(0)
+    for name, (image_name, make, n_distractors, n_path) in images.items():
+        image_fn = p.join(directory, image_name)
+        make(image_fn)
+        model = Model(path=image_fn, word=name, distractors=[], exclusion_path=[])
+        width, height = model.rec_surf.pars.size
+        if n_path:
+            center = space.Point2D(width / 2, height / 2)
+            model.replace_path(_star(center, min(width, height) / 3, n_path))
+            model.close_path = True
+        model.replace_distractors(
+            [
+                Distractor(
+                    rng.choice("abcdefghijklmnopqrstuvwxyz"),
+                    space.Point2D(rng.random() * width, rng.random() * height),
+                )
+                for _ in range(n_distractors)
+            ]
+        )
+        model.config_name = p.join(directory, f"{name}.json")
+        model.save()
+        configs[name] = model.config_name
+    return configs
+
+
+def _time(function: Callable[[], object], repeats: int) -> list[float]:
+    durations = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def bench_config(config: str, repeats: int = REPEATS) -> dict[str, list[float]]:
+    """Returns the durations of the stages for a config"""
+    from model import Model
+    import tiles
+
+    model = Model.from_file(config)
+    rec = model.rec_surf
+    results = {}
+
+    def load_image():
+        lineart.pipeline.clear()  # otherwise only the first decode is timed
+        rec._cacheSurf(model.path)
+
+    results["load_image"] = _time(load_image, repeats)
+    results["draw"] = _time(rec.draw, repeats)
+    level = tiles.level_for_scale(PREVIEW_WIDTH / rec.width)
+    results["draw_preview"] = _time(lambda: rec.draw(2.0**level, True), repeats)
+
+    def preview():
+        cache = tiles.TileCache()
+        cache.set_source(rec.surf)
+        for column, row in cache.visible(level, 0, 0, rec.width, rec.height):
+            cache.tile(level, column, row)
+
+    results["preview"] = _time(preview, repeats)
+
+    rng = random.Random(0)
+    points = [
+        space.Point2D(rng.random() * rec.width, rng.random() * rec.height)
+        for _ in range(PATH_QUERIES)
+    ]
+
+    def in_exclusion_path():
+        for point in points:
+            rec.in_exclusion_path(point)
+
+    results["in_exclusion_path"] = _time(in_exclusion_path, repeats)
+    results["from_file"] = _time(lambda: Model.from_file(config), repeats)
+
+    with tempfile.TemporaryDirectory() as directory:
+        copy = Model.from_file(config)
+        copy.config_name = p.join(directory, "draw.json")
+        results["save"] = _time(copy.save, repeats)
+
+    results["export_png"] = _time(lambda: rec.write_png(io.BytesIO()), repeats)
+    return results
+
+
+def run(repeats: int = REPEATS) -> dict:
+    """Runs the benchmarks on the reference worksheets"""
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for name, config in reference_configs(directory).items():
+            for stage, durations in bench_config(config, repeats).items():
+                results[f"{name}/{stage}"] = {
+                    "median": statistics.median(durations),
+                    "min": min(durations),
+                    "repeats": len(durations),
+                }
+                print(f"{name}/{stage}: {statistics.median(durations):.4f} s")
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": results,
+    }
+
+
+def compare(
+    baseline: dict, current: dict, threshold: float = THRESHOLD
+) -> list[tuple[str, float, float]]:
+    """Returns the stages whose median is more than threshold slower than in
+    the baseline, with their baseline and current median.
+    """
+    regressions = []
+    for stage, result in current["results"].items():
+        base = baseline["results"].get(stage)
+        if base and result["median"] > base["median"] * (1 + threshold):
+            regressions.append((stage, base["median"], result["median"]))
+    return regressions
+
+
+def missing(baseline: dict, current: dict) -> list[str]:
+    """Returns the stages of the baseline that have no current result"""
+    return [stage for stage in baseline["results"] if stage not in current["results"]]
+
+
+def main():
+    """Benchmark the reference worksheets or compare results"""
+    parser = ap.ArgumentParser("benchmark.py", description="benchmark worksheets")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument(
+        "-o", "--output", type=str, default="benchmark.json", help="the results"
+    )
+    run_parser.add_argument("-r", "--repeats", type=int, default=REPEATS)
+    compare_parser = commands.add_parser(
+        "compare", help="fail when a stage of the baseline is slower or missing"
+    )
+    compare_parser.add_argument("baseline", type=str)
+    compare_parser.add_argument("current", type=str)
+    compare_parser.add_argument(
+        "-t",
+        "--threshold",
+        type=float,
+        default=THRESHOLD,
+        help="the fraction a stage may be slower",
+    )
+
+    args = parser.parse_args()
+    if args.command == "run":
+        results = run(args.repeats)
+        with open(args.output, "w", encoding="utf8") as out:
+            json.dump(results, out, indent=4)
+        return
+
+    with open(args.baseline, "r", encoding="utf8") as content:
+        baseline = json.load(content)
+    with open(args.current, "r", encoding="utf8") as content:
+        current = json.load(content)
+    regressions = compare(baseline, current, args.threshold)
+    for stage, before, after in regressions:
+        print(f"{stage}: {before:.4f} s -> {after:.4f} s ({after / before - 1:+.0%})")
+    absent = missing(baseline, current)
+    for stage in absent:
+        print(f"{stage}: missing from {args.current}")
+    if regressions or absent:
+        sys.exit(1)
+    print("no regressions")
+
+
+if __name__ == "__main__":
+    main()
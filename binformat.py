@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+"""A compact binary container for the configuration of a worksheet
+
+The file starts with a fixed size header with the scalar fields of the model,
+followed by the string table and packed arrays with the coordinates of the
+exclusion path and the distractors. Optionally a (PNG) thumbnail is appended.
+All numbers are stored little endian and every section is 8 byte aligned.
+
+Loading a worksheet only parses the header, the other fields are decoded when
+they are accessed. Files are mapped, so the thumbnail of a worksheet isn't read
+when only its config is needed.
+"""
+from __future__ import annotations
+
+import argparse as ap
+import array
+from functools import cached_property
+import json
+import mmap
+import struct
+import sys
+
+import serializer
+import space
+from distractors import Distractor
+
+MAGIC = b"LDWS"
+VERSION = 3
+EXTENSION = ".ldw"
+
+# magic, version, reserved flags, word_x, word_y, img_x, img_y, show_path,
+# close_path, n_strings, n_path, n_distractors, thumbnail_size
+_HEADER_V1 = struct.Struct("<4sHHdddd??2xIIII4x")
+# version 2 appends paper width, paper height (mm) and dpi, which are 0 when
+# the config doesn't specify them
+_HEADER = struct.Struct("<4sHHdddd??2xIIII4xddI4x")
+
+# The fixed entries of the string table, distractor strings follow these.
+# Version 3 adds the line art parameters as json, "" when they are absent.
+_STRING_FIELDS = ("path", "name", "word", "font", "distractor_font", "line_art")
+
+
+def _align(size: int) -> int:
+    return (size + 7) & ~7
+
+
+def _pack_array(fmt: str, values) -> bytes:
+    arr = array.array(fmt, values)
+    if sys.byteorder != "little":
+        arr.byteswap()
+    return arr.tobytes()
+
+
+def dumps(d: dict, thumbnail: bytes = b"") -> bytes:
+    """Encodes the dictionary of Model.as_dict() as a binary worksheet"""
+    strings = [d[field] for field in _STRING_FIELDS[:-1]]
+    strings.append(json.dumps(d["line_art"]) if d.get("line_art") else "")
+    string_ids = {}
+    distractor_ids = []
+    distractor_coords = []
+    for distractor in d["distractors"]:
+        if distractor.string not in string_ids:
+            string_ids[distractor.string] = len(strings)
+            strings.append(distractor.string)
+        distractor_ids.append(string_ids[distractor.string])
+        distractor_coords.extend((distractor.pos.x, distractor.pos.y))
+
+    path_coords = []
+    for point in d["exclusion_path"]:
+        path_coords.extend((point.x, point.y))
+
+    encoded = [s.encode("utf8") for s in strings]
+    offsets = [0]
+    for s in encoded:
+        offsets.append(offsets[-1] + len(s))
+
+    header = _HEADER.pack(
+        MAGIC,
+        VERSION,
+        0,
+        d["word_x"],
+        d["word_y"],
+        d["img_x"],
+        d["img_y"],
+        d["show_path"],
+        d["close_path"],
+        len(strings),
+        len(d["exclusion_path"]),
+        len(d["distractors"]),
+        len(thumbnail),
+        *d.get("paper", (0.0, 0.0)),
+        d.get("dpi", 0),
+    )
+
+    out = bytearray(header)
+    out += _pack_array("I", offsets)
+    out += b"".join(encoded)
+    out += bytes(_align(len(out)) - len(out))
+    out += _pack_array("d", path_coords)
+    out += _pack_array("d", distractor_coords)
+    out += _pack_array("I", distractor_ids)
+    out += bytes(_align(len(out)) - len(out))
+    out += thumbnail
+    return bytes(out)
+
+
+class Worksheet:
+    """A lazily decoded view on a binary worksheet
+
+    close() releases the data, a mapped file is unmapped, e.g. so it can be
+    replaced on Windows. The worksheet is a context manager that closes it.
+    """
+
+    def __init__(self, data: bytes):
+        self._source = data
+        self._data = memoryview(data)
+        if len(data) < _HEADER_V1.size or bytes(self._data[:4]) != MAGIC:
+            raise ValueError("This is not a binary worksheet")
+        self.version = _HEADER_V1.unpack_from(self._data)[1]
+        if self.version > VERSION:
+            raise ValueError(f"Unsupported worksheet version: {self.version}")
+        header = _HEADER if self.version >= 2 else _HEADER_V1
+        if len(data) < header.size:
+            raise ValueError("The binary worksheet is truncated")
+        (
+            _,
+            _,
+            _,
+            self.word_x,
+            self.word_y,
+            self.img_x,
+            self.img_y,
+            self.show_path,
+            self.close_path,
+            self._n_strings,
+            self._n_path,
+            self._n_distractors,
+            self._thumbnail_size,
+            *rest,
+        ) = header.unpack_from(self._data)
+        # without paper and dpi, the defaults of the model are used
+        self.paper = tuple(rest[:2]) if rest and rest[2] else None
+        self.dpi = rest[2] if rest and rest[2] else None
+
+        # compute the offsets of the sections
+        self._offsets_start = header.size
+        self._strings_start = self._offsets_start + 4 * (self._n_strings + 1)
+        try:
+            strings_size = struct.unpack_from(
+                "<I", self._data, self._strings_start - 4
+            )[0]
+        except struct.error as e:
+            raise ValueError(f"The binary worksheet is truncated: {e}") from e
+        self._path_start = _align(self._strings_start + strings_size)
+        self._distractors_start = self._path_start + 16 * self._n_path
+        self._ids_start = self._distractors_start + 16 * self._n_distractors
+        self._thumbnail_start = _align(self._ids_start + 4 * self._n_distractors)
+        if self._thumbnail_start + self._thumbnail_size > len(data):
+            raise ValueError("The binary worksheet is truncated")
+
+    def __enter__(self) -> Worksheet:
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Releases the data, the arrays of the worksheet can't be used
+        afterwards and no other views on them may be left.
+        """
+        for name in (
+            "_string_offsets",
+            "path_coords",
+            "distractor_coords",
+            "distractor_string_ids",
+        ):
+            values = self.__dict__.pop(name, None)
+            if isinstance(values, memoryview):
+                values.release()
+        self._data.release()
+        if isinstance(self._source, mmap.mmap):
+            self._source.close()
+
+    def _array(self, fmt: str, offset: int, count: int):
+        """Returns count numbers from offset without creating python objects"""
+        raw = self._data[offset : offset + count * struct.calcsize(fmt)]
+        if sys.byteorder == "little":
+            return raw.cast(fmt)
+        arr = array.array(fmt)
+        arr.frombytes(raw)
+        arr.byteswap()
+        return arr
+
+    @cached_property
+    def _string_offsets(self):
+        return self._array("I", self._offsets_start, self._n_strings + 1)
+
+    def string(self, index: int) -> str:
+        """Returns an entry of the string table"""
+        start = self._strings_start + self._string_offsets[index]
+        end = self._strings_start + self._string_offsets[index + 1]
+        return str(self._data[start:end], "utf8")
+
+    @property
+    def path(self) -> str:
+        return self.string(0)
+
+    @property
+    def name(self) -> str:
+        return self.string(1)
+
+    @property
+    def word(self) -> str:
+        return self.string(2)
+
+    @property
+    def font(self) -> str:
+        return self.string(3)
+
+    @property
+    def distractor_font(self) -> str:
+        return self.string(4)
+
+    @property
+    def line_art(self) -> dict | None:
+        """The fields of lineart.LineArtParameters"""
+        if self.version < 3 or not self.string(5):
+            return None
+        return json.loads(self.string(5))
+
+    @cached_property
+    def path_coords(self):
+        """The interleaved x and y coordinates of the exclusion path"""
+        return self._array("d", self._path_start, 2 * self._n_path)
+
+    @cached_property
+    def distractor_coords(self):
+        """The interleaved x and y coordinates of the distractors"""
+        return self._array("d", self._distractors_start, 2 * self._n_distractors)
+
+    @cached_property
+    def distractor_string_ids(self):
+        """Index in the string table of the string of each distractor"""
+        return self._array("I", self._ids_start, self._n_distractors)
+
+    @property
+    def exclusion_path(self) -> list[space.Point2D]:
+        coords = self.path_coords
+        return [
+            space.Point2D(coords[i], coords[i + 1]) for i in range(0, len(coords), 2)
+        ]
+
+    @property
+    def distractors(self) -> list[Distractor]:
+        coords = self.distractor_coords
+        strings = [self.string(i) for i in range(self._n_strings)]
+        return [
+            Distractor(strings[index], space.Point2D(coords[2 * i], coords[2 * i + 1]))
+            for i, index in enumerate(self.distractor_string_ids)
+        ]
+
+    @property
+    def thumbnail(self) -> bytes | None:
+        if not self._thumbnail_size:
+            return None
+        start = self._thumbnail_start
+        return bytes(self._data[start : start + self._thumbnail_size])
+
+    def as_dict(self) -> dict:
+        """Returns the fields in the same layout as Model.as_dict(), paper,
+        dpi and line art are absent when the worksheet doesn't specify them.
+        """
+        d = {
+            "path": self.path,
+            "name": self.name,
+            "word": self.word,
+            "word_x": self.word_x,
+            "word_y": self.word_y,
+            "img_x": self.img_x,
+            "img_y": self.img_y,
+            "font": self.font,
+            "distractor_font": self.distractor_font,
+            "show_path": self.show_path,
+            "close_path": self.close_path,
+            "paper": self.paper,
+            "dpi": self.dpi,
+            "line_art": self.line_art,
+            "exclusion_path": self.exclusion_path,
+            "distractors": self.distractors,
+        }
+        if self.dpi is None:
+            del d["paper"], d["dpi"]
+        if d["line_art"] is None:
+            del d["line_art"]
+        return d
+
+
+def loads(data: bytes) -> Worksheet:
+    return Worksheet(data)
+
+
+def is_worksheet(data: bytes) -> bool:
+    """Test whether data starts like a binary worksheet"""
+    return bytes(data[: len(MAGIC)]) == MAGIC
+
+
+def save(fn: str, d: dict, thumbnail: bytes = b""):
+    with open(fn, "wb") as out:
+        out.write(dumps(d, thumbnail))
+
+
+def load(fn: str) -> Worksheet:
+    """Maps the worksheet in fn, the sections are read when they are used.
+    The file stays mapped until the worksheet is closed.
+    """
+    with open(fn, "rb") as content:
+        if not is_worksheet(content.read(len(MAGIC))):
+            raise ValueError("This is not a binary worksheet")
+        data = mmap.mmap(content.fileno(), 0, access=mmap.ACCESS_READ)
+    return Worksheet(data)
+
+
+def main():
+    """Convert between json and binary worksheets"""
+    parser = ap.ArgumentParser(
+        "binformat.py", description="convert between draw.json and binary worksheets"
+    )
+    parser.add_argument("input", type=str, help="a json or binary worksheet")
+    parser.add_argument("output", type=str, help="the converted worksheet")
+    args = parser.parse_args()
+
+    with open(args.input, "rb") as content:
+        data = content.read()
+
+    if is_worksheet(data):
+        with open(args.output, "wb") as out:
+            out.write(
+                json.dumps(
+                    serializer.serializer.pack(loads(data).as_dict()),
+                    indent=4,
+                    default=serializer.serializer,
+                ).encode("utf8")
+            )
+    else:
+        d = json.loads(data, object_hook=serializer.deserializer)
+        save(args.output, d)
+
+
+if __name__ == "__main__":
+    main()
@@ -10,10 +10,14 @@ class Distractor:
         self.pos = pos
 
 
+_DISTRACTOR_TAG = "Distractor"
+_DISTRACTOR_LEGACY_KEY = "__distractor__"
+
+
 def json_serialize_distractor(distractor: Distractor) -> dict:
     if isinstance(distractor, Distractor):
         return {
-            "__distractor__": True,
+            serializer.TYPE_KEY: _DISTRACTOR_TAG,
             "string": distractor.string,
             "pos_x": distractor.pos.x,
             "pos_y": distractor.pos.y,
@@ -22,14 +26,32 @@ def json_serialize_distractor(distractor: Distractor) -> dict:
 
 
 def json_deserialize_distractor(dct):
-    if "__distractor__" in dct:
-        point = space.Point2D(dct["pos_x"], dct["pos_y"])
-        return Distractor(dct["string"], point)
-    return dct
+    point = space.Point2D(dct["pos_x"], dct["pos_y"])
+    return Distractor(dct["string"], point)
+
+
+def json_bulk_serialize_distractors(distractors: list[Distractor]) -> dict:
+    return {
+        serializer.TYPE_KEY: _DISTRACTOR_TAG,
+        serializer.BULK_KEY: True,
+        "string": [d.string for d in distractors],
+        "pos_x": [d.pos.x for d in distractors],
+        "pos_y": [d.pos.y for d in distractors],
+    }
+
+
+def json_bulk_deserialize_distractors(dct) -> list[Distractor]:
+    return [
+        Distractor(string, space.Point2D(x, y))
+        for string, x, y in zip(dct["string"], dct["pos_x"], dct["pos_y"])
+    ]
 
 
 # register (de-)serialization functions
-serializer.serializer.register_serializer(Distractor, json_serialize_distractor)
+serializer.serializer.register_serializer(
+    Distractor, json_serialize_distractor, json_bulk_serialize_distractors
+)
 serializer.deserializer.register_deserializer(
-    "__distractor__", json_deserialize_distractor
+    _DISTRACTOR_TAG, json_deserialize_distractor, json_bulk_deserialize_distractors
 )
+serializer.deserializer.register_legacy_key(_DISTRACTOR_LEGACY_KEY, _DISTRACTOR_TAG)
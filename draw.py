@@ -1,13 +1,64 @@
 #!/usr/bin/env python3
 import cairo
 import argparse as ap
+import io
+import os.path as p
+import sys
+import typing
 
+import imgutils
+import netpbm
 
-def draw(file: str, width: int, height: int, scale=1.0) -> None:
-    """Draws a file on an image of width * height and saves it"""
+FORMATS = ("png", "pam", "ppm")
 
-    with open(file, "rb") as source_file:
-        source_surf = cairo.ImageSurface.create_from_png(source_file)
+
+def _write(surf: cairo.ImageSurface, out: typing.BinaryIO, fmt: str):
+    if fmt == "pam":
+        imgutils.cairoSurfToPam(surf, out)
+    elif fmt == "ppm":
+        imgutils.cairoSurfToPpm(surf, out)
+    else:
+        surf.write_to_png(out)
+
+
+def output_format(output: str, fmt: str = "") -> str:
+    """Returns fmt, or the format of the extension of output, png by default"""
+    if fmt:
+        return fmt
+    extension = p.splitext(output)[1][1:].lower()
+    return extension if extension in FORMATS else "png"
+
+
+def _load(file: str) -> cairo.ImageSurface:
+    """Decodes file, - is stdin"""
+    if file == "-":
+        # PIL needs to seek
+        file = io.BytesIO(sys.stdin.buffer.read())
+    return imgutils.fileToCairoSurf(file, cairo.FORMAT_RGB24)
+
+
+def _save(surf: cairo.ImageSurface, output: str, fmt: str):
+    if output == "-":
+        _write(surf, sys.stdout.buffer, fmt)
+        sys.stdout.buffer.flush()
+    else:
+        with open(output, "wb") as out:
+            _write(surf, out, fmt)
+
+
+def draw(
+    file: str,
+    width: int,
+    height: int,
+    scale=1.0,
+    output: str = "draw.png",
+    fmt: str = "",
+) -> None:
+    """Draws a file on an image of width * height and saves it to output.
+    A file or output of "-" is stdin or stdout.
+    """
+
+    source_surf = _load(file)
 
     target_surf = cairo.ImageSurface(cairo.FORMAT_RGB24, width, height)
 
@@ -30,13 +81,100 @@ def draw(file: str, width: int, height: int, scale=1.0) -> None:
 
     cr.fill()
 
-    target_surf.write_to_png("draw.png")
+    _save(target_surf, output, output_format(output, fmt))
+
+
+def parse_grid(grid: str) -> tuple[int, int]:
+    """Returns the columns and rows of a grid like 3x4"""
+    columns, _, rows = grid.lower().partition("x")
+    columns, rows = int(columns), int(rows)
+    if columns < 1 or rows < 1:
+        raise ValueError(f"A grid needs at least one cell: {grid}")
+    return columns, rows
+
+
+def page_name(output: str, page: int, pages: int) -> str:
+    """Returns the file of page, numbered from 1 when there are several
+    pages. All pages go to stdout one after another.
+    """
+    if pages == 1 or output == "-":
+        return output
+    root, extension = p.splitext(output)
+    return f"{root}-{page + 1}{extension}"
+
+
+def compose(
+    files: list[str],
+    width: int,
+    height: int,
+    columns: int,
+    rows: int,
+    margin: float = 0.0,
+    output: str = "draw.png",
+    fmt: str = "",
+) -> int:
+    """Draws files in a grid of cells on pages of width * height, every
+    image is scaled to fit its cell. The pages are saved as soon as they are
+    drawn, so only one page is in memory. A file that is used several times
+    is decoded once and its pattern is shared by its cells. Returns the
+    number of pages.
+    """
+    fmt = output_format(output, fmt)
+    cells = columns * rows
+    cell_width = (width - margin * (columns + 1)) / columns
+    cell_height = (height - margin * (rows + 1)) / rows
+    if cell_width <= 0 or cell_height <= 0:
+        raise ValueError("The margins leave no space for the cells")
+
+    patterns: dict[str, cairo.SurfacePattern] = {}
+    pages = [files[start : start + cells] for start in range(0, len(files), cells)]
+    for number, page in enumerate(pages):
+        target_surf = cairo.ImageSurface(cairo.FORMAT_RGB24, width, height)
+        cr = cairo.Context(target_surf)
+        cr.set_source_rgb(1, 1, 1)
+        cr.paint()
+
+        for cell, file in enumerate(page):
+            if file not in patterns:
+                patterns[file] = cairo.SurfacePattern(_load(file))
+                patterns[file].set_filter(cairo.FILTER_GOOD)
+            pattern = patterns[file]
+            source_surf = pattern.get_surface()
+            source_width, source_height = (
+                source_surf.get_width(),
+                source_surf.get_height(),
+            )
+
+            scale = min(cell_width / source_width, cell_height / source_height)
+            column, row = cell % columns, cell // columns
+            x = margin + column * (cell_width + margin)
+            y = margin + row * (cell_height + margin)
+
+            cr.save()
+            # center the image in its cell
+            cr.translate(
+                x + (cell_width - source_width * scale) / 2,
+                y + (cell_height - source_height * scale) / 2,
+            )
+            cr.scale(scale, scale)
+            cr.set_source(pattern)
+            cr.rectangle(0, 0, source_width, source_height)
+            cr.fill()
+            cr.restore()
+
+        _save(target_surf, page_name(output, number, len(pages)), fmt)
+    return len(pages)
 
 
 def main():
-    """draw an image"""
+    """draw an image, or several images on pages in a grid"""
     parser = ap.ArgumentParser("draw.py", "draw a picture")
-    parser.add_argument("file", type=str, help="the file used as source surface")
+    parser.add_argument(
+        "files",
+        type=str,
+        nargs="+",
+        help="the images used as source surface, - for stdin",
+    )
     parser.add_argument(
         "-w",
         "--width",
@@ -58,10 +196,65 @@ def main():
         default=1.0,
         help="apply scaling to the source surface",
     )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        default="draw.png",
+        help="the file to write to, - for stdout",
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        choices=FORMATS,
+        default="",
+        help="png or uncompressed pam/ppm, default: the extension of the output. "
+        "pam holds the pixels of cairo as they are, as premultiplied "
+        f"{netpbm.PAM_TUPLTYPE} (not a standard tuple type), use ppm for other "
+        "tools",
+    )
+    parser.add_argument(
+        "-g",
+        "--grid",
+        type=str,
+        default="",
+        help="columns x rows, like 2x2, the images are fitted in the cells of "
+        "as many pages as needed",
+    )
+    parser.add_argument(
+        "-m",
+        "--margin",
+        type=float,
+        default=0.0,
+        help="the pixels around the cells of the grid",
+    )
 
     args = parser.parse_args()
 
-    draw(args.file, args.width, args.height, args.scale)
+    if args.grid or len(args.files) > 1:
+        try:
+            columns, rows = parse_grid(args.grid or "1x1")
+        except ValueError as e:
+            parser.error(str(e))
+        compose(
+            args.files,
+            args.width,
+            args.height,
+            columns,
+            rows,
+            args.margin,
+            args.output,
+            args.format,
+        )
+    else:
+        draw(
+            args.files[0],
+            args.width,
+            args.height,
+            args.scale,
+            args.output,
+            args.format,
+        )
 
 
 if __name__ == "__main__":
@@ -3,23 +3,58 @@
 from __future__ import annotations
 
 import gi
+import dataclasses
 import sys
 import cairo
 import logging
 import math
+import os
 import os.path as p
-from image import RecImage
-import image
+import threading
+from collections.abc import Callable
+from image import PAPER_SIZES, RecImage, TextMeasure
 from model import Model
+from autosave import AutoSaver
+from rendercache import RenderCache
 import space
+import events
+import library
+import lineart
+import memory
+import profiling
+import renderproc
+import tiles
 
 
 gi.require_version("Gtk", "4.0")
 gi.require_version("Gdk", "4.0")
 gi.require_version("Pango", "1.0")
 gi.require_version("GObject", "2.0")
+gi.require_version("Gio", "2.0")
+gi.require_version("GLib", "2.0")
 
-from gi.repository import Gtk, Gdk, Pango
+from gi.repository import Gtk, Gdk, Gio, GLib, GObject, Pango
+
+
+def call_later(delay: float, function: Callable[[], None]) -> Callable[[], None]:
+    """Calls function in the main loop after delay seconds, returns a function
+    that cancels the call. The autosaver snapshots the model on the GUI thread
+    this way, between the edits.
+    """
+    source = None
+
+    def run():
+        nonlocal source
+        source = None
+        function()
+        return GLib.SOURCE_REMOVE
+
+    def cancel():
+        if source is not None:
+            GLib.source_remove(source)
+
+    source = GLib.timeout_add(int(delay * 1000), run)
+    return cancel
 
 
 class AppWindowMixin:
@@ -55,56 +90,310 @@ class AppWindowMixin:
 
 
 class DrawingWidget(Gtk.DrawingArea, AppWindowMixin):
-    """Gives a preview of the rendered drawing"""
+    """Gives a preview of the rendered drawing
+
+    The preview can be zoomed with Control + scroll or by pinching, and panned
+    by scrolling or by dragging with the middle mouse button. The visible
+    part of the page is drawn from a cache of tiles, or by a render process.
+    """
 
     model: Model
+    zoom: float  # 1.0 fits the width of the page in the widget
+    origin: space.Point2D  # the point of the page at the top left corner
+    tile_cache: tiles.TileCache
+    render_process: renderproc.RenderProcess | None
+
+    MAX_ZOOM = 16.0
+    ZOOM_STEP = 1.25  # per scroll step
 
     def __init__(self, model: Model, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.model = model
+        self.zoom = 1.0
+        self.origin = space.Point2D()
+        self.tile_cache = tiles.TileCache()
+        self.render_process = None
         self.set_size_request(594, 841)
 
         self.set_draw_func(self.draw)
         self._setup_mouse_events()
+        self._setup_zoom_events()
         self.set_valign(Gtk.Align.CENTER)
         self.set_vexpand(False)
 
+    @property
+    def scale(self) -> float:
+        """The number of widget pixels per pixel of the page"""
+        return self.get_width() / self.model.rec_surf.width * self.zoom
+
+    @property
+    def render_scale(self) -> float:
+        """The scale of the tiles that are shown, 0 before the widget has a
+        size.
+        """
+        if not self.get_width():
+            return 0.0
+        return 2.0 ** tiles.level_for_scale(self.scale)
+
+    @property
+    def view(self) -> renderproc.View:
+        return renderproc.View(
+            self.get_width(),
+            self.get_height(),
+            self.scale,
+            self.origin.x,
+            self.origin.y,
+        )
+
     def draw(self, darea, cr: cairo.Context, width, height):
+        with profiling.span("preview.draw"):
+            cr.save()
+            if self.render_process and self.render_process.alive:
+                self._draw_frame(cr)
+            else:
+                self._draw_tiles(cr, width, height)
+            cr.restore()
+        if profiling.profiler.enabled:
+            self._draw_profile(cr)
+
+    def _draw_tiles(self, cr: cairo.Context, width, height):
         surf = self.model.rec_surf.surf
 
         # set the surface to gray
         cr.set_source_rgb(0.5, 0.5, 0.5)
         cr.paint()
 
-        if surf:
-            scale = self.get_width() / self.model.rec_surf.width
-            pattern = cairo.SurfacePattern(surf)
+        if not surf:
+            return
+
+        self.tile_cache.set_source(surf)
+        scale = self.scale
+        level = tiles.level_for_scale(scale)
+        tile_scale = 2.0**level
+        page_width, page_height = self.model.rec_surf.pars.size
+        x0, y0 = max(0.0, self.origin.x), max(0.0, self.origin.y)
+        x1 = min(page_width, self.origin.x + width / scale)
+        y1 = min(page_height, self.origin.y + height / scale)
+
+        cr.scale(scale, scale)
+        cr.translate(-self.origin.x, -self.origin.y)
+        cr.rectangle(0, 0, page_width, page_height)
+        cr.clip()
+        # tile pixels to page pixels
+        cr.scale(1 / tile_scale, 1 / tile_scale)
+        size = self.tile_cache.tile_size
+        for column, row in self.tile_cache.visible(level, x0, y0, x1, y1):
+            pattern = cairo.SurfacePattern(self.tile_cache.tile(level, column, row))
+            pattern.set_filter(cairo.FILTER_GOOD)
             mat = cairo.Matrix()
-            mat.scale(1 / scale, 1 / scale)
+            mat.translate(-column * size, -row * size)
             pattern.set_matrix(mat)
             cr.set_source(pattern)
-            cr.rectangle(0.0, 0.0, width, height)
-        else:
-            cr.set_source_rgb(0.5, 0.5, 0.5)
-            cr.rectangle(0.0, 0.0, width, height)
+            cr.rectangle(column * size, row * size, size, size)
+            cr.fill()
+
+    def _draw_frame(self, cr: cairo.Context):
+        """Paints the newest frame of the render process, and requests the
+        current view.
+        """
+        cr.set_source_rgb(0.5, 0.5, 0.5)
+        cr.paint()
+
+        self.render_process.request(self.view)
+        frame = self.render_process.frame()
+        if not frame:
+            return
+        surf, view = frame
+        # the frame may lag behind the view, map its pixels to the page and
+        # from the page to the widget
+        cr.scale(self.scale, self.scale)
+        cr.translate(view.origin_x - self.origin.x, view.origin_y - self.origin.y)
+        cr.scale(1 / view.scale, 1 / view.scale)
+        cr.set_source_surface(surf)
+        cr.paint()
+
+    def _draw_profile(self, cr: cairo.Context):
+        """Draws the timings of the render stages on top of the preview"""
+        lines = [f"{'stage':<24}{'p50':>8}{'p90':>8}{'max':>8}  ms"]
+        for name, stats in sorted(profiling.profiler.stats().items()):
+            lines.append(
+                f"{name:<24}{stats['p50']:8.1f}{stats['p90']:8.1f}{stats['max']:8.1f}"
+            )
+        lines.append(f"{'memory':<24}{'MB':>8}")
+        lines.extend(memory.budget.report())
+        cr.select_font_face("monospace")
+        cr.set_font_size(11)
+        line_height = 14
+        cr.set_source_rgba(0, 0, 0, 0.7)
+        cr.rectangle(4, 4, 420, line_height * len(lines) + 8)
         cr.fill()
+        cr.set_source_rgb(1, 1, 1)
+        for i, line in enumerate(lines):
+            cr.move_to(10, 4 + line_height * (i + 1))
+            cr.show_text(line)
+
+    def _widget_to_page(self, x: float, y: float) -> space.Point2D:
+        """Maps widget coordinates to coordinates on the page"""
+        vec = space.Vector2D(x, y)
+        vec *= 1 / self.scale
+        return self.origin + vec
+
+    def _clamp_origin(self):
+        """Keeps the page in view"""
+        scale = self.scale
+        page_width, page_height = self.model.rec_surf.pars.size
+        max_x = max(0.0, page_width - self.get_width() / scale)
+        max_y = max(0.0, page_height - self.get_height() / scale)
+        self.origin = space.Point2D(
+            min(max_x, max(0.0, self.origin.x)), min(max_y, max(0.0, self.origin.y))
+        )
+
+    def zoom_at(self, zoom: float, x: float, y: float):
+        """Zooms to zoom, the page under widget position x, y stays put"""
+        point = self._widget_to_page(x, y)
+        self.zoom = min(self.MAX_ZOOM, max(1.0, zoom))
+        self.origin = point - space.Vector2D(x, y) * (1 / self.scale)
+        self._clamp_origin()
+        rec = self.model.rec_surf
+        if self.render_scale != rec.drawn_scale:
+            # record with the image level and glyphs of the new scale
+            self.update_app_window()
+        else:
+            self.queue_draw()
+
+    def pan(self, dx: float, dy: float):
+        """Moves the view by dx, dy widget pixels"""
+        self.origin = self.origin + space.Vector2D(dx, dy) * (1 / self.scale)
+        self._clamp_origin()
+        self.queue_draw()
+
+    def _setup_zoom_events(self):
+        self._pointer = (0.0, 0.0)
+        self._pinch_zoom = 1.0
+        self._pan_origin = self.origin
+
+        def on_motion(motion: Gtk.EventControllerMotion, x: float, y: float):
+            self._pointer = x, y
+
+        def on_scroll(scroll: Gtk.EventControllerScroll, dx: float, dy: float):
+            state = scroll.get_current_event_state()
+            if state & Gdk.ModifierType.CONTROL_MASK:
+                self.zoom_at(self.zoom * self.ZOOM_STEP ** (-dy), *self._pointer)
+            else:
+                step = 0.1 * self.get_width()
+                self.pan(dx * step, dy * step)
+            return True
+
+        def on_pinch_begin(gesture: Gtk.GestureZoom, sequence):
+            self._pinch_zoom = self.zoom
+
+        def on_pinch(gesture: Gtk.GestureZoom, scale: float):
+            _, x, y = gesture.get_bounding_box_center()
+            self.zoom_at(self._pinch_zoom * scale, x, y)
+
+        def on_pan_begin(drag: Gtk.GestureDrag, x: float, y: float):
+            self._pan_origin = self.origin
+
+        def on_pan_update(drag: Gtk.GestureDrag, offset_x: float, offset_y: float):
+            self.origin = self._pan_origin
+            self.pan(-offset_x, -offset_y)
+
+        motion = Gtk.EventControllerMotion()
+        motion.connect("motion", on_motion)
+        self.add_controller(motion)
+
+        scroll = Gtk.EventControllerScroll.new(
+            Gtk.EventControllerScrollFlags.BOTH_AXES
+        )
+        scroll.connect("scroll", on_scroll)
+        self.add_controller(scroll)
+
+        pinch = Gtk.GestureZoom()
+        pinch.connect("begin", on_pinch_begin)
+        pinch.connect("scale-changed", on_pinch)
+        self.add_controller(pinch)
+
+        pan_drag = Gtk.GestureDrag()
+        pan_drag.set_button(Gdk.BUTTON_MIDDLE)
+        pan_drag.connect("drag-begin", on_pan_begin)
+        pan_drag.connect("drag-update", on_pan_update)
+        self.add_controller(pan_drag)
 
     def _setup_mouse_events(self):
         def on_mouse_press(click: Gtk.GestureClick, n_press: int, x: float, y: float):
             if not self.model.show_path:  # don't allow path manipulations
                 return
-            orgin = space.Point2D()
-            vec = space.Vector2D(x, y)
-            scale = self.model.rec_surf.width / self.get_width()
-            vec *= scale
-            point = orgin + vec
-            self.model.exclusion_path.append(point)
-            self.update_app_window()
+            point = self._widget_to_page(x, y)
+            self.model.add_path_point(point)
 
         gesture_click = Gtk.GestureClick()
         self.add_controller(gesture_click)
         gesture_click.connect("pressed", on_mouse_press)
 
+        self._setup_distractor_events()
+
+    def _setup_distractor_events(self):
+        """Allows to pick distractors with the mouse, drag them around or delete
+        them with the Delete key.
+        """
+        self.selected = None
+        self._drag_start = None
+        self._drag_page_start = space.Point2D()
+        self.set_focusable(True)
+
+        def on_drag_begin(drag: Gtk.GestureDrag, x: float, y: float):
+            if self.model.show_path:  # clicks are used to draw the path
+                self.selected = None
+                return
+            start = self._widget_to_page(x, y)
+            self.selected = self.model.distractor_at(start)
+            if self.selected:
+                self._drag_start = self.selected.pos
+                self._drag_page_start = start
+                self.grab_focus()
+
+        def on_drag_update(drag: Gtk.GestureDrag, offset_x: float, offset_y: float):
+            if not self.selected or not self._drag_start:
+                return
+            _, x, y = drag.get_start_point()
+            offset = self._widget_to_page(x + offset_x, y + offset_y)
+            offset -= self._drag_page_start
+            self.model.move_distractor(self.selected, self._drag_start + offset)
+
+        def on_drag_end(drag: Gtk.GestureDrag, offset_x: float, offset_y: float):
+            self._drag_start = None
+            self.model.history.checkpoint()  # the next drag is a new step
+
+        def on_key_press(
+            controller: Gtk.EventControllerKey,
+            keyval: int,
+            keycode: int,
+            state: Gdk.ModifierType,
+        ):
+            if keyval != Gdk.KEY_Delete or not self.selected:
+                return False
+            index = self.model.distractors.index(self.selected)
+            self.model.remove_distractor(index)
+            return True
+
+        def on_distractors_changed(change: events.Change):
+            # the index only contains the distractors that are present
+            if self.selected and self.selected not in self.model.distractor_index:
+                self.selected = None
+                self._drag_start = None
+
+        self.model.subscribe(on_distractors_changed, events.DISTRACTORS)
+
+        gesture_drag = Gtk.GestureDrag()
+        self.add_controller(gesture_drag)
+        gesture_drag.connect("drag-begin", on_drag_begin)
+        gesture_drag.connect("drag-update", on_drag_update)
+        gesture_drag.connect("drag-end", on_drag_end)
+
+        key_controller = Gtk.EventControllerKey()
+        self.add_controller(key_controller)
+        key_controller.connect("key-pressed", on_key_press)
+
 
 class WordGrid(Gtk.Grid):
     """A grid with a number of widgets that controls the
@@ -136,38 +425,29 @@ class WordGrid(Gtk.Grid):
             self.font_button.set_font(self.model.font)
         self.attach(self.font_button, 0, 1, 2, 1)
 
-        x_range = image.image_ppi(image.A4_WIDTH, image.DPI)
-        y_range = image.image_ppi(image.A4_HEIGHT, image.DPI)
-
-        self.word_x = Gtk.Scale.new_with_range(
-            Gtk.Orientation.HORIZONTAL,
-            math.floor(-x_range / 2),
-            math.floor(x_range / 2),
-            1,
-        )
+        # the ranges are set to the paper by _sync_word_position
+        self.word_x = Gtk.Scale.new_with_range(Gtk.Orientation.HORIZONTAL, 0, 1, 1)
         self.word_x.set_draw_value(True)
         self.word_x.set_size_request(150, 150)
         self.word_x.connect("value-changed", self._on_x_scale_changed)
-        self.word_x.set_value(self.model.word_x)
-        self.word_y = Gtk.Scale.new_with_range(
-            Gtk.Orientation.VERTICAL,
-            math.floor(-y_range / 2),
-            math.floor(y_range / 2),
-            1,
-        )
+        self.word_y = Gtk.Scale.new_with_range(Gtk.Orientation.VERTICAL, 0, 1, 1)
         self.word_y.set_size_request(150, 150)
         self.word_y.connect("value-changed", self._on_y_scale_changed)
-        self.word_y.set_value(self.model.word_y)
         self.word_y.set_draw_value(True)
+        self._sync_word_position()
         self.attach(Gtk.Label(label="x"), 0, 2, 1, 1)
         self.attach(Gtk.Label(label="y"), 1, 2, 1, 1)
         self.attach(self.word_x, 0, 3, 1, 1)
         self.attach(self.word_y, 1, 3, 1, 1)
 
+        self.model.subscribe(
+            self._on_model_changed, events.WORD, events.FONT, events.PAPER
+        )
+
     def _on_text_changed(self, entry_buffer: Gtk.EntryBuffer, value):
         """Select a new word to draw along with the drawing"""
-        self.model.word = entry_buffer.get_text()
-        self.parent.update()
+        if entry_buffer.get_text() != self.model.word:
+            self.model.word = entry_buffer.get_text()
 
     def _on_font_set(self, button: Gtk.FontButton, value: gobject.GParamSpec):
         """Select a new font"""
@@ -175,23 +455,224 @@ class WordGrid(Gtk.Grid):
         self.model.font = button.get_font_desc().to_string()
         if not fontdesc or not fontdesc.equal(button.get_font_desc()):
             self.model.set_font_desc(button.get_font_desc())
-            self.parent.update()
 
     def _on_x_scale_changed(self, scale):
         if scale.get_value() != self.model.word_x:
             self.model.word_x = scale.get_value()
-            self.parent.update()
 
     def _on_y_scale_changed(self, scale):
-        if scale.get_value() != self.model.word_x:
+        if scale.get_value() != self.model.word_y:
             self.model.word_y = scale.get_value()
-            self.parent.update()
+
+    def _on_model_changed(self, change: events.Change):
+        """Show the word as it is in the model, e.g. after an undo"""
+        if change.kind == events.WORD:
+            buffer = self.word_entry.props.buffer
+            if buffer.props.text != self.model.word:
+                buffer.props.text = self.model.word
+            self._sync_word_position()
+        elif change.kind == events.FONT:
+            font_desc = self.model.get_font_desc()
+            if font_desc and not font_desc.equal(self.font_button.get_font_desc()):
+                self.font_button.set_font_desc(font_desc)
+        elif change.kind == events.PAPER:
+            self._sync_word_position()
+
+    def _sync_word_position(self):
+        """The word can be moved across the paper, the ranges are updated
+        before the values, so they aren't clamped to the previous paper.
+        """
+        width, height = self.model.rec_surf.pars.size
+        self.word_x.set_range(math.floor(-width / 2), math.floor(width / 2))
+        self.word_y.set_range(math.floor(-height / 2), math.floor(height / 2))
+        if self.word_x.get_value() != self.model.word_x:
+            self.word_x.set_value(self.model.word_x)
+        if self.word_y.get_value() != self.model.word_y:
+            self.word_y.set_value(self.model.word_y)
+
+
+class LineArtGrid(Gtk.Grid):
+    """Controls the conversion of the image to line art
+
+    The stages of the conversion run on another thread, the model converts
+    the cached result when they are done. Changes that are made meanwhile,
+    e.g. by dragging a slider, are converted as one.
+    """
+
+    EDGE_LABELS = ("none", "sobel", "difference of gaussians")
+
+    def __init__(self, model: Model, row_spacing=5, column_spacing=5):
+        super().__init__(row_spacing=row_spacing, column_spacing=column_spacing)
+        self.model = model
+        self._converting = False
+        self._pending: lineart.LineArtParameters | None = None
+        pars = self.model.line_art
+
+        self.greyscale = Gtk.CheckButton(label="greyscale")
+        self.greyscale.connect("toggled", self._on_changed)
+        self.attach(self.greyscale, 0, 0, 2, 1)
+
+        self.edges = Gtk.DropDown.new_from_strings(list(self.EDGE_LABELS))
+        self.edges.connect("notify::selected", self._on_changed)
+        self.attach(Gtk.Label(label="edges", xalign=0.0), 0, 1, 1, 1)
+        self.attach(self.edges, 1, 1, 1, 1)
+
+        self.contrast = self._add_scale("contrast", 2, 0.0, 2.0, 0.05, pars.contrast)
+        self.sigma = self._add_scale("edge width", 3, 0.5, 5.0, 0.1, pars.sigma)
+        self.threshold = self._add_scale("threshold", 4, 0, 255, 1, pars.threshold)
+        self.lighten = self._add_scale("lighten", 5, 0.0, 1.0, 0.05, pars.lighten)
+
+        self._on_model_changed()
+        self.model.subscribe(self._on_model_changed, events.IMAGE)
+
+    def _add_scale(self, label, row, low, high, step, value) -> Gtk.Scale:
+        scale = Gtk.Scale.new_with_range(Gtk.Orientation.HORIZONTAL, low, high, step)
+        scale.set_hexpand(True)
+        scale.props.draw_value = True
+        scale.set_value(value)
+        scale.connect("value-changed", self._on_changed)
+        self.attach(Gtk.Label(label=label, xalign=0.0), 0, row, 1, 1)
+        self.attach(scale, 1, row, 1, 1)
+        return scale
+
+    def _on_model_changed(self, change: events.Change | None = None):
+        """Show the parameters of the model, e.g. after an undo"""
+        if self._converting:
+            return
+        pars = self.model.line_art
+        self.greyscale.props.active = pars.greyscale
+        self.edges.set_selected(lineart.EDGE_DETECTORS.index(pars.edges))
+        for scale, value in (
+            (self.contrast, pars.contrast),
+            (self.sigma, pars.sigma),
+            (self.threshold, pars.threshold),
+            (self.lighten, pars.lighten),
+        ):
+            if scale.get_value() != value:
+                scale.set_value(value)
+
+    def _on_changed(self, *args):
+        """Converts with the new parameters, the decoded image and the stages
+        before the changed one are cached.
+        """
+        pars = dataclasses.replace(
+            self.model.line_art,
+            greyscale=self.greyscale.props.active,
+            contrast=self.contrast.get_value(),
+            edges=lineart.EDGE_DETECTORS[self.edges.get_selected()],
+            sigma=self.sigma.get_value(),
+            threshold=round(self.threshold.get_value()),
+            lighten=self.lighten.get_value(),
+        )
+        if pars == self.model.line_art:
+            return
+        self._pending = pars
+        if not self._converting:
+            self._convert()
+
+    def _convert(self):
+        pars, self._pending = self._pending, None
+        fn = self.model.rec_surf.fn
+        self._converting = True
+
+        def run():
+            try:
+                if fn:
+                    lineart.pipeline.process(fn, pars)
+            finally:
+                GLib.idle_add(done)
+
+        def done():
+            self._converting = False
+            if self._pending:
+                self._convert()
+            elif pars != self.model.line_art:
+                self.model.line_art = pars  # the stages are cached
+            return GLib.SOURCE_REMOVE
+
+        threading.Thread(target=run, daemon=True).start()
+
+
+class PaperGrid(Gtk.Grid):
+    """Chooses the size of the page and the resolution of the output"""
+
+    CUSTOM = "custom"  # a size of a config that isn't in PAPER_SIZES
+
+    def __init__(self, model: Model, row_spacing=5, column_spacing=5):
+        super().__init__(row_spacing=row_spacing, column_spacing=column_spacing)
+        self.model = model
+        self.names = list(PAPER_SIZES) + [self.CUSTOM]
+
+        self.paper = Gtk.DropDown.new_from_strings(self.names)
+        self.paper.connect("notify::selected", self._on_paper_selected)
+        self.attach(Gtk.Label(label="paper", xalign=0.0), 0, 0, 1, 1)
+        self.attach(self.paper, 1, 0, 1, 1)
+
+        self.dpi = Gtk.SpinButton.new_with_range(72, 1200, 1)
+        self.dpi.connect("value-changed", self._on_dpi_changed)
+        self.attach(Gtk.Label(label="dpi", xalign=0.0), 0, 1, 1, 1)
+        self.attach(self.dpi, 1, 1, 1, 1)
+
+        self._sync()
+        self.model.subscribe(self._sync, events.PAPER)
+
+    def _sync(self, change: events.Change | None = None):
+        """Show the paper and dpi of the model, e.g. after an undo"""
+        name = self.CUSTOM
+        for paper_name, size in PAPER_SIZES.items():
+            if tuple(size) == tuple(self.model.paper):
+                name = paper_name
+        if self.names[self.paper.get_selected()] != name:
+            self.paper.set_selected(self.names.index(name))
+        if self.dpi.get_value() != self.model.dpi:
+            self.dpi.set_value(self.model.dpi)
+
+    def _on_paper_selected(self, dropdown: Gtk.DropDown, value):
+        name = self.names[dropdown.get_selected()]
+        if name != self.CUSTOM and PAPER_SIZES[name] != self.model.paper:
+            self.model.paper = PAPER_SIZES[name]
+
+    def _on_dpi_changed(self, button: Gtk.SpinButton):
+        if round(button.get_value()) != self.model.dpi:
+            self.model.dpi = round(button.get_value())
+
+
+class DistractorListModel(GObject.Object, Gio.ListModel):
+    """A list model that views Model.distractors directly
+
+    The items are made when the list view asks for them. The list only
+    exists after the edit, so a change of the distractors is reported as a
+    single items-changed of the rows it spans, also when many distractors are
+    replaced or removed at once.
+    """
+
+    def __init__(self, model: Model):
+        super().__init__()
+        self.model = model
+        model.subscribe(self._on_distractors_changed, events.DISTRACTORS)
+
+    def do_get_item_type(self) -> GObject.GType:
+        return Gtk.StringObject.__gtype__
+
+    def do_get_n_items(self) -> int:
+        return len(self.model.distractors)
+
+    def do_get_item(self, position: int) -> Gtk.StringObject | None:
+        if position >= len(self.model.distractors):
+            return None
+        return Gtk.StringObject.new(self.model.distractors[position].string)
+
+    def _on_distractors_changed(self, change: events.Change):
+        position, removed, added = events.span(change)
+        if removed or added:
+            self.items_changed(position, removed, added)
 
 
 class LetterBox(Gtk.Box, AppWindowMixin):
     """This is the box in the second tab to edit the target letters to present"""
 
     model: model.Model
+    font_button: Gtk.FontButton
     letter_entry: Gtk.Entry
     letter_view: Gtk.ListView
 
@@ -211,6 +692,8 @@ class LetterBox(Gtk.Box, AppWindowMixin):
         scrolled_window.set_size_request(200, 400)
         self.append(scrolled_window)
 
+        self.model.subscribe(self._on_font_changed, events.DISTRACTOR_FONT)
+
     def _setup_font_button(self):
         """Sets up the font button"""
 
@@ -220,14 +703,12 @@ class LetterBox(Gtk.Box, AppWindowMixin):
             self.model.distractor_font = button.get_font_desc().to_string()
             if not font_desc or not font_desc.equal(button.get_font_desc()):
                 self.model.set_distractor_font_desc(button.get_font_desc())
-                if self.get_parent() is not None:
-                    self.update_app_window()
 
-        font_button = Gtk.FontButton()
-        font_button.connect("notify::font-desc", font_set, self)
+        self.font_button = Gtk.FontButton()
+        self.font_button.connect("notify::font-desc", font_set, self)
         if self.model.distractor_font:
-            font_button.set_font(self.model.distractor_font)
-        self.append(font_button)
+            self.font_button.set_font(self.model.distractor_font)
+        self.append(self.font_button)
 
     def _setup_entry(self):
         """Setup the entry to fill the content of the letter list"""
@@ -260,26 +741,31 @@ class LetterBox(Gtk.Box, AppWindowMixin):
             state: Gdk.ModifierType,
             self: LetterBox,
         ):
-            """Deletes keys from the distractor list"""
+            """Deletes the selected distractors from the list"""
             if keyval == Gdk.KEY_Delete:
-                list_model = self.letter_view.get_model()
-                selected = list_model.get_selected_item()
-                if selected:
-                    string = selected.get_string()
-                    del self.model.distractors[list_model.get_selected()]
-                    list_model.get_model().remove(list_model.get_selected())
-
-        letter_model = Gtk.StringList.new([d.string for d in self.model.distractors])
+                selection = self.letter_view.get_model().get_selection()
+                indices = [selection.get_nth(i) for i in range(selection.get_size())]
+                if indices:
+                    self.model.remove_distractors(indices)
+
         factory = Gtk.SignalListItemFactory()
         factory.connect("setup", setup_list_item)
         factory.connect("bind", bind_list_item)
         self.letter_view = Gtk.ListView.new(
-            Gtk.SingleSelection.new(letter_model), factory
+            Gtk.MultiSelection.new(DistractorListModel(self.model)), factory
         )
         event_controller = Gtk.EventControllerKey()
         self.letter_view.add_controller(event_controller)
         event_controller.connect("key-pressed", handle_key_press, self)
 
+    def _on_font_changed(self, change: events.Change):
+        """Keeps the font in sync with the model, the rows follow the model
+        by themselves (see DistractorListModel).
+        """
+        font_desc = self.model.get_distractor_font_desc()
+        if font_desc and not font_desc.equal(self.font_button.get_font_desc()):
+            self.font_button.set_font_desc(font_desc)
+
     def _letter_entry_activated(self, entry: Gtk.Entry):
         """Called on activation of the entry, to add letters to the list of
         distractors"""
@@ -287,14 +773,13 @@ class LetterBox(Gtk.Box, AppWindowMixin):
         entry.set_text("")  # clear it
         if text:
             self.model.add_distractor(text)
-            self.letter_view.get_model().get_model().append(text)
-            self.update_app_window()
 
 
 class PathBox(Gtk.Box, AppWindowMixin):
     """This is the box in the third tab to edit the path for exclusion of distractors"""
 
     check_box: Gtk.CheckButton
+    close_box: Gtk.CheckButton
 
     def __init__(self, model: model.Model):
         super().__init__(orientation=Gtk.Orientation.VERTICAL, spacing=5.0)
@@ -308,9 +793,8 @@ class PathBox(Gtk.Box, AppWindowMixin):
         self.append(hbox)
 
         def on_toggled(box: Gtk.CheckButton):
-            model = self.model
-            model.show_path = box.props.active
-            self.update_app_window()
+            if box.props.active != self.model.show_path:
+                self.model.show_path = box.props.active
 
         self.check_box = Gtk.CheckButton.new_with_label("show/draw path")
         self.check_box.set_tooltip_text(
@@ -322,27 +806,111 @@ class PathBox(Gtk.Box, AppWindowMixin):
         self.check_box.props.active = self.model.show_path
         hbox.append(self.check_box)
 
-        close_box = Gtk.CheckButton(label="close path")
-        close_box.props.active = self.model.close_path
-        hbox.append(close_box)
+        self.close_box = Gtk.CheckButton(label="close path")
+        self.close_box.props.active = self.model.close_path
+        hbox.append(self.close_box)
 
         def on_close_toggled(box: Gtk.CheckButton):
-            self.model.close_path = box.props.active
-            self.update_app_window()
+            if box.props.active != self.model.close_path:
+                self.model.close_path = box.props.active
 
         self.check_box.connect("toggled", on_toggled)
-        close_box.connect("toggled", on_close_toggled)
+        self.close_box.connect("toggled", on_close_toggled)
+
+        def on_path_changed(change: events.Change):
+            self.check_box.props.active = self.model.show_path
+            self.close_box.props.active = self.model.close_path
+
+        self.model.subscribe(on_path_changed, events.EXCLUSION_PATH)
 
     def _setup_clear_button(self):
         def on_clear_button_clicked(button):
-            self.model.exclusion_path.clear()
-            self.update_app_window()
+            self.model.clear_path()
 
         button = Gtk.Button.new_with_label("clear path")
         button.connect("clicked", on_clear_button_clicked)
         self.append(button)
 
 
+class LibraryBox(Gtk.Box, AppWindowMixin):
+    """This is the box in the fourth tab to browse and open other worksheets"""
+
+    library: library.Library
+    search_entry: Gtk.SearchEntry
+    list_box: Gtk.ListBox
+
+    def __init__(self, library_name: str = library.LIBRARY_NAME):
+        super().__init__(orientation=Gtk.Orientation.VERTICAL, spacing=5.0)
+        self.library = library.Library(library_name)
+        self.append(Gtk.Label(label="Worksheet library"))
+
+        self.search_entry = Gtk.SearchEntry()
+        self.search_entry.connect("search-changed", lambda entry: self.refresh())
+        self.append(self.search_entry)
+
+        scan_button = Gtk.Button.new_with_label("scan folder")
+        scan_button.set_tooltip_text("Add the worksheets in the current folder")
+        scan_button.connect("clicked", self._on_scan_clicked)
+        self.append(scan_button)
+
+        self.list_box = Gtk.ListBox()
+        self.list_box.connect("row-activated", self._on_row_activated)
+        scrolled_window = Gtk.ScrolledWindow()
+        scrolled_window.set_child(self.list_box)
+        scrolled_window.set_size_request(200, 400)
+        self.append(scrolled_window)
+
+        self.refresh()
+
+    def refresh(self):
+        """Show the worksheets that match the search text"""
+        while child := self.list_box.get_first_child():
+            self.list_box.remove(child)
+
+        for entry in self.library.search(self.search_entry.get_text()):
+            hbox = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=5)
+            if entry.thumbnail:
+                texture = Gdk.Texture.new_from_bytes(GLib.Bytes.new(entry.thumbnail))
+                picture = Gtk.Picture.new_for_paintable(texture)
+                picture.set_size_request(library.THUMBNAIL_WIDTH // 2, -1)
+                hbox.append(picture)
+            label = Gtk.Label(
+                label=f"{entry.word or p.basename(entry.config)}\n"
+                f"{entry.n_distractors} letters",
+                xalign=0.0,
+            )
+            label.set_tooltip_text(entry.config)
+            hbox.append(label)
+            row = Gtk.ListBoxRow()
+            row.set_child(hbox)
+            row.config = entry.config
+            self.list_box.append(row)
+        return GLib.SOURCE_REMOVE
+
+    def _on_scan_clicked(self, button: Gtk.Button):
+        """Scans the current folder and renders the thumbnails on another
+        thread, the list is refreshed on the GUI thread.
+        """
+
+        def on_scanned(found: int):
+            GLib.idle_add(self.refresh)
+
+        def on_done(rendered: int):
+            if rendered:
+                GLib.idle_add(self.refresh)
+
+        library.update_thumbnails_in_background(
+            self.library.fn, on_done, os.getcwd(), on_scanned
+        )
+
+    def _on_row_activated(self, list_box: Gtk.ListBox, row: Gtk.ListBoxRow):
+        """Open the worksheet in a new window"""
+        app = self.get_app_window().get_application()
+        model = Model.from_file(row.config)
+        window = MyWin(model, application=app, title=p.basename(row.config))
+        window.present()
+
+
 class MyWin(Gtk.ApplicationWindow):
     hbox: Gtk.Box  # horizontally oriented box
     vbox: Gtk.Box  # vertically oriented box
@@ -353,6 +921,9 @@ class MyWin(Gtk.ApplicationWindow):
     img_label: Gtk.Label
     word_box: Gtk.Box  # box with word parameters
     letter_box: LetterBox  # box that fills the tab with letter info
+    path_box: PathBox  # box that fills the tab with the path tool
+    autosaver: AutoSaver  # saves the model shortly after it changes
+    render_cache: RenderCache  # previously saved drawings
 
     image_label_start: str = "Image: "
 
@@ -360,6 +931,11 @@ class MyWin(Gtk.ApplicationWindow):
         logging.info("Init window")
         super().__init__(*args, **kwargs)
         self.model = model
+        self.autosaver = AutoSaver(self.model, schedule=call_later)
+        self.autosaver.start()
+        self.render_cache = RenderCache()
+        self._measure = None
+        self._measure_font = ""
 
         margin = 5
 
@@ -384,7 +960,9 @@ class MyWin(Gtk.ApplicationWindow):
         self.vbox.set_spacing(5)
         tabview.append_page(self.vbox, Gtk.Label(label="Image"))
         tabview.append_page(self.letter_box, Gtk.Label(label="Letters"))
-        tabview.append_page(PathBox(self.model), Gtk.Label(label="Path"))
+        self.path_box = PathBox(self.model)
+        tabview.append_page(self.path_box, Gtk.Label(label="Path"))
+        tabview.append_page(LibraryBox(), Gtk.Label(label="Library"))
         self.tab_save_box.append(tabview)
 
         frame = Gtk.Frame(label="drawing")
@@ -440,6 +1018,16 @@ class MyWin(Gtk.ApplicationWindow):
 
         self.vbox.append(Gtk.Separator(orientation=Gtk.Orientation.HORIZONTAL))
 
+        self.vbox.append(PaperGrid(self.model))
+
+        self.vbox.append(Gtk.Separator(orientation=Gtk.Orientation.HORIZONTAL))
+
+        line_art = Gtk.Expander(label="Line art")
+        line_art.set_child(LineArtGrid(self.model))
+        self.vbox.append(line_art)
+
+        self.vbox.append(Gtk.Separator(orientation=Gtk.Orientation.HORIZONTAL))
+
         self.word_grid = WordGrid(self.model, self)
         self.vbox.append(self.word_grid)
 
@@ -448,50 +1036,175 @@ class MyWin(Gtk.ApplicationWindow):
         button.connect("clicked", self.on_save_clicked)
         self.tab_save_box.append(button)
 
+        self._setup_history_actions()
+
+        self._update_queued = False
+        self.model.subscribe(self._on_model_changed)
+
         # connect the unrealize signal, to save the config
         self.connect("unrealize", self.unrealize)
 
+        self._sync_image_controls()
         self.update()  # the GUI
+        # initializing the widgets is not an edit that can be undone
+        self.model.history.reset()
+
+    def _setup_history_actions(self):
+        """Adds the win.undo, win.redo, win.profile and win.render_process
+        actions
+        """
+
+        def on_undo(action: Gio.SimpleAction, parameter):
+            self.model.history.undo()
+
+        def on_redo(action: Gio.SimpleAction, parameter):
+            self.model.history.redo()
+
+        undo = Gio.SimpleAction.new("undo", None)
+        undo.connect("activate", on_undo)
+        self.add_action(undo)
+        redo = Gio.SimpleAction.new("redo", None)
+        redo.connect("activate", on_redo)
+        self.add_action(redo)
+
+        def on_profile(action: Gio.SimpleAction, state: GLib.Variant):
+            action.set_state(state)
+            profiling.profiler.enabled = state.get_boolean()
+            if not profiling.profiler.enabled:
+                profiling.profiler.reset()
+            self.dwidget.queue_draw()
+
+        profile = Gio.SimpleAction.new_stateful(
+            "profile", None, GLib.Variant.new_boolean(profiling.profiler.enabled)
+        )
+        profile.connect("change-state", on_profile)
+        self.add_action(profile)
+
+        def on_render_process(action: Gio.SimpleAction, state: GLib.Variant):
+            action.set_state(state)
+            if state.get_boolean():
+                self.start_render_process()
+            else:
+                self.stop_render_process()
+
+        render_process = Gio.SimpleAction.new_stateful(
+            "render_process", None, GLib.Variant.new_boolean(False)
+        )
+        render_process.connect("change-state", on_render_process)
+        self.add_action(render_process)
 
     def on_img_scale_changed(self, scale):
-        img_pars = self.model.rec_surf.pars
-        if 1 / scale.get_value() != img_pars.surf_scale_factor:
-            img_pars.surf_scale_factor = 1 / scale.get_value()
-            # img_pars.estimate_image_pars()
-            self.update()
+        if 1 / scale.get_value() != self.model.img_scale_factor:
+            self.model.img_scale_factor = 1 / scale.get_value()
 
     def on_tr_x_changed(self, scale):
-        img_pars = self.model.rec_surf.pars
-        if scale.get_value() != img_pars.surf_tr_x:
-            img_pars.surf_tr_x = scale.get_value()
-            self.update()
+        if scale.get_value() != self.model.img_x:
+            self.model.img_x = scale.get_value()
 
     def on_tr_y_changed(self, scale):
-        img_pars = self.model.rec_surf.pars
-        if scale.get_value() != img_pars.surf_tr_y:
-            img_pars.surf_tr_y = scale.get_value()
-            self.update()
+        if scale.get_value() != self.model.img_y:
+            self.model.img_y = scale.get_value()
 
-    def update(self):
-        self.model.rec_surf.draw()  # update the drawing
+    def _on_model_changed(self, change: events.Change):
+        """Every change requires a new drawing, only changes of the image
+        require the image controls to be updated.
+        """
+        if change.kind in (events.IMAGE, events.IMAGE_TRANSFORM, events.PAPER):
+            self._sync_image_controls()
+        self.queue_update()
+
+    def _sync_image_controls(self):
         self.img_label.props.label = self.image_label_start + p.basename(
             self.model.rec_surf.fn
         )
 
         # get reference to image parameters
         img_pars = self.model.rec_surf.pars
+        # the image can be placed anywhere on the paper
+        self.img_tr_x.set_range(0, self.model.rec_surf.width)
+        self.img_tr_y.set_range(0, self.model.rec_surf.height)
 
         if 1 / self.img_scale.get_value() != img_pars.surf_scale_factor:
             self.img_scale.set_value(1 / img_pars.surf_scale_factor)
+        if self.img_tr_x.get_value() != img_pars.surf_tr_x:
+            self.img_tr_x.set_value(img_pars.surf_tr_x)
+        if self.img_tr_y.get_value() != img_pars.surf_tr_y:
+            self.img_tr_y.set_value(img_pars.surf_tr_y)
+
+    def queue_update(self):
+        """Update the drawing once the pending events are handled, so a burst of
+        changes results in one new drawing.
+        """
+        if self._update_queued:
+            return
+
+        def idle_update():
+            self._update_queued = False
+            self.update()
+            return GLib.SOURCE_REMOVE
+
+        self._update_queued = True
+        GLib.idle_add(idle_update)
 
+    def update(self):
+        if self.dwidget.render_process:
+            # the render process draws, only the distractors are measured
+            self._measure_distractors()
+        else:
+            # update the drawing, with the image and the distractor glyphs at
+            # the resolution of the preview
+            self.model.rec_surf.draw(self.dwidget.render_scale, preview=True)
         self.dwidget.queue_draw()
 
+    def _measure_distractors(self):
+        """Registers the sizes of the distractors, so they can be picked"""
+        font_desc = self.model.get_distractor_font_desc()
+        font = font_desc.to_string() if font_desc else ""
+        if self._measure is None or self._measure_font != font:
+            self._measure = TextMeasure(font_desc)
+            self._measure_font = font
+        for d in self.model.distractors:
+            self.model.set_distractor_size(d, *self._measure.size(d.string))
+
+    def start_render_process(self):
+        """Renders the preview in a child process"""
+        process = renderproc.RenderProcess(self.model)
+        process.start()
+
+        def on_readable(fd, condition) -> bool:
+            if process.receive():
+                self.dwidget.queue_draw()
+            elif not process.alive:
+                # draw the tiles again, this removes the watch
+                self.lookup_action("render_process").change_state(
+                    GLib.Variant.new_boolean(False)
+                )
+            return GLib.SOURCE_CONTINUE
+
+        self._render_watch = GLib.io_add_watch(
+            process.fileno(),
+            GLib.PRIORITY_DEFAULT,
+            GLib.IO_IN | GLib.IO_HUP,
+            on_readable,
+        )
+        self.dwidget.render_process = process
+        self.update()
+
+    def stop_render_process(self):
+        """Renders the preview in this process again"""
+        process = self.dwidget.render_process
+        if not process:
+            return
+        GLib.source_remove(self._render_watch)
+        self.dwidget.render_process = None
+        process.stop()
+        self.update()
+
     def _on_open_img(self, dialog: Gtk.Dialog, response: int):
         """Sets the name of the image"""
         if response == Gtk.ResponseType.ACCEPT:
             self.model.path = str(dialog.get_file().get_path())
         dialog.destroy()
-        self.update()
 
     def _choose_image(self, button):
         chooser = Gtk.FileChooserDialog(
@@ -503,13 +1216,14 @@ class MyWin(Gtk.ApplicationWindow):
         chooser.present()
 
     def unrealize(self, _):
-        self.model.save()
+        self.stop_render_process()
+        self.autosaver.stop()
 
     def on_save_image(self, dialog: Gtk.FileChooserDialog, response: int):
         if response == Gtk.ResponseType.ACCEPT:
-            self.update()
             save_path = dialog.get_file().get_path()
-            self.model.rec_surf.surf.write_to_png(save_path)
+            self.model.rec_surf.save(save_path, self.render_cache)
+            logging.info(f"render cache: {self.render_cache.report()}")
         dialog.destroy()
 
     def on_save_clicked(self, button: Gtk.Button):
@@ -532,6 +1246,10 @@ class MyApp(Gtk.Application):
         self.window = None
 
     def do_activate(self):
+        self.set_accels_for_action("win.undo", ["<Control>z"])
+        self.set_accels_for_action("win.redo", ["<Control><Shift>z", "<Control>y"])
+        self.set_accels_for_action("win.profile", ["<Control><Shift>p"])
+        self.set_accels_for_action("win.render_process", ["<Control><Shift>r"])
         if not self.window:
             model = Model.from_file() if p.exists(Model.config_name) else Model()
             self.window = MyWin(model, application=self, title="Letter Drawing")
@@ -540,6 +1258,8 @@ class MyApp(Gtk.Application):
 
 
 def main():
+    # the caches of the preview are shrunk on the GUI thread
+    memory.budget.call_soon = GLib.idle_add
     app = MyApp()
     return app.run(sys.argv)
 
@@ -0,0 +1,94 @@
+"""Notifications of changes to the model and its parameters
+
+Objects that derive from Observable emit a Change for every edit. Others may
+subscribe to the kinds of changes they depend on, e.g. a renderer of the word
+only needs to know about "word" and "font" changes.
+"""
+from __future__ import annotations
+
+from collections.abc import Callable
+from dataclasses import dataclass
+
+# The kinds of changes that are emitted
+IMAGE = "image"  # another source image is used
+IMAGE_TRANSFORM = "image_transform"  # the image is scaled or translated
+WORD = "word"  # the text or position of the word
+FONT = "font"  # the font of the word
+DISTRACTORS = "distractors"  # distractors are added, removed or moved
+DISTRACTOR_FONT = "distractor_font"  # the font of the distractors
+EXCLUSION_PATH = "exclusion_path"  # the points or appearance of the path
+PAPER = "paper"  # the size of the page or the resolution of the output
+
+KINDS = (
+    IMAGE,
+    IMAGE_TRANSFORM,
+    WORD,
+    FONT,
+    DISTRACTORS,
+    DISTRACTOR_FONT,
+    EXCLUSION_PATH,
+    PAPER,
+)
+
+
+@dataclass(frozen=True)
+class Change:
+    """Describes an edit, for list like fields the indices of the items that
+    are added, removed or changed are given. The removed indices refer to
+    the list before the edit, the others to the list after the edit.
+    """
+
+    kind: str
+    added: tuple[int, ...] = ()
+    removed: tuple[int, ...] = ()
+    changed: tuple[int, ...] = ()
+
+
+def span(change: Change) -> tuple[int, int, int]:
+    """Returns the position and the number of removed and added items of the
+    smallest range of items that contains all the added and removed ones, to
+    report the change as a single items-changed. The items after it only
+    move by the difference.
+    """
+    if not change.added and not change.removed:
+        return 0, 0, 0
+    delta = len(change.added) - len(change.removed)
+    first = min(change.added + change.removed)
+    # the last item before the edit that is part of the range
+    last = max(change.removed + tuple(index - delta for index in change.added))
+    removed = last - first + 1
+    return first, removed, removed + delta
+
+
+class Observable:
+    """Mixin for objects that notify their subscribers of changes"""
+
+    @property
+    def _subscribers(self) -> dict[str | None, list[Callable]]:
+        # created on first use, so the mixin doesn't need an __init__
+        try:
+            return self.__dict__["_subscribers_"]
+        except KeyError:
+            return self.__dict__.setdefault("_subscribers_", {})
+
+    def subscribe(self, callback: Callable[[Change], None], *kinds: str):
+        """Call callback for changes of the given kinds, or for all changes
+        when no kinds are given.
+        """
+        for kind in kinds if kinds else (None,):
+            if kind is not None and kind not in KINDS:
+                raise ValueError(f"Unknown kind of change: {kind}")
+            self._subscribers.setdefault(kind, []).append(callback)
+
+    def unsubscribe(self, callback: Callable[[Change], None]):
+        """Stop calling callback for any kind of change"""
+        for callbacks in self._subscribers.values():
+            while callback in callbacks:
+                callbacks.remove(callback)
+
+    def emit(self, change: Change):
+        subscribers = self._subscribers
+        if not subscribers:
+            return
+        for callback in subscribers.get(change.kind, []) + subscribers.get(None, []):
+            callback(change)
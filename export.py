@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""Exports worksheets as compact pngs
+
+Worksheets are mostly black lines on white, so 8 bit grey, 16 grey levels or
+bilevel pngs are much smaller than the default RGB png and they are faster
+to encode. With --compare the size and encoding time are reported relative to
+the default png.
+"""
+from __future__ import annotations
+
+import argparse as ap
+import io
+import time
+
+import image
+import memory
+import profiling
+from model import Model
+
+
+def timed_png(
+    rec: image.RecImage, options: image.PngOptions = image.PngOptions()
+) -> tuple[bytes, float]:
+    """Returns the png and the seconds it took to draw and encode it"""
+    png = io.BytesIO()
+    start = time.perf_counter()
+    rec.write_png(png, options=options)
+    return png.getvalue(), time.perf_counter() - start
+
+
+def main():
+    """Export a worksheet as png"""
+    parser = ap.ArgumentParser("export.py", description="export a worksheet as png")
+    parser.add_argument("config", type=str, help="the worksheet")
+    parser.add_argument("output", type=str, help="the png")
+    parser.add_argument(
+        "-m",
+        "--mode",
+        choices=("RGB", "L", "P", "1"),
+        default="1",
+        help="RGB, 8 bit grey (L), 16 grey levels (P) or bilevel (1)",
+    )
+    parser.add_argument(
+        "-d", "--dither", action="store_true", help="dither P and 1, for photos"
+    )
+    parser.add_argument(
+        "-l", "--level", type=int, default=9, help="the zlib compression level"
+    )
+    parser.add_argument(
+        "--dpi", type=int, default=0, help="by default the dpi of the worksheet"
+    )
+    parser.add_argument(
+        "-c", "--compare", action="store_true", help="compare with the default png"
+    )
+    parser.add_argument(
+        "-p",
+        "--profile",
+        type=str,
+        default="",
+        help="write a Chrome trace of the render stages to this file",
+    )
+    parser.add_argument(
+        "--memory",
+        type=int,
+        default=memory.MAX_BYTES // 2**20,
+        help="the MB that the cached pixel buffers may take",
+    )
+
+    args = parser.parse_args()
+    profiling.profiler.enabled = bool(args.profile)
+    memory.budget.limit = args.memory * 2**20
+
+    model = Model.from_file(args.config)
+    model.load_font_descs()
+    if args.dpi:
+        model.dpi = args.dpi
+    rec = model.rec_surf
+
+    options = image.PngOptions(args.mode, args.dither, args.level)
+    data, seconds = timed_png(rec, options)
+    with open(args.output, "wb") as out:
+        out.write(data)
+    print(f"{args.output}: {len(data)} bytes in {seconds:.3f} s")
+
+    if args.compare:
+        default, default_seconds = timed_png(rec)
+        print(f"default png: {len(default)} bytes in {default_seconds:.3f} s")
+        print(
+            f"{len(default) / len(data):.1f} times smaller, "
+            f"{default_seconds / seconds:.1f} times faster"
+        )
+
+    if args.profile:
+        profiling.profiler.dump(args.profile, trace=True)
+        for name, stats in profiling.profiler.stats().items():
+            print(f"{name}: {stats['count']} x, p50 {stats['p50']:.1f} ms")
+        print("memory in MB:")
+        print("\n".join(memory.budget.report()))
+
+
+if __name__ == "__main__":
+    main()
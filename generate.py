@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""Generates worksheets with distractors from a list of words
+
+Every combination of a word and a target letter results in a variant of a
+base worksheet. The distractors of a variant are a mix of the target letter
+and the other letters of the alphabet, placed at random outside of the
+exclusion path. Each variant has its own random generator that is seeded
+with the seed, word and target, so a variant is always generated
+identically, independent of the other variants.
+"""
+from __future__ import annotations
+
+import argparse as ap
+from collections.abc import Iterable, Iterator
+import os
+import os.path as p
+import random
+import sys
+
+import image
+import space
+import spatial
+from distractors import Distractor
+from model import Model
+from rendercache import RenderCache
+
+MAX_TRIES = 1000  # attempts to place a distractor outside of the path
+
+
+class DistractorGenerator:
+    """Places distractors on the page of a base model
+
+    The glyph sizes and the index of the exclusion path are computed once and
+    reused for every variant.
+    """
+
+    def __init__(self, base: Model):
+        self.base = base
+        self.width, self.height = base.rec_surf.pars.size
+        self.measure = image.TextMeasure(base.get_distractor_font_desc())
+        points = [(point.x, point.y) for point in base.exclusion_path]
+        self.path_index = spatial.PolygonIndex(points)
+
+    @property
+    def page_area(self) -> float:
+        """The area of the page in square inches"""
+        return (self.width / image.DPI) * (self.height / image.DPI)
+
+    def place(self, string: str, rng: random.Random) -> space.Point2D:
+        """Returns a random position where string is on the page and doesn't
+        overlap with the exclusion path.
+        """
+        w, h = self.measure.size(string)
+        for _ in range(MAX_TRIES):
+            x = w / 2 + rng.random() * max(0.0, self.width - w)
+            y = h / 2 + rng.random() * max(0.0, self.height - h)
+            box = x - w / 2, y - h / 2, x + w / 2, y + h / 2
+            if not self.path_index.overlaps(box):
+                return space.Point2D(x, y)
+        raise ValueError(f"Unable to place {string} outside of the exclusion path")
+
+    def distractors(
+        self,
+        rng: random.Random,
+        alphabet: str,
+        target: str,
+        density: float,
+        target_ratio: float,
+    ) -> list[Distractor]:
+        """Returns density distractors per square inch, about target_ratio of
+        them are the target, the others are other letters from alphabet.
+        """
+        others = [letter for letter in alphabet if letter != target] or [target]
+        count = round(density * self.page_area)
+        result = []
+        for _ in range(count):
+            if rng.random() < target_ratio:
+                string = target
+            else:
+                string = rng.choice(others)
+            result.append(Distractor(string, self.place(string, rng)))
+        return result
+
+
+def generate(
+    base: Model,
+    words: Iterable[str],
+    alphabet: str,
+    density: float,
+    seed: int,
+    targets: str = "",
+    target_ratio: float = 0.25,
+) -> Iterator[tuple[str, str, Model]]:
+    """Yields the word, target and model of each variant of base
+
+    When no targets are given, every letter of the alphabet is a target.
+    """
+    generator = DistractorGenerator(base)
+    for word in words:
+        for target in targets if targets else alphabet:
+            rng = random.Random(f"{seed}:{word}:{target}")
+            distractors = generator.distractors(
+                rng, alphabet, target, density, target_ratio
+            )
+            yield word, target, base.derive(word=word, distractors=distractors)
+
+
+def main():
+    """Generate worksheets for a list of words"""
+    parser = ap.ArgumentParser(
+        "generate.py", description="generate worksheets from a list of words"
+    )
+    parser.add_argument("config", type=str, help="the base worksheet")
+    parser.add_argument(
+        "words", type=str, help="a file with one word per line, - for stdin"
+    )
+    parser.add_argument(
+        "-a", "--alphabet", type=str, default="abcdefghijklmnopqrstuvwxyz"
+    )
+    parser.add_argument(
+        "-t", "--targets", type=str, default="", help="default: the alphabet"
+    )
+    parser.add_argument(
+        "-d",
+        "--density",
+        type=float,
+        default=2.0,
+        help="the number of distractors per square inch",
+    )
+    parser.add_argument(
+        "-r",
+        "--target-ratio",
+        type=float,
+        default=0.25,
+        help="the fraction of the distractors that are the target",
+    )
+    parser.add_argument("-s", "--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", type=str, default="generated")
+    parser.add_argument(
+        "--render", action="store_true", help="also render the worksheets as png"
+    )
+    parser.add_argument(
+        "--dpi", type=int, default=image.DPI, help="the resolution of the png"
+    )
+
+    args = parser.parse_args()
+
+    if args.words == "-":
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(args.words, "r", encoding="utf8") as content:
+            lines = content.read().splitlines()
+    words = [line.strip() for line in lines if line.strip()]
+
+    base = Model.from_file(args.config)
+    base.rec_surf.pars.dpi = args.dpi
+    os.makedirs(args.output, exist_ok=True)
+    cache = RenderCache() if args.render else None
+
+    for word, target, model in generate(
+        base,
+        words,
+        args.alphabet,
+        args.density,
+        args.seed,
+        args.targets,
+        args.target_ratio,
+    ):
+        name = p.join(args.output, f"{word}-{target}")
+        with open(name + ".json", "wb") as out:
+            out.write(model.dumps())
+        if cache is not None:
+            model.rec_surf.save(name + ".png", cache)
+        print(name)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+"""Rasterized outlines of the distractors for the preview
+
+Stroking the outlines of hundreds of distractors on every preview is slow,
+while most of them are the same few letters in one font. The atlas rasterizes
+the outline of every string once per font, stroke width and preview scale
+on a page of the atlas, the preview copies the pixels to the positions of the
+distractors. Pages are packed in shelves, rows of glyphs with the height of
+the first glyph. When all pages are full, the least recently used page is
+cleared for new glyphs. All pages are dropped when the memory budget is
+exceeded (see memory).
+"""
+from __future__ import annotations
+
+from collections import OrderedDict
+from dataclasses import dataclass
+import math as m
+
+import cairo
+import gi
+
+gi.require_version("PangoCairo", "1.0")
+gi.require_version("Pango", "1.0")
+from gi.repository import PangoCairo as pc
+from gi.repository import Pango
+
+import memory
+
+PAGE_SIZE = 1024  # pixels
+MAX_PAGES = 4
+STROKE_WIDTH = 2.0  # cairo's default line width, used by RecImage
+
+
+@dataclass
+class Glyph:
+    """Where the outline of a string is in the atlas"""
+
+    page: int
+    x: int  # the pixels of the glyph on the page
+    y: int
+    width: int
+    height: int
+    offset_x: float  # from the logical rectangle to the pixels, in layout units
+    offset_y: float
+    layout_width: float  # the logical size, as measured by Pango
+    layout_height: float
+
+
+class _Page:
+    def __init__(self, size: int):
+        self.surf = cairo.ImageSurface(cairo.FORMAT_ARGB32, size, size)
+        self.shelves: list[list[int]] = []  # y, height, x of the free space
+        self.keys: set[tuple] = set()
+
+    def allocate(self, width: int, height: int) -> tuple[int, int] | None:
+        """Returns the position of a free width x height rectangle"""
+        size = self.surf.get_width()
+        for shelf in self.shelves:
+            y, shelf_height, x = shelf
+            if height <= shelf_height and x + width <= size:
+                shelf[2] += width
+                return x, y
+        y = sum(shelf[1] for shelf in self.shelves)
+        if y + height > size or width > size:
+            return None
+        self.shelves.append([y, height, width])
+        return 0, y
+
+    def clear(self):
+        cr = cairo.Context(self.surf)
+        cr.set_operator(cairo.OPERATOR_CLEAR)
+        cr.paint()
+        self.shelves.clear()
+        self.keys.clear()
+
+
+class GlyphAtlas:
+    """A cache of rasterized distractor outlines on a few pages"""
+
+    def __init__(
+        self, dpi: int, page_size: int = PAGE_SIZE, max_pages: int = MAX_PAGES
+    ):
+        self.dpi = dpi
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.pages: list[_Page] = []
+        self._glyphs: OrderedDict[tuple, Glyph] = OrderedDict()
+        self._layout_surf = cairo.ImageSurface(cairo.FORMAT_ARGB32, 1, 1)
+        self._layout_cr = cairo.Context(self._layout_surf)
+        self._layout = pc.create_layout(self._layout_cr)
+        pc.context_set_resolution(self._layout.get_context(), dpi)
+        memory.budget.register(
+            "glyphs", self.memory_used, self.shrink, main_thread=True
+        )
+
+    def __len__(self) -> int:
+        return len(self._glyphs)
+
+    def memory_used(self) -> int:
+        return sum(
+            page.surf.get_stride() * page.surf.get_height() for page in self.pages
+        )
+
+    def shrink(self, nbytes: int) -> int:
+        """Drops all pages, the glyphs are cheap to rasterize again"""
+        freed = self.memory_used()
+        self.pages.clear()
+        self._glyphs.clear()
+        return freed
+
+    def _page_for(self, width: int, height: int) -> tuple[int, int, int] | None:
+        """Returns the page and position of a free rectangle, the least
+        recently used page is cleared when all pages are full. Returns None
+        when the rectangle is larger than a page.
+        """
+        if width > self.page_size or height > self.page_size:
+            return None
+        for index, page in enumerate(self.pages):
+            position = page.allocate(width, height)
+            if position:
+                return index, *position
+        if len(self.pages) < self.max_pages:
+            # make room before the page is added, shrinking may drop the pages
+            memory.budget.enforce()
+            self.pages.append(_Page(self.page_size))
+            index = len(self.pages) - 1
+        else:
+            # the page of the least recently used glyph
+            index = next(iter(self._glyphs.values())).page
+            page = self.pages[index]
+            for key in page.keys:
+                del self._glyphs[key]
+            page.clear()
+        return index, *self.pages[index].allocate(width, height)
+
+    def glyph(
+        self,
+        string: str,
+        font_desc: Pango.FontDescription,
+        scale: float,
+        stroke_width: float = STROKE_WIDTH,
+    ) -> Glyph | None:
+        """Returns the glyph of string, it is rasterized when it is absent.
+        Returns None when the glyph doesn't fit on a page.
+        """
+        key = string, font_desc.to_string(), stroke_width, scale
+        glyph = self._glyphs.get(key)
+        if glyph is not None:
+            self._glyphs.move_to_end(key)
+            return glyph
+
+        layout = self._layout
+        layout.set_font_description(font_desc)
+        layout.set_text(string)
+        pc.update_layout(self._layout_cr, layout)
+        ink, logical = layout.get_extents()
+        # the stroke extends beyond the ink
+        offset_x = ink.x / Pango.SCALE - stroke_width
+        offset_y = ink.y / Pango.SCALE - stroke_width
+        width = m.ceil((ink.width / Pango.SCALE + 2 * stroke_width) * scale) + 1
+        height = m.ceil((ink.height / Pango.SCALE + 2 * stroke_width) * scale) + 1
+
+        allocation = self._page_for(width, height)
+        if allocation is None:
+            return None
+        index, x, y = allocation
+        page = self.pages[index]
+        cr = cairo.Context(page.surf)
+        cr.rectangle(x, y, width, height)
+        cr.clip()
+        cr.translate(x, y)
+        cr.scale(scale, scale)
+        cr.translate(-offset_x, -offset_y)
+        cr.set_source_rgb(0, 0, 0)
+        cr.set_line_width(stroke_width)
+        pc.layout_path(cr, layout)
+        cr.stroke()
+        page.surf.flush()
+
+        glyph = Glyph(
+            index,
+            x,
+            y,
+            width,
+            height,
+            offset_x,
+            offset_y,
+            logical.width / Pango.SCALE,
+            logical.height / Pango.SCALE,
+        )
+        self._glyphs[key] = glyph
+        page.keys.add(key)
+        return glyph
+
+    def blit(
+        self, cr: cairo.Context, glyph: Glyph, x: float, y: float, scale: float
+    ):
+        """Draws glyph centered around x, y in layout units. The glyph is
+        aligned to the pixels of a device at scale, so it isn't resampled.
+        """
+        left = (x - glyph.layout_width / 2 + glyph.offset_x) * scale
+        top = (y - glyph.layout_height / 2 + glyph.offset_y) * scale
+        cr.save()
+        cr.scale(1 / scale, 1 / scale)
+        cr.translate(round(left), round(top))
+        cr.set_source_surface(self.pages[glyph.page].surf, -glyph.x, -glyph.y)
+        cr.rectangle(0, 0, glyph.width, glyph.height)
+        cr.fill()
+        cr.restore()
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""Compares renders of the reference worksheets with golden images
+
+The reference worksheets of the benchmark are rendered by several paths:
+
+    reference   the recording replayed on one surface, with the full resolution
+                image instead of a level of its pyramid, the plain slow path
+    bands       the banded png export on one thread
+    threads     the banded png export on a pool of threads
+    tiles       the tiles of the preview at the same scale
+    preview     the tiles of the preview recording, which draws the
+                distractors from the glyph atlas
+
+Every path is compared with the golden image of the worksheet, either
+exactly or within a tolerance per channel. The paths that draw the image
+from its pyramid, or the distractors from the glyph atlas, can't match the
+reference exactly, they pass as well when the mean difference of every
+channel is within MEAN_TOLERANCES. Without golden images, e.g. in a fresh
+checkout, the other paths are compared with the reference path of the same
+run instead. When a render differs, it is saved next to an amplified
+difference image, so the change can be seen. `golden.py update` renders new
+golden images with the reference path.
+"""
+from __future__ import annotations
+
+import argparse as ap
+from collections.abc import Callable
+import io
+import math as m
+import os
+import os.path as p
+import sys
+import tempfile
+
+import cairo
+from PIL import Image, ImageChops, ImageStat
+
+import benchmark
+import image
+import imgutils
+import tiles
+from model import Model
+
+GOLDEN_DIR = "golden"
+OUTPUT_DIR = "golden_failures"
+DPI = 75  # renders at 1/4 of the layout resolution keep the images small
+
+# the largest mean difference of a channel of the paths that sample a level of
+# the pyramid, where the reference filters the full resolution image, and of
+# the preview, whose distractors are aligned to the pixels
+MEAN_TOLERANCES = {"bands": 2.0, "threads": 2.0, "tiles": 2.0, "preview": 3.0}
+
+
+def render_reference(rec: image.RecImage) -> Image.Image:
+    """Replays the whole page at once, the image is drawn from level 0 of its
+    pyramid, which any scale beyond the resolution of the image selects.
+    """
+    rec.draw(m.inf)
+    width, height = rec.pars.output_size
+    surf = cairo.ImageSurface(cairo.FORMAT_RGB24, width, height)
+    cr = cairo.Context(surf)
+    scale = rec.pars.dpi / image.DPI
+    cr.scale(scale, scale)
+    cr.set_source_surface(rec.surf)
+    cr.paint()
+    return imgutils.cairoSurfToPilImage(surf)
+
+
+def _render_png(rec: image.RecImage, threads: int) -> Image.Image:
+    png = io.BytesIO()
+    rec.write_png(png, threads=threads)
+    png.seek(0)
+    with Image.open(png) as im:
+        return im.convert("RGB")
+
+
+def render_bands(rec: image.RecImage) -> Image.Image:
+    return _render_png(rec, 1)
+
+
+def render_threads(rec: image.RecImage) -> Image.Image:
+    return _render_png(rec, max(2, image.RENDER_THREADS))
+
+
+def _tile_level(rec: image.RecImage) -> int:
+    """Returns the zoom level of the output resolution"""
+    level = m.log2(rec.pars.dpi / image.DPI)
+    if not level.is_integer():
+        raise ValueError(f"No zoom level has the resolution of {rec.pars.dpi} dpi")
+    return int(level)
+
+
+def render_tiles(rec: image.RecImage) -> Image.Image:
+    """Assembles the tiles of the level of the output resolution"""
+    rec.draw()
+    return _assemble_tiles(rec, _tile_level(rec))
+
+
+def render_preview(rec: image.RecImage) -> Image.Image:
+    """Assembles the tiles of the preview recording, like the widget draws
+    them, at the level of the output resolution
+    """
+    level = _tile_level(rec)
+    rec.draw(2.0**level, preview=True)
+    return _assemble_tiles(rec, level)
+
+
+def _assemble_tiles(rec: image.RecImage, level: int) -> Image.Image:
+    cache = tiles.TileCache(max_bytes=2**62)  # keep all tiles of the page
+    cache.set_source(rec.surf)
+    result = Image.new("RGB", rec.pars.output_size)
+    for column, row in cache.visible(level, 0, 0, rec.width, rec.height):
+        tile = imgutils.cairoSurfToPilImage(cache.tile(level, column, row))
+        result.paste(tile, (column * cache.tile_size, row * cache.tile_size))
+    return result
+
+
+PATHS: dict[str, Callable[[image.RecImage], Image.Image]] = {
+    "reference": render_reference,
+    "bands": render_bands,
+    "threads": render_threads,
+    "tiles": render_tiles,
+    "preview": render_preview,
+}
+
+
+def load(config: str, dpi: int = DPI) -> image.RecImage:
+    model = Model.from_file(config)
+    model.load_font_descs()
+    model.rec_surf.pars.dpi = dpi
+    return model.rec_surf
+
+
+def difference(golden: Image.Image, render: Image.Image) -> int:
+    """Returns the largest difference of a channel, -1 when the sizes differ"""
+    if golden.size != render.size:
+        return -1
+    if golden.tobytes() == render.tobytes():
+        return 0
+    extrema = ImageChops.difference(golden, render).getextrema()
+    return max(high for _, high in extrema)
+
+
+def mean_difference(golden: Image.Image, render: Image.Image) -> float:
+    """Returns the largest mean difference of a channel, -1 when the sizes
+    differ
+    """
+    if golden.size != render.size:
+        return -1
+    return max(ImageStat.Stat(ImageChops.difference(golden, render)).mean)
+
+
+def save_failure(name: str, golden: Image.Image, render: Image.Image, out_dir: str):
+    """Saves the render and its difference with golden, amplified 16 times"""
+    os.makedirs(out_dir, exist_ok=True)
+    render.save(p.join(out_dir, f"{name}.png"))
+    if golden.size == render.size:
+        diff = ImageChops.difference(golden, render).point(lambda v: min(255, v * 16))
+        diff.save(p.join(out_dir, f"{name}-diff.png"))
+
+
+def check(
+    golden_dir: str = GOLDEN_DIR,
+    out_dir: str = OUTPUT_DIR,
+    tolerance: int = 0,
+    paths: list[str] | None = None,
+) -> list[str]:
+    """Renders the reference worksheets with every path, returns the names of
+    the renders that differ more than tolerance from their golden image, or
+    from the reference render when there is no golden image. The paths of
+    MEAN_TOLERANCES may differ more when their mean difference is within it.
+    """
+    failures = []
+    with tempfile.TemporaryDirectory() as directory:
+        for name, config in benchmark.reference_configs(directory).items():
+            fn = p.join(golden_dir, f"{name}.png")
+            if p.exists(fn):
+                with Image.open(fn) as im:
+                    golden = im.convert("RGB")
+                compared = paths or list(PATHS)
+            else:
+                print(
+                    f"{name}: no golden image {fn}, comparing with the reference "
+                    "render of this run (see golden.py update)"
+                )
+                golden = render_reference(load(config))
+                compared = [path for path in paths or PATHS if path != "reference"]
+            for path in compared:
+                render = PATHS[path](load(config))
+                diff = difference(golden, render)
+                mean = mean_difference(golden, render)
+                within_mean = 0 <= mean <= MEAN_TOLERANCES.get(path, -1)
+                status = "ok" if 0 <= diff <= tolerance or within_mean else "FAILED"
+                print(
+                    f"{name} {path}: {status} "
+                    f"(max difference {diff}, mean difference {mean:.2f})"
+                )
+                if status != "ok":
+                    failures.append(f"{name}-{path}")
+                    save_failure(f"{name}-{path}", golden, render, out_dir)
+    return failures
+
+
+def update(golden_dir: str = GOLDEN_DIR):
+    """Renders the golden images with the reference path"""
+    os.makedirs(golden_dir, exist_ok=True)
+    with tempfile.TemporaryDirectory() as directory:
+        for name, config in benchmark.reference_configs(directory).items():
+            fn = p.join(golden_dir, f"{name}.png")
+            render_reference(load(config)).save(fn)
+            print(fn)
+
+
+def main():
+    """Check the renders against the golden images"""
+    parser = ap.ArgumentParser("golden.py", description="compare with golden images")
+    parser.add_argument("-g", "--golden", type=str, default=GOLDEN_DIR)
+    commands = parser.add_subparsers(dest="command", required=True)
+    check_parser = commands.add_parser("check", help="compare the render paths")
+    check_parser.add_argument(
+        "-t",
+        "--tolerance",
+        type=int,
+        default=0,
+        help="the largest allowed difference of a channel, 0 is exact",
+    )
+    check_parser.add_argument(
+        "-p", "--path", action="append", choices=list(PATHS), help="default: all"
+    )
+    check_parser.add_argument("-o", "--output", type=str, default=OUTPUT_DIR)
+    commands.add_parser("update", help="render new golden images")
+
+    args = parser.parse_args()
+    if args.command == "update":
+        update(args.golden)
+        return
+    failures = check(args.golden, args.output, args.tolerance, args.path)
+    if failures:
+        print(f"{len(failures)} renders differ, see {args.output}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
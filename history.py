@@ -0,0 +1,299 @@
+"""Undo and redo of the edits of a model
+
+Every step in the history is an immutable snapshot (State) of the editable
+fields of the model. A new snapshot is derived from the previous one by
+applying the edit that the model reports, the fields that are not edited are
+shared with the previous snapshot. The long lists (distractors and exclusion
+path) are stored in chunks, so an edit only copies the chunk that contains
+the edited item.
+"""
+from __future__ import annotations
+
+from dataclasses import asdict, dataclass, fields, replace
+import itertools
+
+# The fields of a State that the model restores by assignment
+SCALAR_FIELDS = (
+    "word",
+    "font",
+    "distractor_font",
+    "word_x",
+    "word_y",
+    "img_x",
+    "img_y",
+    "img_scale_factor",
+    "show_path",
+    "close_path",
+    "paper",
+    "dpi",
+)
+
+
+class Chunked:
+    """An immutable sequence that shares its storage with the sequences it
+    is derived from.
+    """
+
+    CHUNK_SIZE = 32
+
+    __slots__ = ("_chunks", "_len")
+
+    def __init__(self, chunks: tuple[tuple, ...] = (), length: int = 0):
+        self._chunks = chunks
+        self._len = length
+
+    @classmethod
+    def from_iterable(cls, items) -> Chunked:
+        items = tuple(items)
+        size = cls.CHUNK_SIZE
+        chunks = tuple(items[i : i + size] for i in range(0, len(items), size))
+        return cls(chunks, len(items))
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self._chunks)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Chunked):
+            return NotImplemented
+        if self._chunks is other._chunks:
+            return True
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    def __repr__(self) -> str:
+        return f"Chunked({list(self)})"
+
+    def _locate(self, index: int) -> tuple[int, int]:
+        """Returns the number of the chunk and the index within the chunk"""
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError("Chunked index out of range")
+        for n, chunk in enumerate(self._chunks):
+            if index < len(chunk):
+                return n, index
+            index -= len(chunk)
+
+    def __getitem__(self, index: int):
+        n, i = self._locate(index)
+        return self._chunks[n][i]
+
+    def _replace_chunk(self, n: int, chunk: tuple, length: int) -> Chunked:
+        new = (chunk,) if chunk else ()
+        return Chunked(self._chunks[:n] + new + self._chunks[n + 1 :], length)
+
+    def append(self, item) -> Chunked:
+        if not self._chunks or len(self._chunks[-1]) >= self.CHUNK_SIZE:
+            return Chunked(self._chunks + ((item,),), self._len + 1)
+        n = len(self._chunks) - 1
+        return self._replace_chunk(n, self._chunks[n] + (item,), self._len + 1)
+
+    def set(self, index: int, item) -> Chunked:
+        n, i = self._locate(index)
+        chunk = self._chunks[n]
+        return self._replace_chunk(n, chunk[:i] + (item,) + chunk[i + 1 :], self._len)
+
+    def delete(self, index: int) -> Chunked:
+        n, i = self._locate(index)
+        chunk = self._chunks[n]
+        return self._replace_chunk(n, chunk[:i] + chunk[i + 1 :], self._len - 1)
+
+
+@dataclass(frozen=True)
+class State:
+    """The editable fields of a model at one step in the history
+
+    Distractors are stored as (string, x, y) and path points as (x, y). The
+    decoded source image is shared by reference.
+    """
+
+    path: str
+    img_surf: object
+    word: str
+    font: str
+    distractor_font: str
+    word_x: float
+    word_y: float
+    img_x: float
+    img_y: float
+    img_scale_factor: float
+    show_path: bool
+    close_path: bool
+    paper: tuple[float, float]
+    dpi: int
+    line_art: dict  # of the fields of lineart.LineArtParameters
+    distractors: Chunked
+    exclusion_path: Chunked
+
+    @staticmethod
+    def from_model(model) -> State:
+        return State(
+            path=model.path,
+            img_surf=model.rec_surf.img_surf,
+            word=model.word,
+            font=model.font,
+            distractor_font=model.distractor_font,
+            word_x=model.word_x,
+            word_y=model.word_y,
+            img_x=model.img_x,
+            img_y=model.img_y,
+            img_scale_factor=model.img_scale_factor,
+            show_path=model.show_path,
+            close_path=model.close_path,
+            paper=model.paper,
+            dpi=model.dpi,
+            line_art=asdict(model.line_art),
+            distractors=Chunked.from_iterable(
+                (d.string, d.pos.x, d.pos.y) for d in model.distractors
+            ),
+            exclusion_path=Chunked.from_iterable(
+                (point.x, point.y) for point in model.exclusion_path
+            ),
+        )
+
+    def apply(self, entry: dict) -> State:
+        """Returns the state after the edit, entries are described in autosave"""
+        op = entry["op"]
+        if op == "set":
+            if getattr(self, entry["field"]) == entry["value"]:
+                return self
+            return replace(self, **{entry["field"]: entry["value"]})
+        elif op == "add_distractor":
+            item = entry["string"], entry["x"], entry["y"]
+            return replace(self, distractors=self.distractors.append(item))
+        elif op == "remove_distractor":
+            return replace(self, distractors=self.distractors.delete(entry["index"]))
+        elif op == "remove_distractors":
+            removed = set(entry["indices"])
+            items = (d for i, d in enumerate(self.distractors) if i not in removed)
+            return replace(self, distractors=Chunked.from_iterable(items))
+        elif op == "move_distractor":
+            index = entry["index"]
+            item = self.distractors[index][0], entry["x"], entry["y"]
+            return replace(self, distractors=self.distractors.set(index, item))
+        elif op == "replace_distractors":
+            items = (tuple(d) for d in entry["distractors"])
+            return replace(self, distractors=Chunked.from_iterable(items))
+        elif op == "add_path_point":
+            point = entry["x"], entry["y"]
+            return replace(self, exclusion_path=self.exclusion_path.append(point))
+        elif op == "clear_path":
+            return replace(self, exclusion_path=Chunked())
+        elif op == "replace_path":
+            points = (tuple(point) for point in entry["points"])
+            return replace(self, exclusion_path=Chunked.from_iterable(points))
+        raise ValueError(f"Unknown operation: {op}")
+
+    def changes(self, other: State) -> set[str]:
+        """Returns the names of the fields that differ from other"""
+        return {
+            f.name
+            for f in fields(self)
+            if getattr(self, f.name) is not getattr(other, f.name)
+            and getattr(self, f.name) != getattr(other, f.name)
+        }
+
+
+class History:
+    """Keeps the states of a model, in order to undo and redo edits
+
+    Consecutive edits of the same field or distractor (e.g. dragging a
+    slider or a letter) are merged into one step, until checkpoint() is
+    called.
+    """
+
+    def __init__(self, model, limit: int = 10000):
+        self.model = model
+        self.limit = limit
+        self._undo = [State.from_model(model)]
+        self._redo = []
+        self._last_key = None
+        self._restoring = False
+
+    @property
+    def current(self) -> State:
+        return self._undo[-1]
+
+    @property
+    def can_undo(self) -> bool:
+        return len(self._undo) > 1
+
+    @property
+    def can_redo(self) -> bool:
+        return bool(self._redo)
+
+    def reset(self):
+        """Forget all steps, the current state of the model is the first"""
+        self._undo = [State.from_model(self.model)]
+        self._redo.clear()
+        self._last_key = None
+
+    def checkpoint(self):
+        """The next edit starts a new step"""
+        self._last_key = None
+
+    def changed(self, entry: dict):
+        """Adds the state after an edit of the model to the history"""
+        if self._restoring:
+            return
+        new = self.current.apply(entry)
+        if new is self.current:
+            return
+        if entry["op"] == "set" and entry["field"] == "path":
+            # loading an image also resets its scale and position
+            new = replace(
+                new,
+                img_surf=self.model.rec_surf.img_surf,
+                img_x=self.model.img_x,
+                img_y=self.model.img_y,
+                img_scale_factor=self.model.img_scale_factor,
+            )
+        elif entry["op"] == "set" and entry["field"] == "line_art":
+            # the image is converted again
+            new = replace(new, img_surf=self.model.rec_surf.img_surf)
+
+        if entry["op"] == "set":
+            key = "set", entry["field"]
+        elif entry["op"] == "move_distractor":
+            key = "move_distractor", entry["index"]
+        else:
+            key = None
+
+        if key and key == self._last_key:
+            self._undo[-1] = new
+        else:
+            self._undo.append(new)
+            if len(self._undo) > self.limit:
+                del self._undo[0]
+        self._last_key = key
+        self._redo.clear()
+
+    def _restore(self, old: State, new: State) -> set[str]:
+        """Brings the model from old to new, returns the changed fields"""
+        changes = old.changes(new)
+        self._restoring = True
+        try:
+            self.model.restore(new, changes)
+        finally:
+            self._restoring = False
+        self._last_key = None
+        return changes
+
+    def undo(self) -> set[str]:
+        """Returns the model to the previous state, returns the changed fields"""
+        if not self.can_undo:
+            return set()
+        state = self._undo.pop()
+        self._redo.append(state)
+        return self._restore(state, self.current)
+
+    def redo(self) -> set[str]:
+        """Reapplies the last undone step, returns the changed fields"""
+        if not self.can_redo:
+            return set()
+        state = self._redo.pop()
+        changes = self._restore(self.current, state)
+        self._undo.append(state)
+        return changes
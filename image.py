@@ -1,10 +1,23 @@
 from PIL import Image
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import glyphatlas
 import imgutils
+import io
+import lineart
+import memory
+import mipmap
+import pngwriter
+import profiling
+import os
+import queue
 import cairo
 from dataclasses import dataclass
 import model
 import space
+import events
+import rendercache
 
 import gi
 
@@ -17,20 +30,106 @@ from gi.repository import Pango
 ONE_INCH = 25.4  # mm
 
 A4_WIDTH, A4_HEIGHT = 210, 297
+# width and height in mm
+PAPER_SIZES = {
+    "A5": (148, 210),
+    "A4": (A4_WIDTH, A4_HEIGHT),
+    "A3": (297, 420),
+    "A2": (420, 594),
+    "letter": (215.9, 279.4),
+    "legal": (215.9, 355.6),
+}
+
+# The resolution of the layout, the positions of a worksheet are in pixels at
+# DPI, so they are physical units of 1/300 inch whatever the output resolution.
 DPI = 300
 
+# The size of a band of output rows, so the memory that is needed to rasterize
+# doesn't depend on the size of the output.
+BAND_BYTES = 4 * 1024 * 1024
+
+# The number of threads that rasterize bands, cairo releases the GIL while
+# drawing.
+RENDER_THREADS = os.cpu_count() or 1
+
+DEFAULT_DISTRACTOR_FONT = "sans bold 30"
+
+
+# 16 levels of grey for palette output, as rgb triplets
+GREY_PALETTE = bytes(v for level in range(16) for v in (level * 17,) * 3)
+
+
+@dataclass(frozen=True)
+class PngOptions:
+    """How a png is encoded
+
+    The mode is a PIL mode: "RGB", 8 bit grey "L", 16 grey levels in a palette
+    "P" or bilevel "1". Dithering is used for "P" and "1", which suits photos.
+    level is the zlib compression level.
+    """
+
+    mode: str = "RGB"
+    dither: bool = False
+    level: int = 6
+
+    def __post_init__(self):
+        if self.mode not in ("RGB", "L", "P", "1"):
+            raise ValueError(f"Unsupported png mode: {self.mode}")
+
+    @property
+    def format_name(self) -> str:
+        """The name of the format in the render cache"""
+        if self == PngOptions():
+            return "png"
+        return f"png:{self.mode}:{self.dither:d}:{self.level}"
+
+    def convert(self, band: Image.Image) -> bytes:
+        """Returns the rows of an RGB band in this mode"""
+        if self.mode == "RGB":
+            return band.tobytes()
+        if self.mode == "L":
+            return band.convert("L").tobytes()
+        dither = Image.Dither.FLOYDSTEINBERG if self.dither else Image.Dither.NONE
+        if self.mode == "1":
+            return band.convert("L").convert("1", dither=dither).tobytes()
+        return band.quantize(palette=_grey_palette_image(), dither=dither).tobytes()
+
+
+_palette_image = None
+
+
+def _grey_palette_image() -> Image.Image:
+    global _palette_image
+    if _palette_image is None:
+        _palette_image = Image.new("P", (1, 1))
+        _palette_image.putpalette(GREY_PALETTE)
+    return _palette_image
+
 
 def image_ppi(size_mm: float, dpi: int):
     # calculate the number of pixels per inch
     return round(size_mm / ONE_INCH * dpi)
 
 
+# The kind of change that is emitted when a parameter is set
+_PARAMETER_EVENTS = {
+    "surf_tr_x": events.IMAGE_TRANSFORM,
+    "surf_tr_y": events.IMAGE_TRANSFORM,
+    "_surf_scale": events.IMAGE_TRANSFORM,
+    "word_tr_x": events.WORD,
+    "word_tr_y": events.WORD,
+    "paper": events.PAPER,
+    "dpi": events.PAPER,
+}
+
+
 @dataclass
-class ImageParameters:
+class ImageParameters(events.Observable):
     """Class for storing parameter for an image that are toggleable
     from the GUI"""
 
-    size: tuple[int, int] = image_ppi(A4_WIDTH, DPI), image_ppi(A4_HEIGHT, DPI)
+    paper: tuple[float, float] = A4_WIDTH, A4_HEIGHT  # mm
+    dpi: int = DPI  # the resolution of the output
 
     surf_tr_x: float = 0
     surf_tr_y: float = 0
@@ -45,6 +144,22 @@ class ImageParameters:
     word_tr_y: float = 0.0
     word_tr_x: float = 0.0
 
+    def __setattr__(self, name: str, value):
+        super().__setattr__(name, value)
+        kind = _PARAMETER_EVENTS.get(name)
+        if kind:
+            self.emit(events.Change(kind))
+
+    @property
+    def size(self) -> tuple[int, int]:
+        """The size of the paper in pixels of the layout"""
+        return image_ppi(self.paper[0], DPI), image_ppi(self.paper[1], DPI)
+
+    @property
+    def output_size(self) -> tuple[int, int]:
+        """The size of the paper in pixels at the output resolution"""
+        return image_ppi(self.paper[0], self.dpi), image_ppi(self.paper[1], self.dpi)
+
     @property
     def width(self):
         return self.size[0]
@@ -92,6 +207,35 @@ class ImageParameters:
         self.surf_tr_y = (self.height - self.surf_scaled_height) / 2.0
 
 
+class TextMeasure:
+    """Measures the size of text in one font at DPI, just like the distractors
+    are measured when they are drawn. The sizes are cached per text.
+    """
+
+    def __init__(self, font_desc: Pango.FontDescription | None = None):
+        if not font_desc:
+            font_desc = Pango.font_description_from_string(DEFAULT_DISTRACTOR_FONT)
+        self._surf = cairo.ImageSurface(cairo.FORMAT_ARGB32, 1, 1)
+        cr = cairo.Context(self._surf)
+        self._layout = pc.create_layout(cr)
+        pc.context_set_resolution(self._layout.get_context(), DPI)
+        self._layout.set_font_description(font_desc)
+        pc.update_layout(cr, self._layout)
+        self._sizes = {}
+
+    def size(self, text: str) -> tuple[float, float]:
+        """Returns the width and height of text"""
+        if text not in self._sizes:
+            self._layout.set_text(text)
+            width, height = self._layout.get_size()
+            self._sizes[text] = width / Pango.SCALE, height / Pango.SCALE
+        return self._sizes[text]
+
+
+# the outlines of the distractors of the previews
+glyph_atlas = glyphatlas.GlyphAtlas(DPI)
+
+
 class RecImage:
     """An image that records the operations done to it.
     you can use it's operations in order to draw on another
@@ -101,8 +245,10 @@ class RecImage:
     model: model.Model
     surf: cairo.RecordingSurface | None
     img_surf: cairo.ImageSurface | None
+    drawn_scale: float  # the scale for which the recording was made
     fn: str
     pars: ImageParameters
+    line_art: lineart.LineArtParameters  # applied to the image
     font_desc: Pango.FontDescription | None
     distractors: list[str]
 
@@ -116,12 +262,22 @@ class RecImage:
         self.model = model
         self.surf = None
         self.img_surf = None
+        self.drawn_scale = 1.0
         self.pars = ImageParameters()
+        self.line_art = lineart.LineArtParameters()
         self.font_desc = font_desc
+        self._owns_image = False  # img_surf may be shared with other models
+        memory.budget.register("image", self.memory_used)
 
         self.fn = fn
         self.word = word
 
+    def memory_used(self) -> int:
+        """Returns the bytes of img_surf when it was decoded for this image"""
+        if not self._owns_image or not self.img_surf:
+            return 0
+        return self.img_surf.get_stride() * self.img_surf.get_height()
+
     @property
     def fn(self) -> str:
         return self._fn
@@ -134,6 +290,48 @@ class RecImage:
         else:
             self.img_surf = None
 
+    @property
+    def img_surf(self) -> cairo.ImageSurface | None:
+        return self._img_surf
+
+    @img_surf.setter
+    def img_surf(self, surf: cairo.ImageSurface | None):
+        self._img_surf = surf
+        self._pyramid = None
+
+    @property
+    def pyramid(self) -> mipmap.MipPyramid | None:
+        """The pyramid of img_surf, it is made on first use"""
+        if self._pyramid is None and self.img_surf:
+            self._pyramid = mipmap.MipPyramid(self.img_surf)
+        return self._pyramid
+
+    def image_level(self, scale: float) -> int:
+        """Returns the level of the pyramid that is drawn for a recording that
+        is shown at scale
+        """
+        if not self.img_surf:
+            return 0
+        return self.pyramid.level_for_scale(self.pars.surf_scale * scale)
+
+    def set_image(
+        self,
+        fn: str,
+        img_surf: cairo.ImageSurface | None,
+        pyramid: mipmap.MipPyramid | None = None,
+    ):
+        """Use img_surf, that was decoded from fn before, as image. The
+        pyramid of img_surf may be shared as well.
+        """
+        self._fn = fn
+        self.img_surf = img_surf
+        self._owns_image = False
+        self._pyramid = pyramid
+        if img_surf:
+            self.pars.surf_width = img_surf.get_width()
+            self.pars.surf_height = img_surf.get_height()
+            self.pars.estimate_image_pars()
+
     @property
     def width(self):
         return self.pars.size[0]
@@ -142,11 +340,23 @@ class RecImage:
     def height(self):
         return self.pars.size[1]
 
-    def draw(self):
-        """Draw the image"""
+    @profiling.timed("image.draw")
+    def draw(self, scale: float = 0.0, preview: bool = False):
+        """Draw the image
+
+        scale is the number of device pixels per pixel of the layout at which
+        the drawing will be shown, it determines the level of the pyramid of
+        the image that is used. By default it is the scale of the output dpi.
+        A preview draws the distractors from the glyph atlas, at scale.
+        """
+        self.drawn_scale = scale or self.pars.dpi / DPI
+        self.surf = self._record(preview)
+
+    def _record(self, preview: bool = False) -> cairo.RecordingSurface:
+        """Returns a new recording of the drawing at drawn_scale"""
         rect = cairo.Rectangle(0, 0, self.pars.width, self.pars.height)
-        self.surf = cairo.RecordingSurface(cairo.CONTENT_COLOR, rect)
-        cr = cairo.Context(self.surf)
+        surf = cairo.RecordingSurface(cairo.CONTENT_COLOR, rect)
+        cr = cairo.Context(surf)
         cr.set_source_rgb(1, 1, 1)
         cr.paint()
 
@@ -160,17 +370,30 @@ class RecImage:
             self._drawWord(cr)
 
         if self.model.distractors:
-            self._draw_distractors(cr)
+            if preview:
+                self._blit_distractors(cr)
+            else:
+                self._draw_distractors(cr)
 
         if self.model.show_path and self.model.exclusion_path:
             self._draw_exclusion_path(cr, self.model.exclusion_path)
+        del cr
+        return surf
 
+    @profiling.timed("image.draw_image")
     def _drawImage(self, cr: cairo.Context):
         cr.save()
 
-        pattern = cairo.SurfacePattern(self.img_surf)
+        # the pixels of a level are larger than the pixels of the image
+        surf = self.pyramid.level(self.image_level(self.drawn_scale))
+        level_x = self.img_surf.get_width() / surf.get_width()
+        level_y = self.img_surf.get_height() / surf.get_height()
+
+        pattern = cairo.SurfacePattern(surf)
         mat = cairo.Matrix()
-        mat.scale(1 / self.pars.surf_scale, 1 / self.pars.surf_scale)
+        mat.scale(
+            1 / (self.pars.surf_scale * level_x), 1 / (self.pars.surf_scale * level_y)
+        )
         mat.translate(-self.pars.surf_tr_x, -self.pars.surf_tr_y)
         pattern.set_matrix(mat)
 
@@ -181,6 +404,7 @@ class RecImage:
         cr.fill()
         cr.restore()
 
+    @profiling.timed("image.draw_word")
     def _drawWord(self, cr):
         """Draws the word onto the surface"""
 
@@ -220,6 +444,7 @@ class RecImage:
 
         cr.restore()
 
+    @profiling.timed("image.draw_distractors")
     def _draw_distractors(self, cr):
         """Draw the distractors"""
         cr.save()
@@ -227,36 +452,67 @@ class RecImage:
 
         # Update using DPI, so we get the ~same size when drawing for
         # dpi 96 (default,pc) or dpi 300 (printing default)
-        font_desc = self.model.distractor_font_description
-        if not font_desc:
-            font_desc = Pango.font_description_from_string("sans bold 30")
+        layout = self._distractor_layout(cr)
+        for d in self.model.distractors:
+            self._stroke_distractor(cr, layout, d)
 
+        cr.restore()
+
+    def _distractor_layout(self, cr: cairo.Context) -> Pango.Layout:
         layout = pc.create_layout(cr)
         pc.context_set_resolution(layout.get_context(), DPI)
-
-        layout.set_font_description(font_desc)
-        width, height = layout.get_size()
-
+        layout.set_font_description(self._distractor_font())
         pc.update_layout(cr, layout)
+        return layout
 
-        for d in self.model.distractors:
-            cr.save()
+    def _stroke_distractor(self, cr: cairo.Context, layout: Pango.Layout, d):
+        """Strokes the outline of d centered around its position"""
+        cr.save()
 
-            layout.set_text(d.string)
-            width, height = layout.get_size()
-            width, height = width / Pango.SCALE, height / Pango.SCALE
+        layout.set_text(d.string)
+        width, height = layout.get_size()
+        width, height = width / Pango.SCALE, height / Pango.SCALE
 
-            cr.translate(-width / 2, -height / 2)
-            cr.translate(d.pos.x, d.pos.y)
+        self.model.set_distractor_size(d, width, height)
 
-            pc.layout_path(cr, layout)
+        cr.translate(-width / 2, -height / 2)
+        cr.translate(d.pos.x, d.pos.y)
 
-            cr.stroke()
+        pc.layout_path(cr, layout)
 
-            cr.restore()
+        cr.stroke()
 
         cr.restore()
 
+    def _distractor_font(self) -> Pango.FontDescription:
+        font_desc = self.model.distractor_font_description
+        if not font_desc:
+            font_desc = Pango.font_description_from_string(DEFAULT_DISTRACTOR_FONT)
+        return font_desc
+
+    @profiling.timed("image.blit_distractors")
+    def _blit_distractors(self, cr: cairo.Context):
+        """Draw the distractors from their rasterized outlines, the
+        vectors are only stroked for the export and for outlines that are
+        larger than a page of the atlas.
+        """
+        font_desc = self._distractor_font()
+        layout = None
+        for d in self.model.distractors:
+            glyph = glyph_atlas.glyph(d.string, font_desc, self.drawn_scale)
+            if glyph is None:
+                if layout is None:
+                    cr.save()
+                    cr.set_source_rgb(0, 0, 0)
+                    layout = self._distractor_layout(cr)
+                self._stroke_distractor(cr, layout, d)
+                continue
+            self.model.set_distractor_size(d, glyph.layout_width, glyph.layout_height)
+            glyph_atlas.blit(cr, glyph, d.pos.x, d.pos.y, self.drawn_scale)
+        if layout is not None:
+            cr.restore()
+
+    @profiling.timed("image.draw_exclusion_path")
     def _draw_exclusion_path(self, cr: cairo.Context, path: list[space.Point2D]):
         cr.save()
 
@@ -290,18 +546,205 @@ class RecImage:
         cr.close_path()
         return cr.in_fill(point.x, point.y)
 
+    def _convert(self, fn: str) -> cairo.ImageSurface:
+        """Returns the image in fn after the line art conversion"""
+        inpic = lineart.pipeline.process(fn, self.line_art)
+        if inpic.mode not in ["RGBA", "RGB"]:
+            inpic = inpic.convert("RGB")
+        return imgutils.pilImageToCairoSurf(inpic, cairo.FORMAT_RGB24)
+
+    @profiling.timed("image.cache_surf")
     def _cacheSurf(self, fn: str):
         """Caches the image as a Cairo.ImageSurface"""
-        with Image.open(fn) as inpic:
-            if inpic.mode not in ["RGBA", "RGB"]:
-                inpic = inpic.convert("RGB")
-
-            self.img_surf = imgutils.pilImageToCairoSurf(inpic, cairo.FORMAT_RGB24)
-            self.pars.surf_width = self.img_surf.get_width()
-            self.pars.surf_height = self.img_surf.get_height()
+        self.img_surf = self._convert(fn)
+        self._owns_image = True
+        memory.budget.enforce()
+        self.pars.surf_width = self.img_surf.get_width()
+        self.pars.surf_height = self.img_surf.get_height()
 
-            self.pars.estimate_image_pars()  # update new default values
+        self.pars.estimate_image_pars()  # update new default values
 
-    def save(self, fn="rec_image.png"):
+    def set_line_art(self, line_art: lineart.LineArtParameters):
+        """Converts the image again, its size and placement don't change"""
+        self.line_art = line_art
+        if self.fn:
+            self.img_surf = self._convert(self.fn)
+            self._owns_image = True
+            memory.budget.enforce()
+
+    @profiling.timed("image.render_band")
+    def render_band(
+        self, y: int, height: int, source: cairo.RecordingSurface | None = None
+    ) -> cairo.ImageSurface:
+        """Rasterizes the rows y up to y + height of the output, by replaying
+        the recording (or source, another recording of the same drawing)
+        scaled to the output resolution and clipped to the band.
+        """
+        width = self.pars.output_size[0]
+        scale = self.pars.dpi / DPI
+        band = cairo.ImageSurface(cairo.FORMAT_RGB24, width, height)
+        cr = cairo.Context(band)
+        cr.rectangle(0, 0, width, height)
+        cr.clip()
+        cr.translate(0, -y)
+        cr.scale(scale, scale)
+        cr.set_source_surface(source or self.surf)
+        cr.paint()
+        return band
+
+    def band_rows(self) -> list[tuple[int, int]]:
+        """Returns the first row and the height of the bands of the output,
+        a band takes at most BAND_BYTES.
+        """
+        width, height = self.pars.output_size
+        stride = cairo.FORMAT_RGB24.stride_for_width(width)
+        band_height = max(1, BAND_BYTES // stride)
+        rows = range(0, height, band_height)
+        return [(y, min(band_height, height - y)) for y in rows]
+
+    def bands(self):
+        """Yields the output in bands of rows"""
+        for y, height in self.band_rows():
+            yield self.render_band(y, height)
+
+    @profiling.timed("image.encode_band")
+    def _encode_band(
+        self, y: int, height: int, options: PngOptions, sources: queue.SimpleQueue
+    ) -> bytes:
+        # a recording is replayed by one thread at a time
+        source = sources.get()
+        try:
+            band = self.render_band(y, height, source)
+        finally:
+            sources.put(source)
+        return options.convert(imgutils.cairoSurfToPilImage(band))
+
+    @profiling.timed("image.write_png")
+    def write_png(self, out, threads: int = 0, options: PngOptions = PngOptions()):
+        """Draws and writes the png to the binary file out band by band
+
+        The bands are rasterized by threads threads, RENDER_THREADS by default.
+        Every band is drawn the same on any thread, so the output doesn't
+        depend on the number of threads. At most two bands per thread are kept
+        in memory. Dithering starts anew in every band.
+
+        Replaying a recording isn't thread safe, cairo builds its index of the
+        commands on the first replay, so every thread replays a recording of
+        its own. The recordings share the pixels of the image, which are only
+        read.
+        """
         self.draw()
-        self.surf.write_to_png(fn)
+        threads = threads or RENDER_THREADS
+        sources = queue.SimpleQueue()
+        sources.put(self.surf)
+        for _ in range(threads - 1):
+            sources.put(self._record())
+        writer = pngwriter.PngWriter(
+            out,
+            *self.pars.output_size,
+            mode=options.mode,
+            level=options.level,
+            palette=GREY_PALETTE,
+            dpi=self.pars.dpi,
+        )
+        rows = self.band_rows()
+        band_bytes = cairo.FORMAT_RGB24.stride_for_width(self.pars.output_size[0])
+        band_bytes *= max((height for _, height in rows), default=0)
+        window = 1 if threads == 1 else 2 * threads
+        with memory.budget.allocation("export", window * band_bytes):
+            if threads == 1:
+                for y, height in rows:
+                    writer.write_rows(self._encode_band(y, height, options, sources))
+            else:
+                with ThreadPoolExecutor(threads) as pool:
+                    pending = deque()
+                    for y, height in rows:
+                        pending.append(
+                            pool.submit(self._encode_band, y, height, options, sources)
+                        )
+                        if len(pending) >= 2 * threads:
+                            writer.write_rows(pending.popleft().result())
+                    while pending:
+                        writer.write_rows(pending.popleft().result())
+        writer.close()
+
+    def render_png(
+        self,
+        cache: rendercache.RenderCache | None = None,
+        options: PngOptions = PngOptions(),
+    ) -> bytes:
+        """Returns the drawing as png, a render in the cache is returned without
+        drawing when the model hasn't changed.
+        """
+        if cache is not None:
+            key = rendercache.render_key(self.model, options.format_name, self.pars.dpi)
+            data = cache.get(key)
+            if data is not None:
+                return data
+
+        png = io.BytesIO()
+        self.write_png(png, options=options)
+        data = png.getvalue()
+
+        if cache is not None:
+            cache.put(key, data)
+        return data
+
+    @profiling.timed("image.render_pdf")
+    def render_pdf(self, cache: rendercache.RenderCache | None = None) -> bytes:
+        """Returns the drawing as a pdf page of the size of the paper"""
+        if cache is not None:
+            key = rendercache.render_key(self.model, "pdf", DPI)
+            data = cache.get(key)
+            if data is not None:
+                return data
+
+        self.draw(1.0)  # the resolution of the layout
+        pdf = io.BytesIO()
+        points_per_pixel = 72 / DPI
+        pdf_surf = cairo.PDFSurface(
+            pdf, self.width * points_per_pixel, self.height * points_per_pixel
+        )
+        cr = cairo.Context(pdf_surf)
+        cr.scale(points_per_pixel, points_per_pixel)
+        cr.set_source_surface(self.surf)
+        cr.paint()
+        pdf_surf.finish()
+        data = pdf.getvalue()
+
+        if cache is not None:
+            cache.put(key, data)
+        return data
+
+    def save(
+        self,
+        fn="rec_image.png",
+        cache: rendercache.RenderCache | None = None,
+        options: PngOptions = PngOptions(),
+    ):
+        with open(fn, "wb") as out:
+            if cache is None:
+                self.write_png(out, options=options)
+            else:
+                out.write(self.render_png(cache, options))
+
+    def thumbnail(self, width: int = 150) -> bytes:
+        """Returns a small png of the drawing that is width pixels wide"""
+        if not self.surf:
+            self.draw()
+        scale = width / self.width
+        thumb = cairo.ImageSurface(
+            cairo.FORMAT_RGB24, width, max(1, round(self.height * scale))
+        )
+        cr = cairo.Context(thumb)
+        pattern = cairo.SurfacePattern(self.surf)
+        pattern.set_filter(cairo.FILTER_GOOD)
+        mat = cairo.Matrix()
+        mat.scale(1 / scale, 1 / scale)
+        pattern.set_matrix(mat)
+        cr.set_source(pattern)
+        cr.paint()
+
+        png = io.BytesIO()
+        thumb.write_to_png(png)
+        return png.getvalue()
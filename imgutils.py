@@ -3,68 +3,89 @@
 from PIL import Image
 from PIL.ImageFile import ImageFile
 import cairo as c
+import netpbm
+import profiling
+import sys
 import typing
 
-PBGen = typing.Generator[bytes, Image.Image, None]
+# the raw packer of PIL that yields the bytes of an RGB24 pixel of cairo
+_CAIRO_RGB24 = "BGRX" if sys.byteorder == "little" else "XRGB"
 
 
-def _genCairoBytesFromPilRGB(img: Image):
-    """Generate byte sequence in cairo image ordering
+@profiling.timed("imgutils.pil_to_cairo")
+def pilImageToCairoSurf(img: ImageFile, f: c.Format) -> c.ImageSurface:
+    """Turn a pillow Image into a Cairo.Surface, PIL packs the pixels. An
+    ARGB32 surface gets the premultiplied alpha of the image, RGB24 ignores it.
+    """
+    if f == c.FORMAT_ARGB32:
+        img = img.convert("RGBa")
+        if sys.byteorder == "little":
+            data = img.tobytes("raw", "BGRa")
+        else:
+            r, g, b, a = img.split()
+            data = Image.merge("RGBA", (a, r, g, b)).tobytes()
+    else:
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        data = img.tobytes("raw", _CAIRO_RGB24)
+    return c.ImageSurface.create_for_data(
+        bytearray(data), f, img.width, img.height, f.stride_for_width(img.width)
+    )
 
-    PIL's RGB is a format of 3 bytes([R, G, B]) per pixel,
-    cairo's RGB is a 4 bytes quantity bytes ([unused, R, G, B])
 
-    So for every 3 bytes of PIL's RGB image, four bytes of cairo's pixels are
-    yielded from the output.
+def cairoSurfToPilImage(surf: c.ImageSurface) -> Image.Image:
+    """Turn an RGB24 or ARGB32 Cairo.ImageSurface into an RGB pillow Image, the
+    pixels are read directly from the data of the surface.
     """
-    imgbytes = img.tobytes()
-    unusedbyte = bytes([0])  # put a 0 on the unused byte value
-    for i in range(0, len(imgbytes), 3):
-        yield imgbytes[i + 2]
-        yield imgbytes[i + 1]
-        yield imgbytes[i + 0]
-        yield unusedbyte[0]
-
+    surf.flush()
+    return Image.frombuffer(
+        "RGB",
+        (surf.get_width(), surf.get_height()),
+        surf.get_data(),
+        "raw",
+        _CAIRO_RGB24,
+        surf.get_stride(),
+        1,
+    )
 
-def _genCairoBytesFromPilRGBA(img: Image):
-    """Generate byte sequence in cairo image ordering
 
-    PIL's RGBA is a format of 4 bytes([R, G, B, A]) per pixel,
-    cairo's ARGB32 is a 4 bytes quantity bytes ([A, R, G, B])
+def fileToCairoSurf(file: str | typing.BinaryIO, f: c.Format) -> c.ImageSurface:
+    """Decodes any image that PIL can read, from a path or a binary stream,
+    into a surface.
     """
-    imgbytes = img.tobytes()
-    for i in range(0, len(imgbytes), 4):
-        yield imgbytes[i + 2]
-        yield imgbytes[i + 1]
-        yield imgbytes[i + 0]
-        yield imgbytes[i + 3]
-
-
-def _convertToSurf(img: Image, Format: c.Format, gen_func: PBGen) -> c.ImageSurface:
-    """Converts an PIL.Image to a surface."""
-    imgbytes = bytearray(gen_func(img))
-    surf = c.ImageSurface.create_for_data(
-        imgbytes,
-        Format,
-        img.width,
-        img.height,
-        Format.stride_for_width(img.width),
-    )
-    return surf
+    with Image.open(file) as img:
+        if img.mode not in ["RGB", "RGBA"]:
+            img = img.convert("RGB")
+        return pilImageToCairoSurf(img, f)
 
 
-def pilImageToCairoSurf(img: ImageFile, f: c.Format) -> c.ImageSurface:
-    """Turn a pillow Image into a Cairo.Surface"""
-    mode = img.mode
+def cairoSurfToPam(surf: c.ImageSurface, out: typing.BinaryIO):
+    """Writes the pixels of an RGB24 or ARGB32 surface as an uncompressed pam,
+    see netpbm.write_pam. The unused byte of an RGB24 surface is set to 255
+    in place, so it reads as opaque.
+    """
+    surf.flush()
+    opaque = surf.get_format() == c.FORMAT_RGB24
+    netpbm.write_pam(
+        surf.get_data(),
+        surf.get_width(),
+        surf.get_height(),
+        surf.get_stride(),
+        out,
+        opaque,
+    )
+    if opaque:
+        surf.mark_dirty()
 
-    # Currently we only handle these images directly
-    if mode not in ["RGB", "RGBA"]:
-        img = img.convert("RGB")
 
-    if mode == "RGB":
-        return _convertToSurf(img, f, _genCairoBytesFromPilRGB)
-    else:
-        return _convertToSurf(img, f, _genCairoBytesFromPilRGBA)
+def cairoSurfToPpm(surf: c.ImageSurface, out: typing.BinaryIO):
+    """Writes an RGB24 or ARGB32 surface as an uncompressed binary ppm, the
+    4 byte pixels are packed into RGB triplets.
+    """
+    surf.flush()
+    netpbm.write_ppm(
+        surf.get_data(), surf.get_width(), surf.get_height(), surf.get_stride(), out
+    )
 
 
 if __name__ == "__main__":
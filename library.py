@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""An index of the worksheets on disk
+
+The configs of the worksheets are summarized in a SQLite database together
+with a small thumbnail of the drawing. Browsing and searching the library
+only needs the database, the configs and their source images are only read
+when a worksheet is added or changed.
+"""
+from __future__ import annotations
+
+import argparse as ap
+from dataclasses import dataclass
+import hashlib
+import json
+import logging
+import os
+import os.path as p
+import sqlite3
+import threading
+from collections.abc import Callable
+
+import binformat
+
+LIBRARY_NAME = "library.sqlite"
+THUMBNAIL_WIDTH = 150
+CONFIG_EXTENSIONS = (".json", binformat.EXTENSION)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS worksheets (
+    config TEXT PRIMARY KEY,
+    word TEXT NOT NULL,
+    image_path TEXT NOT NULL,
+    n_distractors INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    content_hash TEXT NOT NULL,
+    thumbnail BLOB,
+    thumbnail_hash TEXT
+)
+"""
+
+
+@dataclass
+class Entry:
+    """A worksheet in the library"""
+
+    config: str
+    word: str
+    image_path: str
+    n_distractors: int
+    mtime: float
+    thumbnail: bytes | None
+
+
+def summarize(data: bytes) -> tuple[str, str, int]:
+    """Returns the word, image path and number of distractors of a config
+    without creating the model.
+    """
+    if binformat.is_worksheet(data):
+        with binformat.loads(data) as sheet:
+            return sheet.word, sheet.path, len(sheet.distractor_string_ids)
+    d = json.loads(data)
+    distractors = d["distractors"]
+    if isinstance(distractors, dict):  # a columnar list
+        n_distractors = len(distractors["string"])
+    else:
+        n_distractors = len(distractors)
+    return d["word"], d["path"], n_distractors
+
+
+def render_thumbnail(config: str, width: int = THUMBNAIL_WIDTH) -> bytes:
+    """Returns the png thumbnail of a config"""
+    # the model needs GTK, browsing the library doesn't
+    from model import Model
+
+    return Model.from_file(config).rec_surf.thumbnail(width)
+
+
+class Library:
+    """The SQLite index of the worksheets
+
+    A Library may only be used from the thread that opened it.
+    """
+
+    def __init__(self, fn: str = LIBRARY_NAME):
+        self.fn = fn
+        self._db = sqlite3.connect(fn)
+        self._db.execute(_SCHEMA)
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+    def add(self, config: str) -> bool:
+        """Adds or updates a config, returns False if it isn't a worksheet
+
+        The config is only read when its modification time has changed.
+        """
+        config = p.abspath(config)
+        mtime = p.getmtime(config)
+        row = self._db.execute(
+            "SELECT mtime, content_hash FROM worksheets WHERE config = ?", (config,)
+        ).fetchone()
+        if row and row[0] == mtime:
+            return True
+
+        with open(config, "rb") as content:
+            data = content.read()
+        try:
+            word, image_path, n_distractors = summarize(data)
+        except (ValueError, KeyError, TypeError) as e:
+            logging.info(f"{config} is not a worksheet: {e}")
+            return False
+
+        content_hash = hashlib.sha1(data).hexdigest()
+        if row:
+            self._db.execute(
+                "UPDATE worksheets SET word = ?, image_path = ?, n_distractors = ?, "
+                "mtime = ?, content_hash = ? WHERE config = ?",
+                (word, image_path, n_distractors, mtime, content_hash, config),
+            )
+        else:
+            self._db.execute(
+                "INSERT INTO worksheets "
+                "(config, word, image_path, n_distractors, mtime, content_hash) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (config, word, image_path, n_distractors, mtime, content_hash),
+            )
+        self._db.commit()
+        return True
+
+    def remove(self, config: str):
+        config = p.abspath(config)
+        self._db.execute("DELETE FROM worksheets WHERE config = ?", (config,))
+        self._db.commit()
+
+    def scan(self, directory: str) -> int:
+        """Adds the worksheets in directory and its subdirectories and removes
+        the ones that no longer exist, returns the number of worksheets.
+        """
+        directory = p.abspath(directory)
+        found = set()
+        for root, _, files in os.walk(directory):
+            for name in files:
+                if name.endswith(CONFIG_EXTENSIONS):
+                    config = p.join(root, name)
+                    if self.add(config):
+                        found.add(config)
+
+        # not LIKE, _ and % may be part of the name of a directory
+        prefix = p.join(directory, "")
+        rows = self._db.execute(
+            "SELECT config FROM worksheets WHERE substr(config, 1, ?) = ?",
+            (len(prefix), prefix),
+        ).fetchall()
+        for (config,) in rows:
+            if config not in found and not p.exists(config):
+                self._db.execute("DELETE FROM worksheets WHERE config = ?", (config,))
+        self._db.commit()
+        return len(found)
+
+    def search(self, text: str = "") -> list[Entry]:
+        """Returns the worksheets whose word, config or image matches text,
+        the most recently modified first.
+        """
+        pattern = f"%{text}%"
+        rows = self._db.execute(
+            "SELECT config, word, image_path, n_distractors, mtime, thumbnail "
+            "FROM worksheets WHERE word LIKE ? OR config LIKE ? OR image_path LIKE ? "
+            "ORDER BY mtime DESC",
+            (pattern, pattern, pattern),
+        )
+        return [Entry(*row) for row in rows]
+
+    def stale_thumbnails(self) -> list[tuple[str, str]]:
+        """Returns the configs and content hashes of the worksheets whose
+        thumbnail doesn't match their content.
+        """
+        return self._db.execute(
+            "SELECT config, content_hash FROM worksheets "
+            "WHERE thumbnail_hash IS NULL OR thumbnail_hash != content_hash"
+        ).fetchall()
+
+    def set_thumbnail(self, config: str, content_hash: str, thumbnail: bytes):
+        self._db.execute(
+            "UPDATE worksheets SET thumbnail = ?, thumbnail_hash = ? WHERE config = ?",
+            (thumbnail, content_hash, config),
+        )
+        self._db.commit()
+
+    def update_thumbnails(self) -> int:
+        """Renders the stale thumbnails, returns the number of rendered ones"""
+        rendered = 0
+        for config, content_hash in self.stale_thumbnails():
+            try:
+                thumbnail = render_thumbnail(config)
+            except Exception as e:  # a broken config shouldn't stop the others
+                logging.warning(f"Unable to render a thumbnail of {config}: {e}")
+                continue
+            self.set_thumbnail(config, content_hash, thumbnail)
+            rendered += 1
+        return rendered
+
+
+def update_thumbnails_in_background(
+    fn: str = LIBRARY_NAME,
+    on_done: Callable[[int], None] | None = None,
+    directory: str = "",
+    on_scanned: Callable[[int], None] | None = None,
+) -> threading.Thread:
+    """Renders the stale thumbnails of the library in fn on another thread,
+    on_done is called with the number of rendered thumbnails. When directory
+    is given it is scanned first, on_scanned is called with the number of
+    worksheets it contains.
+    """
+
+    def run():
+        library = Library(fn)
+        try:
+            if directory:
+                found = library.scan(directory)
+                if on_scanned:
+                    on_scanned(found)
+            rendered = library.update_thumbnails()
+        finally:
+            library.close()
+        if on_done:
+            on_done(rendered)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+def main():
+    """Maintain the library of worksheets"""
+    parser = ap.ArgumentParser("library.py", description="index worksheets")
+    parser.add_argument(
+        "-l", "--library", type=str, default=LIBRARY_NAME, help="the database"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    scan = commands.add_parser("scan", help="add the worksheets in a directory")
+    scan.add_argument("directory", type=str, nargs="?", default=".")
+    search = commands.add_parser("search", help="list the matching worksheets")
+    search.add_argument("text", type=str, nargs="?", default="")
+    commands.add_parser("thumbnails", help="render the stale thumbnails")
+
+    args = parser.parse_args()
+    library = Library(args.library)
+    if args.command == "scan":
+        print(f"{library.scan(args.directory)} worksheets")
+    elif args.command == "search":
+        for entry in library.search(args.text):
+            print(f"{entry.word}\t{entry.n_distractors}\t{entry.config}")
+    else:
+        print(f"rendered {library.update_thumbnails()} thumbnails")
+    library.close()
+
+
+if __name__ == "__main__":
+    main()
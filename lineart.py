@@ -0,0 +1,200 @@
+"""Turns photos into line art that can be traced or colored
+
+The conversion is a pipeline of stages: decode, greyscale, contrast, edges,
+threshold and lighten. Every stage works on whole images with the operations
+of PIL. The result of every stage is cached by the hash of the image and the
+parameters of that stage and the stages before it. Hence, changing e.g. the
+threshold only reruns the threshold and lighten stages.
+"""
+from __future__ import annotations
+
+from collections import OrderedDict
+from collections.abc import Callable
+from dataclasses import dataclass
+import threading
+
+from PIL import Image, ImageChops, ImageEnhance, ImageFilter, ImageOps
+
+import memory
+import profiling
+import rendercache
+
+MAX_BYTES = 256 * 1024 * 1024
+EDGE_DETECTORS = ("", "sobel", "dog")
+
+
+@dataclass(frozen=True)
+class LineArtParameters:
+    """The parameters of the stages, the defaults leave the image as is"""
+
+    greyscale: bool = False
+    contrast: float = 1.0  # < 1 fades to grey, > 1 increases the contrast
+    edges: str = ""  # one of EDGE_DETECTORS, "" keeps the image
+    sigma: float = 1.0  # of the smallest gaussian of the difference of gaussians
+    threshold: int = 0  # 0 keeps the grey values, otherwise black or white
+    lighten: float = 0.0  # 0 keeps the image, 1 makes it white
+
+    def __post_init__(self):
+        if self.edges not in EDGE_DETECTORS:
+            raise ValueError(f"Unknown edge detector: {self.edges}")
+
+
+def _table(function: Callable[[int], int], im: Image.Image) -> list[int]:
+    """Returns the lookup table of function for all bands of im"""
+    table = [min(255, max(0, round(function(v)))) for v in range(256)]
+    return table * len(im.getbands())
+
+
+# the kernels respond with at most 4 * 255, scaled to +/- 127 around 128
+_SOBEL_X = ImageFilter.Kernel((3, 3), (-1, 0, 1, -2, 0, 2, -1, 0, 1), 8, 128)
+_SOBEL_Y = ImageFilter.Kernel((3, 3), (-1, -2, -1, 0, 0, 0, 1, 2, 1), 8, 128)
+_DOG_RATIO = 1.6  # of the sigmas, approximates a laplacian of gaussian
+
+
+def _magnitude(im: Image.Image, gain: float) -> Image.Image:
+    """Maps signed responses around 128 to their absolute value"""
+    return im.point(_table(lambda v: abs(v - 128) * gain, im))
+
+
+def greyscale(im: Image.Image, pars: LineArtParameters) -> Image.Image:
+    return im.convert("L") if pars.greyscale else im
+
+
+def contrast(im: Image.Image, pars: LineArtParameters) -> Image.Image:
+    if pars.contrast == 1.0:
+        return im
+    return ImageEnhance.Contrast(im).enhance(pars.contrast)
+
+
+def edges(im: Image.Image, pars: LineArtParameters) -> Image.Image:
+    """Returns the strength of the edges, white on black"""
+    if not pars.edges:
+        return im
+    grey = im.convert("L")
+    if pars.edges == "sobel":
+        gx = _magnitude(grey.filter(_SOBEL_X), 2)
+        gy = _magnitude(grey.filter(_SOBEL_Y), 2)
+        return ImageChops.add(gx, gy)
+    narrow = grey.filter(ImageFilter.GaussianBlur(pars.sigma))
+    wide = grey.filter(ImageFilter.GaussianBlur(pars.sigma * _DOG_RATIO))
+    return _magnitude(ImageChops.subtract(narrow, wide, offset=128), 8)
+
+
+def threshold(im: Image.Image, pars: LineArtParameters) -> Image.Image:
+    """Edges become black lines on white, other images black and white"""
+    t = pars.threshold
+    if pars.edges:
+        if not t:
+            return ImageOps.invert(im)
+        return im.point(_table(lambda v: 0 if v >= t else 255, im))
+    if not t:
+        return im
+    # one threshold for the brightness, not one per channel
+    grey = im.convert("L")
+    return grey.point(_table(lambda v: 0 if v < t else 255, grey))
+
+
+def lighten(im: Image.Image, pars: LineArtParameters) -> Image.Image:
+    if not pars.lighten:
+        return im
+    return im.point(_table(lambda v: v + (255 - v) * pars.lighten, im))
+
+
+Stage = tuple[tuple[str, ...], Callable[[Image.Image, LineArtParameters], Image.Image]]
+
+# the fields of the parameters that every stage depends on, in order
+STAGES: tuple[Stage, ...] = (
+    (("greyscale",), greyscale),
+    (("contrast",), contrast),
+    (("edges", "sigma"), edges),
+    (("edges", "threshold"), threshold),
+    (("lighten",), lighten),
+)
+
+
+def decode(fn: str) -> Image.Image:
+    with Image.open(fn) as im:
+        if im.mode not in ("RGB", "RGBA", "L"):
+            return im.convert("RGB")
+        im.load()
+        return im.copy()
+
+
+class LineArtPipeline:
+    """Runs the stages and caches their results, the least recently used
+    results are dropped when they take more than max_bytes.
+
+    The cached images are shared, so they shouldn't be modified.
+    """
+
+    def __init__(self, max_bytes: int = MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._images: OrderedDict[tuple, Image.Image] = OrderedDict()
+        self._lock = threading.Lock()
+        memory.budget.register("lineart", self.memory_used, self.shrink)
+
+    def _get(self, key: tuple) -> Image.Image | None:
+        with self._lock:
+            im = self._images.get(key)
+            if im is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._images.move_to_end(key)
+            return im
+
+    def _put(self, key: tuple, im: Image.Image):
+        with self._lock:
+            if key in self._images:
+                return
+            self._images[key] = im
+            self.size += im.width * im.height * len(im.getbands())
+            while self.size > self.max_bytes and len(self._images) > 1:
+                _, evicted = self._images.popitem(last=False)
+                self.size -= evicted.width * evicted.height * len(evicted.getbands())
+
+    def clear(self):
+        with self._lock:
+            self._images.clear()
+            self.size = 0
+
+    def memory_used(self) -> int:
+        return self.size
+
+    def shrink(self, nbytes: int) -> int:
+        """Drops the least recently used results until nbytes are freed"""
+        freed = 0
+        with self._lock:
+            while freed < nbytes and self._images:
+                _, evicted = self._images.popitem(last=False)
+                freed += evicted.width * evicted.height * len(evicted.getbands())
+            self.size -= freed
+        return freed
+
+    @profiling.timed("lineart.process")
+    def process(self, fn: str, pars: LineArtParameters) -> Image.Image:
+        """Returns the image in fn converted with pars"""
+        key = (rendercache.file_digest(fn),)
+        im = self._get(key)
+        if im is None:
+            im = decode(fn)
+            self._put(key, im)
+
+        for fields, stage in STAGES:
+            key += tuple(getattr(pars, field) for field in fields)
+            cached = self._get(key)
+            if cached is not None:
+                im = cached
+                continue
+            result = stage(im, pars)
+            if result is not im:  # stages that keep the image aren't stored
+                self._put(key, result)
+            im = result
+        memory.budget.enforce()
+        return im
+
+
+pipeline = LineArtPipeline()
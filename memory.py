@@ -0,0 +1,173 @@
+"""A memory budget for the large pixel buffers of a session
+
+The decoded source image, the levels of its pyramid, the converted line art,
+the tiles and glyphs of the preview, the frames of the render process and the
+bands of an export each take megabytes; an A4 page at 300 dpi is about 35 MB.
+The owners of these buffers register with the budget under a category, with
+a function that returns the bytes they use and, when the buffers can be made
+again, a function that frees some of them.
+
+When the total exceeds the limit, the budget shrinks the caches in the order
+of EVICTION_ORDER, the cheapest to make again first. Buffers without a shrink
+function, like the source image, are counted but never evicted.
+
+The caches of the preview belong to the main thread and aren't locked. When
+the limit is enforced on another thread, e.g. after an image is converted,
+shrinking stops at the first of them and the budget is enforced again on the
+main thread, with call_soon (GLib.idle_add in the GUI).
+"""
+from __future__ import annotations
+
+from collections.abc import Callable
+from contextlib import contextmanager
+import threading
+import weakref
+
+MAX_BYTES = 1024 * 1024 * 1024
+
+# the caches that are shrunk first are the cheapest to make again
+EVICTION_ORDER = ("tiles", "glyphs", "mipmap", "lineart")
+
+
+def _ref(function: Callable) -> Callable[[], Callable | None]:
+    """Returns a weak reference to a bound method, so registering doesn't
+    keep its owner alive, and a strong one to other functions.
+    """
+    if hasattr(function, "__self__"):
+        return weakref.WeakMethod(function)
+    return lambda: function
+
+
+class Budget:
+    """The bytes of the registered buffers by category, and their limit"""
+
+    def __init__(self, limit: int = MAX_BYTES):
+        self.limit = limit
+        self.evicted = 0  # the bytes that are freed to stay within the limit
+        self.call_soon: Callable[[Callable], object] | None = None
+        self._owners: list[tuple[str, Callable, Callable | None, bool]] = []
+        self._transient: dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._enforcing = threading.local()
+        self._deferred = False  # enforce is scheduled on the main thread
+
+    def register(
+        self,
+        category: str,
+        used: Callable[[], int],
+        shrink: Callable[[int], int] | None = None,
+        main_thread: bool = False,
+    ):
+        """Counts the bytes that used returns as category. shrink(nbytes)
+        should free at least nbytes when possible and return the bytes that
+        it freed, with main_thread it is only called on the main thread.
+        Bound methods are referenced weakly, the registration ends when their
+        object is collected.
+        """
+        with self._lock:
+            self._owners.append(
+                (category, _ref(used), _ref(shrink) if shrink else None, main_thread)
+            )
+
+    def _live(self) -> list[tuple[str, Callable, Callable | None, bool]]:
+        """Returns the functions of the registrations whose owners still
+        exist, the others are dropped.
+        """
+        with self._lock:
+            live, owners = [], []
+            for registration in self._owners:
+                category, used, shrink, main_thread = registration
+                used = used()
+                if used is not None:
+                    shrink = shrink() if shrink else None
+                    live.append((category, used, shrink, main_thread))
+                    owners.append(registration)
+            self._owners = owners
+            return live
+
+    def usage(self) -> dict[str, int]:
+        """Returns the bytes that are used by category"""
+        with self._lock:
+            usage = dict(self._transient)
+        for category, used, _, _ in self._live():
+            usage[category] = usage.get(category, 0) + used()
+        return usage
+
+    def total(self) -> int:
+        return sum(self.usage().values())
+
+    def enforce(self) -> int:
+        """Shrinks the caches until the total is within the limit, returns the
+        freed bytes. On another thread than the main thread, it stops before
+        the first cache that belongs to the main thread.
+        """
+        # shrinking a cache may allocate, and report that
+        if getattr(self._enforcing, "active", False):
+            return 0
+        self._enforcing.active = True
+        try:
+            excess = self.total() - self.limit
+            freed = 0
+            live = self._live()
+            on_main_thread = threading.current_thread() is threading.main_thread()
+            shrinks = [
+                (shrink, main_thread)
+                for category in EVICTION_ORDER
+                for owner_category, _, shrink, main_thread in live
+                if owner_category == category and shrink
+            ]
+            for shrink, main_thread in shrinks:
+                if freed >= excess:
+                    break
+                if main_thread and not on_main_thread:
+                    self._defer()
+                    break
+                freed += shrink(excess - freed)
+            self.evicted += freed
+            return freed
+        finally:
+            self._enforcing.active = False
+
+    def _defer(self):
+        """Enforces the limit on the main thread soon"""
+        with self._lock:
+            if self._deferred or not self.call_soon:
+                return
+            self._deferred = True
+        self.call_soon(self._enforce_deferred)
+
+    def _enforce_deferred(self) -> bool:
+        with self._lock:
+            self._deferred = False
+        self.enforce()
+        return False  # don't repeat, like GLib.SOURCE_REMOVE
+
+    @contextmanager
+    def allocation(self, category: str, nbytes: int):
+        """Counts nbytes as category while the block runs, e.g. for the
+        buffers of an export. The caches are shrunk to make room first.
+        """
+        with self._lock:
+            self._transient[category] = self._transient.get(category, 0) + nbytes
+        self.enforce()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._transient[category] -= nbytes
+                if not self._transient[category]:
+                    del self._transient[category]
+
+    def report(self) -> list[str]:
+        """Returns a line per category, in MB"""
+        usage = self.usage()
+        lines = [
+            f"{category:<12}{nbytes / 2**20:8.1f}"
+            for category, nbytes in sorted(usage.items())
+        ]
+        total = sum(usage.values())
+        lines.append(f"{'total':<12}{total / 2**20:8.1f} of {self.limit / 2**20:.0f}")
+        return lines
+
+
+budget = Budget()
@@ -0,0 +1,161 @@
+"""Successively halved copies of an image surface
+
+Drawing a large image at a small scale makes cairo read many more pixels than
+it shows, which is slow and aliases. A pyramid keeps copies of the image that
+are halved with a box filter, so the level that is closest to the scale at
+which the image is shown can be drawn. The levels are made when they are
+first needed. All pyramids share a memory budget, the least recently used
+levels are dropped when it, or the memory budget (see memory), is exceeded.
+"""
+from __future__ import annotations
+
+from collections import OrderedDict
+import math as m
+import sys
+import threading
+import weakref
+
+from PIL import Image
+
+import memory
+import profiling
+
+MAX_BYTES = 128 * 1024 * 1024  # for the levels of all pyramids
+
+# (id of the pyramid, level) -> the pyramid and the size of the level, the
+# least recently used level comes first
+_levels: OrderedDict[tuple[int, int], tuple[weakref.ref, int]] = OrderedDict()
+_lock = threading.Lock()
+_size = 0
+
+
+def _nbytes(surf: cairo.ImageSurface) -> int:
+    return surf.get_stride() * surf.get_height()
+
+
+def _forget(pyramid_id: int):
+    """Drops the levels of a pyramid that is garbage collected"""
+    global _size
+    with _lock:
+        for key in [key for key in _levels if key[0] == pyramid_id]:
+            _size -= _levels.pop(key)[1]
+
+
+def shrink(nbytes: int) -> int:
+    """Drops the least recently used levels until nbytes are freed"""
+    global _size
+    freed = 0
+    with _lock:
+        while freed < nbytes and _levels:
+            (_, level), (ref, level_bytes) = _levels.popitem(last=False)
+            freed += level_bytes
+            pyramid = ref()
+            if pyramid is not None:
+                pyramid._surfaces.pop(level, None)
+        _size -= freed
+    return freed
+
+
+def _evict():
+    shrink(_size - MAX_BYTES)
+    memory.budget.enforce()
+
+
+def memory_used() -> int:
+    """Returns the bytes of the levels of all pyramids, without level 0"""
+    return _size
+
+
+memory.budget.register("mipmap", memory_used, shrink)
+
+
+# the raw mode of PIL for the 4 bytes of an RGB24 pixel, the 4th is unused
+_RAW_RGB24 = "BGRX" if sys.byteorder == "little" else "XRGB"
+
+
+def halve_pixels(
+    data, width: int, height: int, stride: int, alpha: bool
+) -> tuple[bytes, int, int]:
+    """Returns the pixels of an RGB24 or, with alpha, ARGB32 buffer at half the
+    size, with their width and height. Every pixel is the mean of 2 x 2
+    pixels, the odd last row and column are averaged on their own.
+    """
+    if alpha:
+        # the colors are premultiplied, so every byte is averaged on its own
+        # and their order is kept
+        mode, raw = "RGBa", "RGBa"
+    else:
+        # the unused byte may be 0, it mustn't be read as alpha
+        mode, raw = "RGB", _RAW_RGB24
+    im = Image.frombuffer(mode, (width, height), data, "raw", raw, stride, 1)
+    half = im.reduce(2)
+    return half.tobytes("raw", raw), half.width, half.height
+
+
+@profiling.timed("mipmap.halve")
+def halve(surf: cairo.ImageSurface) -> cairo.ImageSurface:
+    """Returns surf at half the size, see halve_pixels"""
+    # only the surfaces need cairo, the pixels are halved by PIL
+    import cairo
+
+    surf.flush()
+    fmt = surf.get_format()
+    data, width, height = halve_pixels(
+        surf.get_data(),
+        surf.get_width(),
+        surf.get_height(),
+        surf.get_stride(),
+        fmt == cairo.FORMAT_ARGB32,
+    )
+    # the stride of 4 byte pixels has no padding
+    return cairo.ImageSurface.create_for_data(
+        bytearray(data), fmt, width, height, fmt.stride_for_width(width)
+    )
+
+
+class MipPyramid:
+    """The levels of an image surface, level 0 is the surface itself and
+    every next level has half the size of the previous one.
+    """
+
+    def __init__(self, surf: cairo.ImageSurface):
+        self._surfaces: dict[int, cairo.ImageSurface] = {0: surf}
+        self.width = surf.get_width()
+        self.height = surf.get_height()
+        self.max_level = max(0, m.floor(m.log2(max(1, min(self.width, self.height)))))
+        weakref.finalize(self, _forget, id(self))
+
+    def level_for_scale(self, scale: float) -> int:
+        """Returns the smallest level that has at least scale times the
+        pixels of the image, so it isn't enlarged when it is drawn at scale.
+        """
+        if scale <= 0 or scale >= 1:
+            return 0
+        return min(self.max_level, m.floor(m.log2(1 / scale)))
+
+    def level(self, level: int) -> cairo.ImageSurface:
+        """Returns the surface of level, it is made from the nearest larger
+        level that is present. The levels may be dropped by shrink() on
+        another thread, so they are only accessed with the lock held.
+        """
+        global _size
+        with _lock:
+            surf = self._surfaces.get(level)
+            if surf is not None:
+                if level:
+                    _levels.move_to_end((id(self), level))
+                return surf
+            larger = max(k for k in self._surfaces if k < level)
+            surf = self._surfaces[larger]
+
+        # the lock isn't held while halving, which is slow
+        for k in range(larger + 1, level + 1):
+            surf = halve(surf)
+            with _lock:
+                # another thread may have made the level meanwhile
+                if k not in self._surfaces:
+                    self._surfaces[k] = surf
+                    _levels[(id(self), k)] = weakref.ref(self), _nbytes(surf)
+                    _size += _nbytes(surf)
+        _evict()
+        return surf
@@ -1,20 +1,39 @@
 from __future__ import annotations
 
 import os.path as p
+import dataclasses
 import json
 from typing import TypedDict
 import image
 import gi
 import random
 import space
+import spatial
 from distractors import Distractor
 import serializer
+import binformat
+import autosave
+import history
+import events
+import lineart
+import renderproc
 
 gi.require_version("Pango", "1.0")
 from gi.repository import Pango
 
 
-class Model:
+# The kind of change that is emitted when a field is set, the other fields
+# emit their change via the image parameters or the font description.
+_FIELD_EVENTS = {
+    "path": events.IMAGE,
+    "word": events.WORD,
+    "show_path": events.EXCLUSION_PATH,
+    "close_path": events.EXCLUSION_PATH,
+    "line_art": events.IMAGE,
+}
+
+
+class Model(events.Observable):
     path: str
     name: str
     config_name = "draw.json"
@@ -26,6 +45,10 @@ class Model:
     show_path: bool
     close_path: bool
     exclusion_path: list[space.Point2D]
+    distractor_index: spatial.GridIndex
+    autosaver: autosave.AutoSaver | None
+    history: history.History | None
+    render_process: renderproc.RenderProcess | None
 
     rec_surf: image.RecImage
 
@@ -44,9 +67,23 @@ class Model:
         show_path: bool = False,
         close_path: bool = False,
         exclusion_path: list[space.Point2D] = [],
+        paper: tuple[float, float] = (image.A4_WIDTH, image.A4_HEIGHT),
+        dpi: int = image.DPI,
+        line_art: dict | None = None,
     ):
+        self.autosaver = None
+        self.history = None
+        self.render_process = None
         self.rec_surf = image.RecImage(self)
-
+        self.distractor_index = spatial.GridIndex()
+        self.rec_surf.pars.subscribe(self.emit)
+
+        # the default position of the image depends on the size of the paper
+        self.paper = paper
+        self.dpi = dpi
+        # the image is converted when it's loaded
+        if line_art:
+            self.rec_surf.line_art = lineart.LineArtParameters(**line_art)
         self.path = path
         self.name = name
         self.word = word
@@ -69,9 +106,29 @@ class Model:
         self.distractor_font = distractor_font
         self.distractor_font_description = None
         self.show_path = show_path
-        self.close_path = show_path
+        self.close_path = close_path
         self.exclusion_path = exclusion_path
 
+        self.history = history.History(self)
+
+    def _changed(self, entry: dict, change: events.Change | None = None):
+        """Report an edit to the autosaver, the history, the render process
+        and the subscribers
+        """
+        if self.autosaver:
+            self.autosaver.changed(entry)
+        if self.render_process:
+            self.render_process.changed(entry)
+        if self.history:
+            self.history.changed(entry)
+        if change:
+            self.emit(change)
+
+    def _field_changed(self, field: str, value):
+        kind = _FIELD_EVENTS.get(field)
+        change = events.Change(kind) if kind else None
+        self._changed({"op": "set", "field": field, "value": value}, change)
+
     @property
     def name(self):
         return self._name
@@ -87,6 +144,7 @@ class Model:
     @word.setter
     def word(self, value: str):
         self.rec_surf.word = value
+        self._field_changed("word", value)
 
     @property
     def path(self):
@@ -103,6 +161,7 @@ class Model:
                 self.rec_surf.fn = self.path
         else:
             self._path = ""
+        self._field_changed("path", self._path)
 
     @property
     def word_x(self) -> float:
@@ -117,6 +176,7 @@ class Model:
         Positive direction makes the word move right, negative move it left.
         """
         self.rec_surf.pars.word_tr_x = value
+        self._field_changed("word_x", value)
 
     @property
     def word_y(self) -> float:
@@ -131,6 +191,7 @@ class Model:
         Positive direction makes the word move down, negative move it up.
         """
         self.rec_surf.pars.word_tr_y = value
+        self._field_changed("word_y", value)
 
     @property
     def img_x(self) -> float:
@@ -139,6 +200,7 @@ class Model:
     @img_x.setter
     def img_x(self, value: float):
         self.rec_surf.pars.surf_tr_x = value
+        self._field_changed("img_x", value)
 
     @property
     def img_y(self) -> float:
@@ -147,6 +209,86 @@ class Model:
     @img_y.setter
     def img_y(self, value: float):
         self.rec_surf.pars.surf_tr_y = value
+        self._field_changed("img_y", value)
+
+    @property
+    def img_scale_factor(self) -> float:
+        return self.rec_surf.pars.surf_scale_factor
+
+    @img_scale_factor.setter
+    def img_scale_factor(self, value: float):
+        self.rec_surf.pars.surf_scale_factor = value
+        self._field_changed("img_scale_factor", value)
+
+    @property
+    def paper(self) -> tuple[float, float]:
+        """The width and height of the page in mm"""
+        return self.rec_surf.pars.paper
+
+    @paper.setter
+    def paper(self, value: tuple[float, float]):
+        self.rec_surf.pars.paper = tuple(value)
+        self._field_changed("paper", self.paper)
+
+    @property
+    def dpi(self) -> int:
+        """The resolution of the output"""
+        return self.rec_surf.pars.dpi
+
+    @dpi.setter
+    def dpi(self, value: int):
+        self.rec_surf.pars.dpi = value
+        self._field_changed("dpi", value)
+
+    @property
+    def line_art(self) -> lineart.LineArtParameters:
+        return self.rec_surf.line_art
+
+    @line_art.setter
+    def line_art(self, value: lineart.LineArtParameters | dict):
+        """Converts the image to line art with the given parameters, they are
+        journaled as a dict.
+        """
+        if isinstance(value, dict):
+            value = lineart.LineArtParameters(**value)
+        self.rec_surf.set_line_art(value)
+        self._field_changed("line_art", dataclasses.asdict(value))
+
+    @property
+    def font(self) -> str:
+        return self._font
+
+    @font.setter
+    def font(self, value: str):
+        self._font = value
+        self._field_changed("font", value)
+
+    @property
+    def distractor_font(self) -> str:
+        return self._distractor_font
+
+    @distractor_font.setter
+    def distractor_font(self, value: str):
+        self._distractor_font = value
+        self._field_changed("distractor_font", value)
+
+    @property
+    def show_path(self) -> bool:
+        return self._show_path
+
+    @show_path.setter
+    def show_path(self, value: bool):
+        self._show_path = value
+        self._field_changed("show_path", value)
+
+    @property
+    def close_path(self) -> bool:
+        return self._close_path
+
+    @close_path.setter
+    def close_path(self, value: bool):
+        self._close_path = value
+        self._field_changed("close_path", value)
 
     def as_dict(self) -> dict:
         return {
@@ -161,11 +303,39 @@ class Model:
             "distractor_font": self.distractor_font,
             "show_path": self.show_path,
             "close_path": self.close_path,
+            "paper": self.paper,
+            "dpi": self.dpi,
+            "line_art": dataclasses.asdict(self.line_art),
             # put long lists in the end
             "exclusion_path": self.exclusion_path,
             "distractors": self.distractors,
         }
 
+    def derive(self, **fields) -> Model:
+        """Returns a copy with the given fields of as_dict() replaced. The
+        decoded image and the font descriptions are shared with this model.
+        """
+        d = self.as_dict()
+        # don't share the lists, nor the distractors that may be moved
+        d["exclusion_path"] = list(self.exclusion_path)
+        d["distractors"] = [
+            Distractor(dis.string, space.Point2D(dis.pos.x, dis.pos.y))
+            for dis in self.distractors
+        ]
+        d.update(fields)
+        path = d.pop("path")
+        model = Model(**d)
+        model.rec_surf.set_image(path, self.rec_surf.img_surf, self.rec_surf.pyramid)
+        model._path = path
+        # set_image estimated the defaults, use the values of this model
+        model.img_scale_factor = self.img_scale_factor
+        model.img_x = d["img_x"]
+        model.img_y = d["img_y"]
+        model.set_font_desc(self.font_description)
+        model.set_distractor_font_desc(self.distractor_font_description)
+        model.history.reset()
+        return model
+
     @staticmethod
     def from_dict(d: dict) -> Model:
         return Model(**dict)
@@ -175,23 +345,184 @@ class Model:
         """Load the config file for this program
 
         The config file should be in the same current working directory.
-        if not fn, the default will be tried.
+        if not fn, the default will be tried. Both json and binary worksheets
+        (see binformat) are accepted.
         """
         if not fn:
             fn = Model.config_name
-        with open(fn, "r") as content:
-            d = json.loads(content.read(), object_hook=serializer.deserializer)
+        with open(fn, "rb") as content:
+            binary = binformat.is_worksheet(content.read(len(binformat.MAGIC)))
+        if binary:
+            # the mapped worksheet doesn't read the thumbnail
+            with binformat.load(fn) as sheet:
+                model = Model(**sheet.as_dict())
+        else:
+            with open(fn, "rb") as content:
+                d = json.loads(content.read(), object_hook=serializer.deserializer)
             model = Model(**d)
-            return model
+        model.config_name = fn  # save where we came from
+        return model
 
-    def add_distractor(self, string: str):
+    def add_distractor(self, string: str, rng: random.Random | None = None):
+        """Adds a distractor at a random position outside of the exclusion path,
+        use rng to place the distractors reproducibly.
+        """
+        if rng is None:
+            rng = random
         width, height = self.rec_surf.pars.size
-        point = space.Point2D(width * random.random(), height * random.random())
+        point = space.Point2D(width * rng.random(), height * rng.random())
         while self.rec_surf.in_exclusion_path(point):
             print(f"{point} in exclusion_path")
-            point.x, point.y = width * random.random(), height * random.random()
-        distractor = Distractor(string, point)
+            point.x, point.y = width * rng.random(), height * rng.random()
+        self.append_distractor(Distractor(string, point))
+
+    def append_distractor(self, distractor: Distractor):
+        """Adds distractor on top of the others"""
         self.distractors.append(distractor)
+        self._changed(
+            {
+                "op": "add_distractor",
+                "string": distractor.string,
+                "x": distractor.pos.x,
+                "y": distractor.pos.y,
+            },
+            events.Change(events.DISTRACTORS, added=(len(self.distractors) - 1,)),
+        )
+
+    def replace_distractors(self, distractors: list[Distractor]):
+        """Replaces all distractors at once"""
+        removed = tuple(range(len(self.distractors)))
+        self.distractors[:] = distractors
+        self.distractor_index.clear()
+        self._changed(
+            {
+                "op": "replace_distractors",
+                "distractors": [[d.string, d.pos.x, d.pos.y] for d in distractors],
+            },
+            events.Change(
+                events.DISTRACTORS,
+                added=tuple(range(len(distractors))),
+                removed=removed,
+            ),
+        )
+
+    def remove_distractor(self, index: int) -> Distractor:
+        """Removes the distractor at index from the list and the spatial index"""
+        distractor = self.distractors.pop(index)
+        self.distractor_index.discard(distractor)
+        self._changed(
+            {"op": "remove_distractor", "index": index},
+            events.Change(events.DISTRACTORS, removed=(index,)),
+        )
+        return distractor
+
+    def remove_distractors(self, indices: list[int]) -> list[Distractor]:
+        """Removes the distractors at indices at once, they are reported as
+        one edit.
+        """
+        indices = sorted(set(indices))
+        removed = [self.distractors[index] for index in indices]
+        for index in reversed(indices):
+            self.distractor_index.discard(self.distractors.pop(index))
+        self._changed(
+            {"op": "remove_distractors", "indices": indices},
+            events.Change(events.DISTRACTORS, removed=tuple(indices)),
+        )
+        return removed
+
+    def move_distractor(self, distractor: Distractor, pos: space.Point2D):
+        """Moves distractor to pos, its measured box moves along"""
+        if distractor in self.distractor_index:
+            x0, y0, x1, y1 = self.distractor_index.box(distractor)
+            dx, dy = pos.x - distractor.pos.x, pos.y - distractor.pos.y
+            self.distractor_index.move(distractor, (x0 + dx, y0 + dy, x1 + dx, y1 + dy))
+        distractor.pos = pos
+        index = self.distractors.index(distractor)
+        self._changed(
+            {"op": "move_distractor", "index": index, "x": pos.x, "y": pos.y},
+            events.Change(events.DISTRACTORS, changed=(index,)),
+        )
+
+    def set_distractor_size(self, distractor: Distractor, width: float, height: float):
+        """Registers the measured size of the glyphs of distractor, the box is
+        centered around the position of the distractor.
+        """
+        x, y = distractor.pos.x, distractor.pos.y
+        box = (x - width / 2, y - height / 2, x + width / 2, y + height / 2)
+        self.distractor_index.insert(distractor, box)
+
+    def distractor_at(self, point: space.Point2D) -> Distractor | None:
+        """Returns the topmost distractor whose box contains point"""
+        return self.distractor_index.pick(point.x, point.y)
+
+    def add_path_point(self, point: space.Point2D):
+        """Extends the exclusion path with point"""
+        self.exclusion_path.append(point)
+        self._changed(
+            {"op": "add_path_point", "x": point.x, "y": point.y},
+            events.Change(events.EXCLUSION_PATH),
+        )
+
+    def clear_path(self):
+        """Removes all points from the exclusion path"""
+        self.exclusion_path.clear()
+        self._changed({"op": "clear_path"}, events.Change(events.EXCLUSION_PATH))
+
+    def replace_path(self, points: list[space.Point2D]):
+        """Replaces the exclusion path at once"""
+        self.exclusion_path[:] = points
+        self._changed(
+            {"op": "replace_path", "points": [[pt.x, pt.y] for pt in points]},
+            events.Change(events.EXCLUSION_PATH),
+        )
+
+    def restore(self, state: history.State, changes: set[str]):
+        """Brings the fields in changes to their value in state"""
+        if "path" in changes or "img_surf" in changes:
+            self.rec_surf.set_image(state.path, state.img_surf)
+            self._path = state.path
+            if state.path:
+                self.name = p.basename(state.path)
+            self._field_changed("path", state.path)
+            # the image parameters belong to the image
+            changes = changes | {"img_x", "img_y", "img_scale_factor"}
+
+        for field in history.SCALAR_FIELDS:
+            if field in changes:
+                setattr(self, field, getattr(state, field))
+
+        if "line_art" in changes:
+            # the converted image is restored as img_surf
+            self.rec_surf.line_art = lineart.LineArtParameters(**state.line_art)
+            self._field_changed("line_art", state.line_art)
+
+        if "font" in changes:
+            self.set_font_desc(
+                Pango.font_description_from_string(state.font) if state.font else None
+            )
+        if "distractor_font" in changes:
+            font = state.distractor_font
+            self.set_distractor_font_desc(
+                Pango.font_description_from_string(font) if font else None
+            )
+
+        if "distractors" in changes:
+            self.replace_distractors(
+                [Distractor(s, space.Point2D(x, y)) for s, x, y in state.distractors]
+            )
+        if "exclusion_path" in changes:
+            self.replace_path([space.Point2D(x, y) for x, y in state.exclusion_path])
+
+    def load_font_descs(self):
+        """Creates the font descriptions from the names of the fonts, the GUI
+        does this with its font buttons.
+        """
+        if self.font:
+            self.set_font_desc(Pango.font_description_from_string(self.font))
+        if self.distractor_font:
+            self.set_distractor_font_desc(
+                Pango.font_description_from_string(self.distractor_font)
+            )
 
     def get_font_desc(self) -> Pango.FontDescription | None:
         """Get the font description when specified"""
@@ -201,6 +532,7 @@ class Model:
         """set the font description when specified"""
         self.font_description = font_desc
         self.rec_surf.font_desc = font_desc
+        self.emit(events.Change(events.FONT))
 
     def get_distractor_font_desc(self) -> Pango.FontDescription | None:
         """Get the distractor font description when specified"""
@@ -208,13 +540,27 @@ class Model:
 
     def set_distractor_font_desc(self, font_desc: Pango.FontDescription) -> None:
         self.distractor_font_description = font_desc
+        self.emit(events.Change(events.DISTRACTOR_FONT))
+
+    def dumps(self) -> bytes:
+        """Returns the config as json"""
+        return json.dumps(
+            serializer.serializer.pack(self.as_dict()),
+            indent=4,
+            default=serializer.serializer,
+        ).encode("utf8")
+
+    def serialize(self) -> bytes:
+        """Returns the config in the format of its file, a binary worksheet
+        (without thumbnail) when it has the binformat extension, json otherwise.
+        """
+        if self.config_name.endswith(binformat.EXTENSION):
+            return binformat.dumps(self.as_dict())
+        return self.dumps()
 
     def save(self):
-        with open(self.config_name, "wb") as configfile:
-            configfile.write(
-                json.dumps(
-                    self.as_dict(),
-                    indent=4,
-                    default=serializer.serializer,
-                ).encode("utf8")
-            )
+        autosave.atomic_write(self.config_name, self.serialize())
+
+    def save_binary(self, fn: str, thumbnail: bytes = b""):
+        """Save the config as binary worksheet, optionally with a thumbnail"""
+        binformat.save(fn, self.as_dict(), thumbnail)
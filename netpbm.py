@@ -0,0 +1,53 @@
+"""Writes the pixels of cairo surfaces as uncompressed pam and ppm files
+
+The pixels are given as the data of an RGB24 or ARGB32 surface: 4 bytes per
+pixel in the byte order of the machine, rows of stride bytes. Only PIL is
+needed, imgutils passes the data of the surfaces.
+"""
+import sys
+import typing
+
+from PIL import Image
+
+# the order of the 4 bytes of a pixel (the alpha byte is unused by RGB24).
+# These aren't standard pam tuple types, standard readers need ppm.
+PAM_TUPLTYPE = "BGRA" if sys.byteorder == "little" else "ARGB"
+
+# the raw packer of PIL that yields the bytes of an RGB24 pixel of cairo
+_CAIRO_RGB24 = "BGRX" if sys.byteorder == "little" else "XRGB"
+
+
+def write_pam(
+    data,
+    width: int,
+    height: int,
+    stride: int,
+    out: typing.BinaryIO,
+    opaque: bool = False,
+):
+    """Writes the pixels as they are, without a copy, so the tuple type is
+    PAM_TUPLTYPE and the colors of ARGB32 are premultiplied. With opaque, for
+    RGB24, the unused byte is set to 255 in data, so it reads as opaque.
+    """
+    data = memoryview(data)
+    if opaque:
+        alpha = PAM_TUPLTYPE.index("A")
+        for y in range(height):
+            row = y * stride + alpha
+            data[row : row + width * 4 : 4] = b"\xff" * width
+    out.write(
+        f"P7\nWIDTH {width}\nHEIGHT {height}\nDEPTH 4\nMAXVAL 255\n"
+        f"TUPLTYPE {PAM_TUPLTYPE}\nENDHDR\n".encode("ascii")
+    )
+    if stride == width * 4:
+        out.write(data[: stride * height])
+    else:
+        for y in range(height):
+            out.write(data[y * stride : y * stride + width * 4])
+
+
+def write_ppm(data, width: int, height: int, stride: int, out: typing.BinaryIO):
+    """Writes the pixels as a binary ppm, they are packed into RGB triplets"""
+    im = Image.frombuffer("RGB", (width, height), data, "raw", _CAIRO_RGB24, stride, 1)
+    out.write(f"P6\n{width} {height}\n255\n".encode("ascii"))
+    out.write(im.tobytes())
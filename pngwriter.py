@@ -0,0 +1,97 @@
+"""Writes png files incrementally, in bands of rows"""
+import struct
+import typing
+import zlib
+
+import profiling
+
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# PIL mode -> png color type, bit depth and the number of channels
+_PNG_FORMATS = {
+    "1": (0, 1, 1),
+    "L": (0, 8, 1),
+    "P": (3, 8, 1),
+    "RGB": (2, 8, 3),
+    "RGBA": (6, 8, 4),
+}
+
+
+class PngWriter:
+    """Encodes a png incrementally, so an image can be written in bands of rows
+    without holding all of it in memory. The rows are not filtered.
+
+    The rows are in the layout of PIL's tobytes() for mode, i.e. a bilevel "1"
+    image has 8 pixels per byte. A "P" image needs a palette of rgb triplets.
+    When dpi is given, it is stored as the physical size of the pixels.
+    """
+
+    IDAT_SIZE = 1 << 16  # the compressed bytes that are collected in a chunk
+
+    def __init__(
+        self,
+        out: typing.BinaryIO,
+        width: int,
+        height: int,
+        mode="RGB",
+        level=6,
+        palette: bytes = b"",
+        dpi: int = 0,
+    ):
+        color_type, depth, channels = _PNG_FORMATS[mode]
+        if mode == "P" and not palette:
+            raise ValueError("A palette image needs a palette")
+        self.out = out
+        self.width = width
+        self.height = height
+        self.rows = 0
+        self.row_bytes = (width * depth * channels + 7) // 8
+        self._compress = zlib.compressobj(level)
+        self._pending = bytearray()
+
+        out.write(_PNG_SIGNATURE)
+        self._chunk(
+            b"IHDR",
+            struct.pack(">IIBBBBB", width, height, depth, color_type, 0, 0, 0),
+        )
+        if dpi:
+            per_meter = round(dpi / 0.0254)
+            self._chunk(b"pHYs", struct.pack(">IIB", per_meter, per_meter, 1))
+        if mode == "P":
+            self._chunk(b"PLTE", palette)
+
+    def _chunk(self, tag: bytes, data: bytes):
+        self.out.write(struct.pack(">I", len(data)))
+        self.out.write(tag)
+        self.out.write(data)
+        self.out.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(tag))))
+
+    def _flush_pending(self):
+        if self._pending:
+            self._chunk(b"IDAT", bytes(self._pending))
+            self._pending.clear()
+
+    @profiling.timed("pngwriter.write_rows")
+    def write_rows(self, data: bytes):
+        """Appends whole rows of pixels"""
+        view = memoryview(data)
+        if len(view) % self.row_bytes:
+            raise ValueError("Only whole rows can be written")
+        n_rows = len(view) // self.row_bytes
+        if self.rows + n_rows > self.height:
+            raise ValueError("Writing more rows than the height of the image")
+        # every row starts with its filter type: None
+        rows = b"".join(
+            b"\x00" + view[start : start + self.row_bytes]
+            for start in range(0, len(view), self.row_bytes)
+        )
+        self._pending += self._compress.compress(rows)
+        self.rows += n_rows
+        if len(self._pending) >= self.IDAT_SIZE:
+            self._flush_pending()
+
+    def close(self):
+        if self.rows != self.height:
+            raise ValueError(f"Only {self.rows} of {self.height} rows are written")
+        self._pending += self._compress.flush()
+        self._flush_pending()
+        self._chunk(b"IEND", b"")
@@ -0,0 +1,193 @@
+"""Timing of the stages of rendering
+
+Stages are timed with spans, either around a block
+
+    with profiling.span("encode"):
+        ...
+
+or around every call of a function decorated with @profiling.timed(). Spans
+may be nested. The most recent durations of every name are kept, to report
+percentiles and histograms, and the most recent spans can be written as json
+or in the Chrome trace event format (chrome://tracing, Perfetto).
+
+Profiling is disabled by default. A disabled span is a shared object that
+does nothing, so the instrumentation costs about a function call.
+"""
+from __future__ import annotations
+
+from collections import deque
+from collections.abc import Callable
+import functools
+import json
+import math as m
+import os
+import threading
+import time
+
+WINDOW = 512  # the durations that are kept per name
+MAX_SPANS = 100_000  # the spans that are kept for a trace
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ("profiler", "name", "start")
+
+    def __init__(self, profiler: Profiler, name: str):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler._stack().append(self.name)
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter_ns()
+        stack = self.profiler._stack()
+        stack.pop()
+        self.profiler.record(self.name, self.start, end - self.start, len(stack))
+        return False
+
+
+class Profiler:
+    """Collects the durations of named spans"""
+
+    def __init__(self, window: int = WINDOW, max_spans: int = MAX_SPANS):
+        self.enabled = False
+        self.window = window
+        self._durations: dict[str, deque[int]] = {}
+        self._counts: dict[str, int] = {}
+        # name, start, duration in ns, depth, thread id
+        self._spans: deque[tuple[str, int, int, int, int]] = deque(maxlen=max_spans)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _stack(self) -> list[str]:
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    def span(self, name: str):
+        """Returns a context manager that times its block as name"""
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name)
+
+    def timed(self, name: str = "") -> Callable[[Callable], Callable]:
+        """Decorator that times every call, name defaults to the qualified
+        name of the function.
+        """
+
+        def decorator(function: Callable) -> Callable:
+            span_name = name or function.__qualname__
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                with _Span(self, span_name):
+                    return function(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def record(self, name: str, start: int, duration: int, depth: int = 0):
+        """Adds a span of duration ns that started at start ns"""
+        with self._lock:
+            durations = self._durations.get(name)
+            if durations is None:
+                durations = self._durations[name] = deque(maxlen=self.window)
+                self._counts[name] = 0
+            durations.append(duration)
+            self._counts[name] += 1
+            self._spans.append((name, start, duration, depth, threading.get_ident()))
+
+    def reset(self):
+        with self._lock:
+            self._durations.clear()
+            self._counts.clear()
+            self._spans.clear()
+
+    def names(self) -> list[str]:
+        return list(self._durations)
+
+    def stats(self) -> dict[str, dict]:
+        """Returns the count and the statistics in ms of the recent durations
+        of every name.
+        """
+        with self._lock:
+            windows = {name: sorted(d) for name, d in self._durations.items()}
+            counts = dict(self._counts)
+
+        def percentile(durations: list[int], q: float) -> float:
+            rank = max(1, m.ceil(len(durations) * q / 100))
+            return durations[rank - 1] / 1e6
+
+        return {
+            name: {
+                "count": counts[name],
+                "mean": sum(durations) / len(durations) / 1e6,
+                "p50": percentile(durations, 50),
+                "p90": percentile(durations, 90),
+                "p99": percentile(durations, 99),
+                "max": durations[-1] / 1e6,
+            }
+            for name, durations in windows.items()
+        }
+
+    def histogram(self, name: str) -> dict[float, int]:
+        """Returns the number of recent durations of name per bucket, a
+        bucket is named by its upper bound in ms, the bounds are powers of 2.
+        """
+        with self._lock:
+            durations = list(self._durations.get(name, ()))
+        buckets: dict[float, int] = {}
+        for duration in durations:
+            bound = 2.0 ** m.ceil(m.log2(max(duration, 1) / 1e6))
+            buckets[bound] = buckets.get(bound, 0) + 1
+        return dict(sorted(buckets.items()))
+
+    def chrome_trace(self) -> dict:
+        """Returns the recent spans in the Chrome trace event format"""
+        with self._lock:
+            spans = list(self._spans)
+        pid = os.getpid()
+        return {
+            "traceEvents": [
+                {
+                    "name": name,
+                    "ph": "X",
+                    "ts": start / 1e3,
+                    "dur": duration / 1e3,
+                    "pid": pid,
+                    "tid": tid,
+                    "args": {"depth": depth},
+                }
+                for name, start, duration, depth, tid in spans
+            ],
+            "displayTimeUnit": "ms",
+        }
+
+    def dump(self, fn: str, trace: bool = False):
+        """Writes the statistics, or the trace when trace, as json to fn"""
+        data = self.chrome_trace() if trace else self.stats()
+        with open(fn, "w", encoding="utf8") as out:
+            json.dump(data, out, indent=1)
+
+
+profiler = Profiler()
+span = profiler.span
+timed = profiler.timed
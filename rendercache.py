@@ -0,0 +1,163 @@
+"""A cache of rendered worksheets on disk
+
+Rendered files are stored under a key that is a hash of everything that
+determines the output: the config of the model, the content of the source
+image and its line art conversion, the fonts and the output format and
+resolution. Hence, a worksheet that has been rendered before can be returned
+without drawing or encoding it again. The cache has a maximum size, the least
+recently used files are removed first.
+"""
+from __future__ import annotations
+
+from collections import OrderedDict
+import dataclasses
+import hashlib
+import json
+import os
+import os.path as p
+import time
+
+import autosave
+import serializer
+
+CACHE_DIR = "render_cache"
+MAX_BYTES = 512 * 1024 * 1024
+# temporary files that are older were left by an interrupted write
+STALE_SECONDS = 60 * 60
+
+# Increment when the drawing code changes, so old renders are not used
+RENDER_VERSION = 2
+
+# (filename, mtime, size) -> digest, so large images are hashed only once
+_file_digests: dict[tuple[str, float, int], str] = {}
+
+
+def file_digest(fn: str) -> str:
+    """Returns the sha256 of the content of a file"""
+    stat = os.stat(fn)
+    key = p.abspath(fn), stat.st_mtime, stat.st_size
+    if key not in _file_digests:
+        digest = hashlib.sha256()
+        with open(fn, "rb") as content:
+            for block in iter(lambda: content.read(1 << 20), b""):
+                digest.update(block)
+        _file_digests[key] = digest.hexdigest()
+    return _file_digests[key]
+
+
+def render_key(model, fmt: str, dpi: int) -> str:
+    """Returns the key of the rendering of model as fmt at dpi"""
+    font_desc = model.get_font_desc()
+    distractor_font_desc = model.get_distractor_font_desc()
+    description = {
+        "version": RENDER_VERSION,
+        "model": serializer.serializer.pack(model.as_dict()),
+        "image": file_digest(model.path) if model.path else "",
+        "font": font_desc.to_string() if font_desc else "",
+        "distractor_font": (
+            distractor_font_desc.to_string() if distractor_font_desc else ""
+        ),
+        "img_scale_factor": model.img_scale_factor,
+        "line_art": dataclasses.asdict(model.rec_surf.line_art),
+        "size": model.rec_surf.pars.size,
+        "format": fmt,
+        "dpi": dpi,
+    }
+    text = json.dumps(description, sort_keys=True, default=serializer.serializer)
+    return hashlib.sha256(text.encode("utf8")).hexdigest()
+
+
+class RenderCache:
+    """A size capped store of rendered files with LRU eviction"""
+
+    def __init__(self, directory: str = CACHE_DIR, max_bytes: int = MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        os.makedirs(directory, exist_ok=True)
+
+        # the files that were used least recently come first
+        entries = []
+        for entry in os.scandir(directory):
+            if not entry.is_file() or entry.name.startswith("."):
+                continue
+            stat = entry.stat()
+            if entry.name.endswith(autosave.TEMP_SUFFIX):
+                # another cache may still be writing a recent one
+                if stat.st_mtime < time.time() - STALE_SECONDS:
+                    os.remove(entry.path)
+                continue
+            entries.append((stat.st_mtime, entry.name, stat.st_size))
+        entries.sort()
+        self._sizes = OrderedDict((name, size) for _, name, size in entries)
+        self.size = sum(self._sizes.values())
+
+    def _fn(self, key: str) -> str:
+        return p.join(self.directory, key)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._sizes
+
+    def get(self, key: str) -> bytes | None:
+        """Returns the stored file or None when it is absent"""
+        if key not in self._sizes:
+            self.misses += 1
+            return None
+        try:
+            with open(self._fn(key), "rb") as content:
+                data = content.read()
+        except FileNotFoundError:  # removed behind our back
+            self.size -= self._sizes.pop(key)
+            self.misses += 1
+            return None
+        os.utime(self._fn(key))  # keep the order when the cache is reopened
+        self._sizes.move_to_end(key)
+        self.hits += 1
+        self.bytes_saved += len(data)
+        return data
+
+    def put(self, key: str, data: bytes):
+        """Stores data and evicts the least recently used files when the cache
+        is too large.
+        """
+        if len(data) > self.max_bytes:
+            return
+        autosave.atomic_write(self._fn(key), data)
+        if key in self._sizes:
+            self.size -= self._sizes.pop(key)
+        self._sizes[key] = len(data)
+        self.size += len(data)
+        self._evict()
+
+    def _evict(self):
+        while self.size > self.max_bytes and self._sizes:
+            key, size = self._sizes.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(self._fn(key))
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        for key in list(self._sizes):
+            os.remove(self._fn(key))
+        self._sizes.clear()
+        self.size = 0
+
+    @property
+    def hit_rate(self) -> float:
+        requests = self.hits + self.misses
+        return self.hits / requests if requests else 0.0
+
+    def report(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+            "bytes_saved": self.bytes_saved,
+            "size": self.size,
+            "max_bytes": self.max_bytes,
+            "files": len(self._sizes),
+        }
@@ -0,0 +1,295 @@
+"""Renders the preview in a separate process
+
+Drawing the recording holds the GIL while Pango shapes the text and Python
+walks the distractors, which makes the GUI stutter on large worksheets. A
+RenderProcess keeps a copy of the model in a child process. The child starts
+from a snapshot of the model, after that only the edits are sent over a pipe,
+as entries of the journal (see autosave.replay).
+
+The child renders the visible part of the page into a shared memory block
+that is laid out as a cairo ARGB32 surface at the stride of the widget, and
+sends a message when it is done. The widget wraps the block in an
+ImageSurface and paints it without copying the pixels. There are two blocks,
+the child renders into the one that isn't shown.
+
+When the child fails to handle a message it reports the exception and its
+copy of the model can no longer be trusted, the RenderProcess is then no
+longer alive, like when the child died, and the GUI draws in process again.
+"""
+from __future__ import annotations
+
+from dataclasses import dataclass
+import json
+import logging
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import traceback
+
+import cairo
+
+import memory
+
+
+@dataclass(frozen=True)
+class View:
+    """The part of the page that is shown by a widget of width x height
+    pixels, origin is the point of the page at its top left corner.
+    """
+
+    width: int
+    height: int
+    scale: float  # widget pixels per pixel of the page
+    origin_x: float
+    origin_y: float
+
+    @property
+    def stride(self) -> int:
+        return cairo.Format.ARGB32.stride_for_width(self.width)
+
+    @property
+    def nbytes(self) -> int:
+        return self.stride * self.height
+
+
+def snapshot(model) -> dict:
+    """Returns what the child needs to rebuild model"""
+    return {
+        "config": model.dumps().decode("utf8"),
+        "img_scale_factor": model.img_scale_factor,
+    }
+
+
+def _load(state: dict):
+    import serializer
+    from model import Model
+
+    d = json.loads(state["config"], object_hook=serializer.deserializer)
+    model = Model(**d)
+    # loading the image estimated the defaults, use the values of the snapshot
+    model.img_scale_factor = state["img_scale_factor"]
+    model.img_x = d["img_x"]
+    model.img_y = d["img_y"]
+    model.load_font_descs()
+    return model
+
+
+def _render(model, block: shared_memory.SharedMemory, view: View):
+    import tiles
+
+    rec = model.rec_surf
+    render_scale = 2.0 ** tiles.level_for_scale(view.scale)
+    if rec.surf is None or rec.drawn_scale != render_scale:
+        rec.draw(render_scale, preview=True)
+
+    surf = cairo.ImageSurface.create_for_data(
+        block.buf, cairo.FORMAT_ARGB32, view.width, view.height, view.stride
+    )
+    cr = cairo.Context(surf)
+    cr.set_source_rgb(0.5, 0.5, 0.5)
+    cr.paint()
+    cr.scale(view.scale, view.scale)
+    cr.translate(-view.origin_x, -view.origin_y)
+    cr.rectangle(0, 0, rec.width, rec.height)
+    cr.clip()
+    cr.set_source_surface(rec.surf)
+    cr.paint()
+    del cr
+    surf.finish()
+
+
+def _handle(conn, model, blocks: dict[str, shared_memory.SharedMemory], message):
+    """Handles a message of the RenderProcess, returns the model"""
+    import autosave
+
+    op, *args = message
+    if op == "load":
+        model = _load(args[0])
+    elif op == "edit":
+        entry = args[0]
+        autosave.replay(model, entry)
+        if entry["op"] == "set" and entry["field"] in ("font", "distractor_font"):
+            model.load_font_descs()
+        model.rec_surf.surf = None
+    elif op == "render":
+        name, view, frame = args
+        if name not in blocks:
+            blocks[name] = shared_memory.SharedMemory(name)
+        _render(model, blocks[name], view)
+        conn.send(("done", frame))
+    elif op == "release":
+        # the block is only attached once it is rendered into
+        block = blocks.pop(args[0], None)
+        if block:
+            block.close()
+    return model
+
+
+def serve(conn):
+    """The loop of the child, it handles the messages of the RenderProcess
+    and sends the exceptions back.
+    """
+    model = None
+    blocks: dict[str, shared_memory.SharedMemory] = {}
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:  # the parent died
+            break
+        if message[0] == "quit":
+            break
+        try:
+            model = _handle(conn, model, blocks, message)
+        except Exception:
+            conn.send(("error", message[0], traceback.format_exc()))
+    for block in blocks.values():
+        block.close()
+    conn.close()
+
+
+class RenderProcess:
+    """Renders the views of a model in a child process
+
+    The model reports its edits with changed(), like it does to the
+    autosaver. The GUI requests renders of the view that it shows and calls
+    receive() when the connection becomes readable (see fileno()). Once the
+    process isn't alive, the GUI should stop it and draw in process.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        # forking a process that runs GTK is unsafe
+        context = mp.get_context("spawn")
+        self._conn, child_conn = context.Pipe()
+        self._child_conn = child_conn
+        self._process = context.Process(target=serve, args=(child_conn,), daemon=True)
+        self._blocks: list[shared_memory.SharedMemory] = []
+        self._surfaces: list[cairo.ImageSurface] = []
+        self._block_size = 0, 0  # the width and height of the blocks
+        self._edits = 0  # the number of edits that are sent
+        self._front: int | None = None  # the block that is shown
+        self._front_frame: tuple[View, int] | None = None
+        self._in_flight: tuple[int, View, int] | None = None  # block, view, edits
+        self._pending: View | None = None
+        self._failed = False  # the child died or failed to handle a message
+        memory.budget.register("frames", self.memory_used)
+
+    def start(self):
+        self._process.start()
+        self._child_conn.close()
+        self._conn.send(("load", snapshot(self.model)))
+        self.model.render_process = self
+
+    def stop(self):
+        self.model.render_process = None
+        if self._process.is_alive():
+            self._send("quit")
+        self._process.join(timeout=5)
+        if self._process.is_alive():
+            self._process.terminate()
+        self._conn.close()
+        self._free_blocks()
+
+    @property
+    def alive(self) -> bool:
+        """Whether the child renders the views"""
+        return not self._failed and self._process.is_alive()
+
+    def _send(self, *message):
+        try:
+            self._conn.send(message)
+        except OSError:  # the child closed the pipe
+            self._fail("the render process died")
+
+    def _fail(self, reason: str):
+        logging.warning(f"Rendering in process: {reason}")
+        self._failed = True
+        self._in_flight = self._pending = None
+
+    def memory_used(self) -> int:
+        """Returns the bytes of the shared blocks, they are mapped by both
+        processes but counted once.
+        """
+        return sum(block.size for block in self._blocks)
+
+    def fileno(self) -> int:
+        """Readable when a render is done"""
+        return self._conn.fileno()
+
+    def changed(self, entry: dict):
+        """Sends an edit of the model to the child"""
+        self._edits += 1
+        if not self._failed:
+            self._send("edit", entry)
+
+    def _free_blocks(self):
+        self._surfaces.clear()  # they export the buffers of the blocks
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks.clear()
+        self._block_size = 0, 0
+        self._front = self._front_frame = None
+
+    def _allocate_blocks(self, view: View):
+        for block in self._blocks:
+            self._send("release", block.name)
+        self._free_blocks()
+        for _ in range(2):
+            block = shared_memory.SharedMemory(create=True, size=view.nbytes)
+            self._blocks.append(block)
+            self._surfaces.append(
+                cairo.ImageSurface.create_for_data(
+                    block.buf, cairo.FORMAT_ARGB32, view.width, view.height, view.stride
+                )
+            )
+        self._block_size = view.width, view.height
+
+    def request(self, view: View):
+        """Renders view when it, or the model, differs from the frame that is
+        shown or being rendered. Only one render is in flight, the newest
+        request waits for it.
+        """
+        if not view.width or not view.height or not self.alive:
+            return
+        if self._in_flight:
+            _, flight_view, edits = self._in_flight
+            if (flight_view, edits) != (view, self._edits):
+                self._pending = view
+            return
+        if self._front_frame == (view, self._edits):
+            return
+        if self._block_size != (view.width, view.height):
+            self._allocate_blocks(view)
+        back = 1 if self._front == 0 else 0
+        self._in_flight = back, view, self._edits
+        self._send("render", self._blocks[back].name, view, self._edits)
+
+    def receive(self) -> bool:
+        """Handles the messages of the child, returns whether a new frame
+        can be shown.
+        """
+        new_frame = False
+        try:
+            while not self._failed and self._conn.poll():
+                op, *args = self._conn.recv()
+                if op == "done" and self._in_flight:
+                    back, view, edits = self._in_flight
+                    self._in_flight = None
+                    self._front, self._front_frame = back, (view, edits)
+                    new_frame = True
+                elif op == "error":
+                    self._fail(f"{args[0]} failed in the render process\n{args[1]}")
+        except (EOFError, OSError):
+            self._fail("the render process died")
+        if self._failed:
+            return False
+        if new_frame and self._pending:
+            view, self._pending = self._pending, None
+            self.request(view)
+        return new_frame
+
+    def frame(self) -> tuple[cairo.ImageSurface, View] | None:
+        """Returns the surface that wraps the newest frame and its view"""
+        if self._front is None:
+            return None
+        return self._surfaces[self._front], self._front_frame[0]
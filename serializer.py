@@ -2,17 +2,30 @@
 
 from collections.abc import Callable
 
+# Every serialized object carries its type in this field
+TYPE_KEY = "__type__"
+# Objects with this field contain a list of objects in a columnar layout
+BULK_KEY = "__bulk__"
+
 
 class _CustomSerializer:
     """Serializers objects to json, the types must be register a function before
     this class know how to serialize them
+
+    Types may also register a bulk function, it encodes a list of instances
+    as one object with parallel arrays (columns) for each field.
     """
 
     def __init__(self):
         self.class_serializers = {}
+        self.bulk_serializers = {}
 
-    def register_serializer(self, tp: type, function: Callable):
+    def register_serializer(
+        self, tp: type, function: Callable, bulk_function: Callable | None = None
+    ):
         self.class_serializers[tp] = function
+        if bulk_function:
+            self.bulk_serializers[tp] = bulk_function
 
     def __call__(self, obj: object) -> dict:
         tp = type(obj)
@@ -20,23 +33,62 @@ class _CustomSerializer:
             raise TypeError(f"We don't know how to serialize an instance of {tp}")
         return self.class_serializers[tp](obj)
 
+    def pack(self, obj: object) -> object:
+        """Replaces the homogeneous lists in obj by their columnar form
+
+        json only calls us for objects it cannot serialize itself, so lists
+        should be packed before they are handed to json.dumps.
+        """
+        if isinstance(obj, dict):
+            return {key: self.pack(value) for key, value in obj.items()}
+        if isinstance(obj, list):
+            if obj:
+                tp = type(obj[0])
+                if tp in self.bulk_serializers and all(type(o) is tp for o in obj):
+                    return self.bulk_serializers[tp](obj)
+            return [self.pack(value) for value in obj]
+        return obj
+
 
 class _CustomDeSerializer:
     """DeSerializes json to python object, the types must register a function before
     this class knows how to deserialize them into python objects
+
+    The function is looked up using the value of the TYPE_KEY field of the
+    json object. Older files used a type specific key instead; these keys
+    may be registered as legacy keys.
     """
 
     def __init__(self):
-        self.deserializer_keys = {}
+        self.deserializer_tags = {}
+        self.bulk_deserializer_tags = {}
+        self.legacy_keys = {}
+
+    def register_deserializer(
+        self, tag: str, function: Callable, bulk_function: Callable | None = None
+    ):
+        self.deserializer_tags[tag] = function
+        if bulk_function:
+            self.bulk_deserializer_tags[tag] = bulk_function
 
-    def register_deserializer(self, json_str: str, function: Callable):
-        self.deserializer_keys[json_str] = function
+    def register_legacy_key(self, json_str: str, tag: str):
+        """Objects containing json_str are deserialized as if they had tag"""
+        self.legacy_keys[json_str] = tag
 
     def __call__(self, dct) -> object:
-        for key in self.deserializer_keys.keys():
-            if key in dct:
-                return self.deserializer_keys[key](dct)
-        return dct
+        tag = dct.get(TYPE_KEY)
+        if tag is None:
+            for key, legacy_tag in self.legacy_keys.items():
+                if key in dct:
+                    return self.deserializer_tags[legacy_tag](dct)
+            return dct
+        if BULK_KEY in dct:
+            function = self.bulk_deserializer_tags.get(tag)
+        else:
+            function = self.deserializer_tags.get(tag)
+        if function is None:
+            return dct
+        return function(dct)
 
 
 serializer = _CustomSerializer()
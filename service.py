@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+"""A local service that renders worksheets on demand
+
+The service speaks a minimal HTTP/1.0 on localhost or on a unix socket:
+
+    POST /render?format=png   with a draw.json as body returns the png
+    POST /render?format=pdf   returns the pdf
+    GET /stats                returns the queue depth and latencies as json
+
+The worksheets are drawn by a pool of worker processes that have imported GI
+and loaded the fonts before the first request. A worker keeps the decoded
+source images of the most recent worksheets, so variants of a worksheet don't
+decode the image again. Identical requests that arrive while one of them is
+being rendered share its result.
+"""
+from __future__ import annotations
+
+import argparse as ap
+import asyncio
+from collections import OrderedDict, deque
+from collections.abc import Callable
+from concurrent.futures import Executor, ProcessPoolExecutor
+import hashlib
+import ipaddress
+import json
+import logging
+import math as m
+import os
+import os.path as p
+import time
+from urllib.parse import parse_qs, urlsplit
+
+DEFAULT_PORT = 8765
+MAX_PAYLOAD = 16 * 1024 * 1024
+FORMATS = {"png": "image/png", "pdf": "application/pdf"}
+MAX_MODELS = 8  # the number of decoded source images a worker keeps
+
+_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+}
+
+# (path, mtime) -> model with the decoded image, one per worker process
+_models: OrderedDict[tuple[str, float], object] = OrderedDict()
+
+
+def init_worker():
+    """Imports GI and lets Pango load the fonts, so the first request of a
+    worker doesn't pay for it. The modules are imported here, the server
+    itself doesn't need GI.
+    """
+    import image
+
+    image.TextMeasure().size("a")
+
+
+def _ping() -> int:
+    return os.getpid()
+
+
+def render_worksheet(payload: bytes, fmt: str) -> bytes:
+    """Renders the draw.json in payload as fmt, runs in a worker. Raises
+    ValueError when the payload isn't a json object.
+    """
+    import serializer
+
+    d = json.loads(payload, object_hook=serializer.deserializer)
+    if not isinstance(d, dict):
+        raise ValueError(f"The payload isn't a json object: {type(d).__name__}")
+    # the model needs GTK, a malformed payload is reported without it
+    from model import Model
+
+    path = d.get("path", "")
+    key = path, p.getmtime(path) if p.exists(path) else 0.0
+    base = _models.get(key)
+    if base is None:
+        base = Model(path=path)
+        _models[key] = base
+        if len(_models) > MAX_MODELS:
+            _models.popitem(last=False)
+    _models.move_to_end(key)
+
+    model = base.derive(**d)
+    model.load_font_descs()
+    if fmt == "pdf":
+        return model.rec_surf.render_pdf()
+    return model.rec_surf.render_png()
+
+
+def request_key(payload: bytes, fmt: str) -> str:
+    """Returns a key that is equal for requests with the same result"""
+    canonical = json.dumps(json.loads(payload), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(f"{fmt}:{canonical}".encode("utf8")).hexdigest()
+
+
+class LatencyStats:
+    """Percentiles of the most recent latencies"""
+
+    def __init__(self, size: int = 1000):
+        self.count = 0
+        self._samples: deque[float] = deque(maxlen=size)
+
+    def add(self, seconds: float):
+        self.count += 1
+        self._samples.append(seconds)
+
+    def percentile(self, q: float) -> float:
+        """Returns the q-th percentile (0 - 100) using the nearest rank"""
+        if not self._samples:
+            return 0.0
+        samples = sorted(self._samples)
+        rank = max(1, m.ceil(len(samples) * q / 100))
+        return samples[rank - 1]
+
+    def report(self) -> dict:
+        return {
+            "count": self.count,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "max": max(self._samples, default=0.0),
+        }
+
+
+class RenderService:
+    """Dispatches render requests to a pool of workers and coalesces the
+    identical ones that are in flight.
+    """
+
+    def __init__(
+        self,
+        workers: int | None = None,
+        executor: Executor | None = None,
+        render: Callable[[bytes, str], bytes] = render_worksheet,
+    ):
+        self.workers = workers or os.cpu_count() or 1
+        if executor is None:
+            executor = ProcessPoolExecutor(self.workers, initializer=init_worker)
+        self.executor = executor
+        self.render_function = render
+        self.coalesced = 0
+        self.errors = 0
+        self.latency = LatencyStats()
+        self._in_flight: dict[str, asyncio.Future] = {}
+
+    @property
+    def in_flight(self) -> int:
+        """The number of distinct renders that are submitted to the workers"""
+        return len(self._in_flight)
+
+    @property
+    def queue_depth(self) -> int:
+        """The number of renders that wait for a free worker"""
+        return max(0, self.in_flight - self.workers)
+
+    async def warm(self):
+        """Starts all workers, so they are warm before the first request"""
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(
+            *(loop.run_in_executor(self.executor, _ping) for _ in range(self.workers))
+        )
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+
+    async def render(self, payload: bytes, fmt: str) -> bytes:
+        """Returns the rendering of payload, raises ValueError for an invalid
+        format or payload.
+        """
+        if fmt not in FORMATS:
+            raise ValueError(f"Unsupported format: {fmt}")
+        key = request_key(payload, fmt)
+        future = self._in_flight.get(key)
+        if future is not None:
+            self.coalesced += 1
+        else:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(
+                self.executor, self.render_function, payload, fmt
+            )
+            self._in_flight[key] = future
+            # a request that is cancelled doesn't cancel the render of the others
+            future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        return await asyncio.shield(future)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth,
+            "coalesced": self.coalesced,
+            "errors": self.errors,
+            "latency": self.latency.report(),
+        }
+
+    async def _dispatch(self, method: str, target: str, body: bytes):
+        url = urlsplit(target)
+        if url.path == "/stats":
+            if method != "GET":
+                return 405, "text/plain", b"use GET"
+            return 200, "application/json", json.dumps(self.stats()).encode("utf8")
+        if url.path != "/render":
+            return 404, "text/plain", b"not found"
+        if method != "POST":
+            return 405, "text/plain", b"use POST"
+
+        fmt = parse_qs(url.query).get("format", ["png"])[0]
+        start = time.perf_counter()
+        try:
+            data = await self.render(body, fmt)
+        except (ValueError, KeyError, TypeError) as e:
+            self.errors += 1
+            return 400, "text/plain", str(e).encode("utf8")
+        except Exception as e:
+            self.errors += 1
+            logging.exception("Unable to render a worksheet")
+            return 500, "text/plain", str(e).encode("utf8")
+        self.latency.add(time.perf_counter() - start)
+        return 200, FORMATS[fmt], data
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Serves one request per connection"""
+        try:
+            try:
+                method, target, _ = (await reader.readline()).decode("latin1").split()
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = line.decode("latin1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+                if length < 0:
+                    raise ValueError(f"negative content length: {length}")
+            except ValueError:
+                status, content_type, data = 400, "text/plain", b"malformed request"
+            else:
+                if length > MAX_PAYLOAD:
+                    status, content_type, data = 413, "text/plain", b"too large"
+                else:
+                    body = await reader.readexactly(length)
+                    status, content_type, data = await self._dispatch(
+                        method, target, body
+                    )
+            writer.write(
+                f"HTTP/1.0 {status} {_REASONS[status]}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(data)}\r\n"
+                "Connection: close\r\n\r\n".encode("latin1")
+            )
+            writer.write(data)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass  # the client went away
+        finally:
+            writer.close()
+
+
+def is_local(host: str) -> bool:
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+async def serve(service: RenderService, host: str, port: int, socket: str = ""):
+    """Serves on a unix socket when given, otherwise on host:port. Only
+    loopback addresses are accepted.
+    """
+    if socket:
+        server = await asyncio.start_unix_server(service.handle, socket)
+    else:
+        if not is_local(host):
+            raise ValueError(f"Only serving on localhost, not on {host}")
+        server = await asyncio.start_server(service.handle, host, port)
+    await service.warm()
+    for sock in server.sockets:
+        logging.info(f"Serving on {sock.getsockname()}")
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    """Run the render service"""
+    parser = ap.ArgumentParser(
+        "service.py", description="render worksheets on localhost"
+    )
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("-p", "--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument(
+        "-s", "--socket", type=str, default="", help="serve on a unix socket"
+    )
+    parser.add_argument(
+        "-w", "--workers", type=int, default=0, help="default: the number of cpus"
+    )
+
+    args = parser.parse_args()
+    if not args.socket and not is_local(args.host):
+        parser.error(f"{args.host} is not a loopback address")
+
+    logging.basicConfig(level=logging.INFO)
+    service = RenderService(args.workers)
+    try:
+        asyncio.run(serve(service, args.host, args.port, args.socket))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -61,7 +61,8 @@ class Point2D(TwoD):
             raise TypeError("Other is {type(other)}, Point2D was expected")
 
 
-_POINT_JSON_KEY = "__Point2D__"
+_POINT_TAG = "Point2D"
+_POINT_LEGACY_KEY = "__Point2D__"
 
 
 def _json_serialize_point2d(point: Point2D):
@@ -69,21 +70,34 @@ def _json_serialize_point2d(point: Point2D):
         raise TypeError(
             f"Oops point is of {type(point)}, we expected a instance of {Point2D}"
         )
-    return {_POINT_JSON_KEY: True, "x": point.x, "y": point.y}
+    return {serializer.TYPE_KEY: _POINT_TAG, "x": point.x, "y": point.y}
 
 
 def _json_deserialize_point2d(dct):
-    if _POINT_JSON_KEY in dct:
-        point = Point2D(dct["x"], dct["y"])
-        return point
-    return dct
+    return Point2D(dct["x"], dct["y"])
+
+
+def _json_bulk_serialize_point2d(points: list[Point2D]):
+    return {
+        serializer.TYPE_KEY: _POINT_TAG,
+        serializer.BULK_KEY: True,
+        "x": [point.x for point in points],
+        "y": [point.y for point in points],
+    }
+
+
+def _json_bulk_deserialize_point2d(dct):
+    return [Point2D(x, y) for x, y in zip(dct["x"], dct["y"])]
 
 
 # Add support for serializing points
-serializer.serializer.register_serializer(Point2D, _json_serialize_point2d)
+serializer.serializer.register_serializer(
+    Point2D, _json_serialize_point2d, _json_bulk_serialize_point2d
+)
 serializer.deserializer.register_deserializer(
-    _POINT_JSON_KEY, _json_deserialize_point2d
+    _POINT_TAG, _json_deserialize_point2d, _json_bulk_deserialize_point2d
 )
+serializer.deserializer.register_legacy_key(_POINT_LEGACY_KEY, _POINT_TAG)
 
 
 class Vector2D(TwoD):
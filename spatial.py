@@ -0,0 +1,184 @@
+"""Indices to quickly find the items that are located around a position and to
+test whether a position is inside a polygon
+"""
+from __future__ import annotations
+
+from collections.abc import Hashable
+import itertools
+import math as m
+
+# An axis aligned bounding box: x0, y0, x1, y1 with x0 <= x1 and y0 <= y1
+Box = tuple[float, float, float, float]
+
+
+class GridIndex:
+    """Spatial index that buckets axis aligned bounding boxes in a uniform grid
+
+    Every item is registered in each cell that its box overlaps. Looking up the
+    items at a position only examines the items in one cell, so picking doesn't
+    depend on the total number of items. Items are drawn in the order in which
+    they are inserted, hence items that are inserted later are on top.
+    """
+
+    def __init__(self, cell_size: float = 128.0):
+        if cell_size <= 0:
+            raise ValueError(f"cell_size should be positive, not {cell_size}")
+        self.cell_size = cell_size
+        self._cells: dict[tuple[int, int], set[Hashable]] = {}
+        self._boxes: dict[Hashable, Box] = {}
+        self._order: dict[Hashable, int] = {}
+        self._counter = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self._boxes)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._boxes
+
+    def box(self, key: Hashable) -> Box:
+        """Returns the bounding box of key"""
+        return self._boxes[key]
+
+    def _cell_range(self, box: Box):
+        x0, y0, x1, y1 = box
+        size = self.cell_size
+        for cx in range(m.floor(x0 / size), m.floor(x1 / size) + 1):
+            for cy in range(m.floor(y0 / size), m.floor(y1 / size) + 1):
+                yield cx, cy
+
+    def _add_to_cells(self, key: Hashable, box: Box):
+        for cell in self._cell_range(box):
+            self._cells.setdefault(cell, set()).add(key)
+
+    def _remove_from_cells(self, key: Hashable, box: Box):
+        for cell in self._cell_range(box):
+            bucket = self._cells[cell]
+            bucket.discard(key)
+            if not bucket:
+                del self._cells[cell]
+
+    def insert(self, key: Hashable, box: Box):
+        """Adds key to the index, when key is present it is moved to box"""
+        if key in self._boxes:
+            self.move(key, box)
+            return
+        self._boxes[key] = box
+        self._order[key] = next(self._counter)
+        self._add_to_cells(key, box)
+
+    def move(self, key: Hashable, box: Box):
+        """Updates the box of key, the stacking order is retained"""
+        old = self._boxes[key]
+        if old == box:
+            return
+        self._remove_from_cells(key, old)
+        self._boxes[key] = box
+        self._add_to_cells(key, box)
+
+    def remove(self, key: Hashable):
+        """Removes key from the index, raises a KeyError when absent"""
+        box = self._boxes.pop(key)
+        del self._order[key]
+        self._remove_from_cells(key, box)
+
+    def discard(self, key: Hashable):
+        """Removes key from the index when present"""
+        if key in self._boxes:
+            self.remove(key)
+
+    def clear(self):
+        self._cells.clear()
+        self._boxes.clear()
+        self._order.clear()
+
+    def query_point(self, x: float, y: float) -> list[Hashable]:
+        """Returns the keys whose box contains (x, y), the topmost comes first"""
+        cell = m.floor(x / self.cell_size), m.floor(y / self.cell_size)
+        hits = []
+        for key in self._cells.get(cell, ()):
+            x0, y0, x1, y1 = self._boxes[key]
+            if x0 <= x <= x1 and y0 <= y <= y1:
+                hits.append(key)
+        hits.sort(key=self._order.__getitem__, reverse=True)
+        return hits
+
+    def query_rect(self, box: Box) -> list[Hashable]:
+        """Returns the keys whose box overlaps with box, the topmost comes first"""
+        x0, y0, x1, y1 = box
+        candidates = set()
+        for cell in self._cell_range(box):
+            candidates.update(self._cells.get(cell, ()))
+        hits = []
+        for key in candidates:
+            kx0, ky0, kx1, ky1 = self._boxes[key]
+            if kx0 <= x1 and x0 <= kx1 and ky0 <= y1 and y0 <= ky1:
+                hits.append(key)
+        hits.sort(key=self._order.__getitem__, reverse=True)
+        return hits
+
+    def pick(self, x: float, y: float) -> Hashable | None:
+        """Returns the topmost key at (x, y) or None when there is none"""
+        hits = self.query_point(x, y)
+        return hits[0] if hits else None
+
+
+class PolygonIndex:
+    """Tests whether points are inside a closed polygon
+
+    The nonzero winding rule is used, just like cairo's default fill rule.
+    The edges are bucketed in horizontal bands, so a test only considers the
+    edges that cross the band of the point.
+    """
+
+    def __init__(self, points: list[tuple[float, float]], band_height: float = 64.0):
+        if band_height <= 0:
+            raise ValueError(f"band_height should be positive, not {band_height}")
+        self.band_height = band_height
+        self._bands: dict[int, list[tuple[float, float, float, float]]] = {}
+        self._box = None
+        if len(points) < 3:
+            return
+
+        xs = [x for x, _ in points]
+        ys = [y for _, y in points]
+        self._box = min(xs), min(ys), max(xs), max(ys)
+
+        for (x0, y0), (x1, y1) in zip(points, points[1:] + points[:1]):
+            if y0 == y1:  # horizontal edges never cross a horizontal ray
+                continue
+            edge = x0, y0, x1, y1
+            low, high = min(y0, y1), max(y0, y1)
+            for band in range(
+                m.floor(low / band_height), m.floor(high / band_height) + 1
+            ):
+                self._bands.setdefault(band, []).append(edge)
+
+    def contains(self, x: float, y: float) -> bool:
+        if not self._box:
+            return False
+        bx0, by0, bx1, by1 = self._box
+        if not (bx0 <= x <= bx1 and by0 <= y <= by1):
+            return False
+
+        winding = 0
+        for x0, y0, x1, y1 in self._bands.get(m.floor(y / self.band_height), ()):
+            is_left = (x1 - x0) * (y - y0) - (x - x0) * (y1 - y0)
+            if y0 <= y < y1 and is_left > 0:  # upward edge, point on the left
+                winding += 1
+            elif y1 <= y < y0 and is_left < 0:  # downward edge, point on the right
+                winding -= 1
+        return winding != 0
+
+    def overlaps(self, box: Box) -> bool:
+        """Tests whether the corners or the center of box are inside"""
+        x0, y0, x1, y1 = box
+        return any(
+            self.contains(x, y)
+            for x, y in (
+                ((x0 + x1) / 2, (y0 + y1) / 2),
+                (x0, y0),
+                (x1, y0),
+                (x0, y1),
+                (x1, y1),
+            )
+        )
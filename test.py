@@ -1,9 +1,52 @@
 #!/usr/bin/env python3
 from space import Point2D, Vector2D
+from spatial import GridIndex, PolygonIndex
+from distractors import Distractor
+import serializer
+import binformat
+import library
+import autosave
+from history import Chunked, State
+import events
+import rendercache
+from rendercache import RenderCache
+import service
+import profiling
+import memory
+import lineart
+import mipmap
+import netpbm
+import benchmark
+from pngwriter import PngWriter
+from PIL import Image
+import io
 import unittest as unit
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import sys
+import os.path
+import tempfile
+import time
 import math as m
 import random
 
+try:
+    import glyphatlas
+    import golden
+    import image
+    from model import Model
+    import renderproc
+except (ImportError, ValueError):  # cairo or the GTK typelibs are missing
+    Model = None
+
+try:
+    import draw
+except ImportError:  # cairo is missing
+    draw = None
+
 
 class TestPoint2D(unit.TestCase):
     """Tests various properties of points in 2d space"""
@@ -114,5 +157,1032 @@ class TestVector2D(unit.TestCase):
             self.assertAlmostEqual(vorg.y, v1.y)
 
 
+class TestGridIndex(unit.TestCase):
+    """Tests picking of boxes in the spatial index"""
+
+    def test_pick(self):
+        index = GridIndex(cell_size=10)
+        index.insert("a", (0, 0, 15, 15))
+        index.insert("b", (10, 10, 25, 25))
+        self.assertEqual(index.pick(5, 5), "a")
+        self.assertEqual(index.pick(12, 12), "b", "later inserts are on top")
+        self.assertEqual(index.query_point(12, 12), ["b", "a"])
+        self.assertIsNone(index.pick(40, 40))
+        self.assertIsNone(index.pick(-5, 5))
+
+    def test_move_and_remove(self):
+        index = GridIndex(cell_size=10)
+        index.insert("a", (0, 0, 5, 5))
+        index.insert("b", (0, 0, 5, 5))
+        index.move("b", (100, 100, 105, 105))
+        self.assertEqual(index.pick(2, 2), "a")
+        self.assertEqual(index.pick(102, 102), "b")
+        index.remove("a")
+        self.assertIsNone(index.pick(2, 2))
+        self.assertEqual(len(index), 1)
+        self.assertRaises(KeyError, lambda: index.remove("a"))
+        self.assertEqual(index.query_rect((90, 90, 100, 100)), ["b"])
+
+
+class TestPolygonIndex(unit.TestCase):
+    """Tests the point in polygon test of the exclusion path"""
+
+    def test_square(self):
+        square = PolygonIndex([(0, 0), (100, 0), (100, 100), (0, 100)], 10)
+        self.assertTrue(square.contains(50, 50))
+        self.assertTrue(square.contains(1, 99))
+        self.assertFalse(square.contains(150, 50))
+        self.assertFalse(square.contains(50, -1))
+        self.assertTrue(square.overlaps((90, 90, 200, 200)))
+        self.assertFalse(square.overlaps((110, 0, 200, 100)))
+
+    def test_nonzero_winding(self):
+        # the path goes around the inner square twice, like cairo it's filled
+        outer = [(0, 0), (100, 0), (100, 100), (0, 100)]
+        path = outer + [(0, 0)] + outer
+        self.assertTrue(PolygonIndex(path).contains(50, 50))
+        self.assertFalse(PolygonIndex([(0, 0), (10, 10)]).contains(5, 5))
+
+
+class TestSerializer(unit.TestCase):
+    """Tests the (de)serialization of the registered types"""
+
+    def round_trip(self, obj):
+        text = json.dumps(
+            serializer.serializer.pack(obj), default=serializer.serializer
+        )
+        return json.loads(text, object_hook=serializer.deserializer)
+
+    def test_points(self):
+        points = [Point2D(i, i * 2.5) for i in range(10)]
+        packed = serializer.serializer.pack({"path": points})
+        self.assertIn(serializer.BULK_KEY, packed["path"])
+        self.assertEqual(self.round_trip({"path": points}), {"path": points})
+        self.assertEqual(self.round_trip(Point2D(1, 2)), Point2D(1, 2))
+        self.assertEqual(self.round_trip([]), [])
+
+    def test_distractors(self):
+        distractors = [Distractor(s, Point2D(i, i + 1)) for i, s in enumerate("abc")]
+        result = self.round_trip(distractors)
+        self.assertEqual([d.string for d in result], ["a", "b", "c"])
+        self.assertEqual([d.pos for d in result], [d.pos for d in distractors])
+
+    def test_mixed_list(self):
+        mixed = [Point2D(1, 2), Distractor("a", Point2D(3, 4))]
+        result = self.round_trip(mixed)
+        self.assertEqual(result[0], Point2D(1, 2))
+        self.assertEqual(result[1].string, "a")
+
+    def test_legacy(self):
+        text = """{
+            "exclusion_path": [{"__Point2D__": true, "x": 1.0, "y": 2.0}],
+            "distractors": [
+                {"__distractor__": true, "string": "q", "pos_x": 3, "pos_y": 4}
+            ]
+        }"""
+        d = json.loads(text, object_hook=serializer.deserializer)
+        self.assertEqual(d["exclusion_path"], [Point2D(1, 2)])
+        self.assertEqual(d["distractors"][0].string, "q")
+        self.assertEqual(d["distractors"][0].pos, Point2D(3, 4))
+
+
+class TestBinaryWorksheet(unit.TestCase):
+    """Tests the conversion between json and binary worksheets"""
+
+    def setUp(self):
+        self.d = {
+            "path": "",
+            "name": "näme",
+            "word": "boom",
+            "word_x": 1.5,
+            "word_y": -3.25,
+            "img_x": 1240.0,
+            "img_y": 1754.0,
+            "font": "sans bold 60",
+            "distractor_font": "",
+            "show_path": True,
+            "close_path": False,
+            "paper": (297.0, 420.0),
+            "dpi": 150,
+            "line_art": {"edges": "dog", "threshold": 40},
+            "exclusion_path": [Point2D(i / 3, i * 7.1) for i in range(25)],
+            "distractors": [
+                Distractor(s, Point2D(random.random(), random.random()))
+                for s in "abcabcxyz"
+            ],
+        }
+
+    def test_round_trip(self):
+        data = binformat.dumps(self.d, b"thumb")
+        self.assertTrue(binformat.is_worksheet(data))
+        sheet = binformat.loads(data)
+        result = sheet.as_dict()
+        for key in self.d:
+            if key != "distractors":
+                self.assertEqual(result[key], self.d[key], key)
+        self.assertEqual(
+            [(d.string, d.pos) for d in result["distractors"]],
+            [(d.string, d.pos) for d in self.d["distractors"]],
+        )
+        self.assertEqual(sheet.thumbnail, b"thumb")
+        self.assertEqual(len(sheet.path_coords), 50)
+
+    def test_json_equivalence(self):
+        sheet = binformat.loads(binformat.dumps(self.d))
+        packed = serializer.serializer.pack(sheet.as_dict())
+        expected = serializer.serializer.pack(self.d)
+        self.assertEqual(
+            json.dumps(packed, default=serializer.serializer),
+            json.dumps(expected, default=serializer.serializer),
+        )
+
+    def test_paper(self):
+        sheet = binformat.loads(binformat.dumps(self.d))
+        self.assertEqual((sheet.paper, sheet.dpi), ((297.0, 420.0), 150))
+        self.assertEqual(sheet.line_art, {"edges": "dog", "threshold": 40})
+
+        del self.d["paper"], self.d["dpi"], self.d["line_art"]
+        data = binformat.dumps(self.d)
+        self.assertNotIn("dpi", binformat.loads(data).as_dict())
+        self.assertNotIn("line_art", binformat.loads(data).as_dict())
+        # version 1 had no paper and dpi in its header
+        fields = binformat._HEADER.unpack_from(data)
+        header = binformat._HEADER_V1.pack(fields[0], 1, *fields[2:-3])
+        sheet = binformat.loads(header + data[binformat._HEADER.size :])
+        self.assertEqual((sheet.version, sheet.dpi), (1, None))
+        self.assertEqual(sheet.word, "boom")
+        self.assertEqual(len(sheet.distractors), 9)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, lambda: binformat.loads(b"{}"))
+        data = binformat.dumps(self.d, b"thumbnail")
+        self.assertRaises(ValueError, lambda: binformat.loads(data[:-4]))
+
+    def test_truncated(self):
+        data = binformat.dumps(self.d)
+        # the table of string offsets follows the header
+        for size in (binformat._HEADER.size, binformat._HEADER.size + 8):
+            self.assertRaises(ValueError, lambda: binformat.loads(data[:size]))
+
+    def test_load(self):
+        with tempfile.TemporaryDirectory() as directory:
+            fn = os.path.join(directory, "sheet" + binformat.EXTENSION)
+            binformat.save(fn, self.d, b"thumb")
+            with binformat.load(fn) as sheet:
+                self.assertEqual(sheet.word, "boom")
+                self.assertEqual(sheet.thumbnail, b"thumb")
+                self.assertEqual(len(sheet.distractors), len(self.d["distractors"]))
+            # the file is unmapped, so it can be replaced
+            self.assertRaises(ValueError, lambda: sheet.word)
+            autosave.atomic_write(fn, binformat.dumps(self.d))
+            json_fn = os.path.join(directory, "draw.json")
+            with open(json_fn, "w") as out:
+                out.write("{}")
+            self.assertRaises(ValueError, lambda: binformat.load(json_fn))
+
+
+class _JournaledModel:
+    """Implements the parts of model.Model that the AutoSaver uses"""
+
+    def __init__(self, fn):
+        self.config_name = fn
+        self.autosaver = None
+        self.word = ""
+        self.distractors = []
+        self.exclusion_path = []
+
+    def add_path_point(self, point):
+        self.exclusion_path.append(point)
+        if self.autosaver:
+            self.autosaver.changed({"op": "add_path_point", "x": point.x, "y": point.y})
+
+    def serialize(self):
+        d = {"word": self.word, "exclusion_path": self.exclusion_path}
+        return json.dumps(d, default=serializer.serializer).encode("utf8")
+
+
+class TestAutoSave(unit.TestCase):
+    """Tests journaling and recovery of edits"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.fn = os.path.join(self.tmpdir.name, "draw.json")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_atomic_write(self):
+        autosave.atomic_write(self.fn, b"first")
+        autosave.atomic_write(self.fn, b"second")
+        with open(self.fn, "rb") as f:
+            self.assertEqual(f.read(), b"second")
+        self.assertEqual(os.listdir(self.tmpdir.name), ["draw.json"])
+
+    def schedule(self, delay, function):
+        self.scheduled = function
+        return lambda: setattr(self, "scheduled", None)
+
+    def test_recover(self):
+        model = _JournaledModel(self.fn)
+        saver = autosave.AutoSaver(model, schedule=self.schedule)
+        saver.start()
+        model.add_path_point(Point2D(1, 2))
+        saver.changed({"op": "set", "field": "word", "value": "boom"})
+        model.add_path_point(Point2D(3, 4))
+        self.assertIsNotNone(self.scheduled)
+        saver.journal.close()  # crash before the snapshot
+
+        recovered = _JournaledModel(self.fn)
+        saver = autosave.AutoSaver(recovered)
+        self.assertEqual(saver.recover(), 3)
+        self.assertEqual(recovered.word, "boom")
+        self.assertEqual(recovered.exclusion_path, [Point2D(1, 2), Point2D(3, 4)])
+
+        saver.snapshot()
+        saver.journal.close()
+        self.assertEqual(autosave.AutoSaver(_JournaledModel(self.fn)).recover(), 0)
+
+    def test_unchanged(self):
+        autosave.atomic_write(self.fn, b"not json")
+        mtime = os.path.getmtime(self.fn)
+        saver = autosave.AutoSaver(_JournaledModel(self.fn), schedule=self.schedule)
+        saver.start()
+        saver.stop()
+        with open(self.fn, "rb") as f:
+            self.assertEqual(f.read(), b"not json")
+        self.assertEqual(os.path.getmtime(self.fn), mtime)
+        self.assertEqual(os.listdir(self.tmpdir.name), ["draw.json"])
+
+    def test_scheduled_snapshot(self):
+        model = _JournaledModel(self.fn)
+        saver = autosave.AutoSaver(model, schedule=self.schedule)
+        saver.start()
+        model.add_path_point(Point2D(1, 2))
+        self.scheduled()
+        saver.journal.close()
+
+        with open(self.fn, "rb") as f:
+            self.assertEqual(f.read(), model.serialize())
+        self.assertEqual(autosave.AutoSaver(_JournaledModel(self.fn)).recover(), 0)
+
+
+@unit.skipIf(Model is None, "needs cairo and GTK")
+class TestRecImage(unit.TestCase):
+    """Tests the rasterization of the recording"""
+
+    def test_threads(self):
+        rng = random.Random(2)
+        model = Model(
+            word="boom",
+            show_path=True,
+            exclusion_path=[Point2D(100, 100), Point2D(900, 300), Point2D(400, 900)],
+            distractors=[
+                Distractor(s, Point2D(rng.uniform(0, 2480), rng.uniform(0, 3508)))
+                for s in "abcdefgh" * 20
+            ],
+        )
+        model.dpi = 150
+        band_bytes = image.BAND_BYTES
+        image.BAND_BYTES = 64 * 1024  # many bands
+        try:
+            serial, threaded = io.BytesIO(), io.BytesIO()
+            model.rec_surf.write_png(serial, threads=1)
+            model.rec_surf.write_png(threaded, threads=4)
+        finally:
+            image.BAND_BYTES = band_bytes
+        self.assertEqual(serial.getvalue(), threaded.getvalue())
+
+
+class TestLineArt(unit.TestCase):
+    """Tests the stages of the line art conversion"""
+
+    def setUp(self):
+        # a dark red square on a light background
+        self.im = Image.new("RGB", (32, 32), (230, 220, 210))
+        self.im.paste((120, 10, 10), (8, 8, 24, 24))
+
+    def test_defaults(self):
+        pars = lineart.LineArtParameters()
+        for _, stage in lineart.STAGES:
+            self.assertIs(stage(self.im, pars), self.im)
+        self.assertRaises(ValueError, lambda: lineart.LineArtParameters(edges="x"))
+
+    def test_threshold(self):
+        pars = lineart.LineArtParameters(threshold=128)
+        result = lineart.threshold(self.im, pars)
+        # the red is dark, though its red channel is 120
+        self.assertEqual(result.mode, "L")
+        self.assertEqual(result.getpixel((16, 16)), 0)
+        self.assertEqual(result.getpixel((0, 0)), 255)
+
+    def test_edges(self):
+        for edges in ("sobel", "dog"):
+            pars = lineart.LineArtParameters(edges=edges, threshold=30)
+            strength = lineart.edges(self.im, pars)
+            self.assertEqual(strength.mode, "L")
+            self.assertGreater(strength.getpixel((8, 16)), 30, edges)
+            # the kernels leave the border pixels as they are
+            self.assertEqual(strength.getpixel((3, 3)), 0, edges)
+            self.assertEqual(strength.getpixel((16, 16)), 0, edges)
+            # black lines on white
+            lines = lineart.threshold(strength, pars)
+            self.assertEqual(lines.getpixel((8, 16)), 0, edges)
+            self.assertEqual(lines.getpixel((3, 3)), 255, edges)
+
+    def test_lighten(self):
+        grey = lineart.greyscale(self.im, lineart.LineArtParameters(greyscale=True))
+        self.assertEqual(grey.mode, "L")
+        light = lineart.lighten(grey, lineart.LineArtParameters(lighten=0.5))
+        v = grey.getpixel((16, 16))
+        self.assertEqual(light.getpixel((16, 16)), round(v + (255 - v) / 2))
+
+    def test_pipeline(self):
+        with tempfile.TemporaryDirectory() as directory:
+            fn = os.path.join(directory, "square.png")
+            self.im.save(fn)
+            pipeline = lineart.LineArtPipeline()
+            pars = lineart.LineArtParameters(greyscale=True, threshold=100)
+            first = pipeline.process(fn, pars)
+            self.assertIs(pipeline.process(fn, pars), first)
+
+            # the decoded and the greyscale image are reused
+            hits = pipeline.hits
+            pipeline.process(fn, lineart.LineArtParameters(greyscale=True))
+            self.assertEqual(pipeline.hits - hits, 2)
+            size = pipeline.size
+            self.assertEqual(pipeline.shrink(size), size)
+            self.assertEqual(pipeline.size, 0)
+
+
+class TestBenchmark(unit.TestCase):
+    """Tests the comparison of benchmark results"""
+
+    def test_compare(self):
+        def results(**medians):
+            return {"results": {k: {"median": v} for k, v in medians.items()}}
+
+        baseline = results(draw=1.0, save=0.1, preview=0.5)
+        current = results(draw=1.1, save=0.2, export_png=3.0)
+        self.assertEqual(benchmark.compare(baseline, current), [("save", 0.1, 0.2)])
+        self.assertEqual(
+            benchmark.compare(baseline, current, threshold=0.05),
+            [("draw", 1.0, 1.1), ("save", 0.1, 0.2)],
+        )
+        self.assertEqual(benchmark.missing(baseline, current), ["preview"])
+        self.assertEqual(benchmark.missing(current, current), [])
+
+
+@unit.skipIf(Model is None, "needs cairo and GTK")
+class TestGlyphAtlas(unit.TestCase):
+    """Tests the cache of rasterized distractors"""
+
+    def test_oversized(self):
+        from gi.repository import Pango
+
+        atlas = glyphatlas.GlyphAtlas(300, page_size=128, max_pages=1)
+        font_desc = Pango.font_description_from_string("sans 8")
+        self.assertIsNotNone(atlas.glyph("a", font_desc, 1.0))
+        # it's stroked as vectors, the page of "a" is kept
+        self.assertIsNone(atlas.glyph("W" * 20, font_desc, 4.0))
+        self.assertEqual(len(atlas), 1)
+
+
+@unit.skipIf(Model is None, "needs cairo and GTK")
+class TestRenderProcess(unit.TestCase):
+    """Tests the loop of the child of the render process"""
+
+    def test_serve(self):
+        import multiprocessing as mp
+
+        conn, child_conn = mp.Pipe()
+        child = threading.Thread(target=renderproc.serve, args=(child_conn,))
+        child.start()
+        # a block that was never rendered into is released
+        conn.send(("release", "unattached"))
+        conn.send(("edit", {"op": "clear_path"}))  # there is no model
+        op, failed, trace = conn.recv()
+        self.assertEqual((op, failed), ("error", "edit"))
+        self.assertIn("AttributeError", trace)
+        conn.send(("quit",))
+        child.join(timeout=5)
+        self.assertFalse(child.is_alive())
+        conn.close()
+
+
+@unit.skipIf(Model is None, "needs cairo and GTK")
+class TestGolden(unit.TestCase):
+    """Tests the comparison of renders"""
+
+    def test_difference(self):
+        im = Image.new("RGB", (4, 4), (10, 20, 30))
+        self.assertEqual(golden.difference(im, im.copy()), 0)
+        self.assertEqual(golden.difference(im, Image.new("RGB", (4, 5))), -1)
+        changed = im.copy()
+        changed.putpixel((1, 2), (10, 27, 25))
+        self.assertEqual(golden.difference(im, changed), 7)
+        self.assertEqual(golden.mean_difference(im, Image.new("RGB", (4, 5))), -1)
+        self.assertAlmostEqual(golden.mean_difference(im, changed), 7 / 16)
+
+
+class TestMipmap(unit.TestCase):
+    """Tests the halving of the pixels of cairo surfaces"""
+
+    def test_rgb24(self):
+        # 3 x 3 pixels in the byte order of cairo, the unused byte is 0
+        pixels = [(10, 20, 30), (30, 40, 50), (200, 100, 0)] * 3
+        if sys.byteorder == "little":
+            data = b"".join(bytes([b, g, r, 0]) for r, g, b in pixels)
+        else:
+            data = b"".join(bytes([0, r, g, b]) for r, g, b in pixels)
+        half, width, height = mipmap.halve_pixels(data, 3, 3, 12, alpha=False)
+        self.assertEqual((width, height), (2, 2))
+        im = Image.frombytes("RGB", (2, 2), half, "raw", mipmap._RAW_RGB24)
+        self.assertEqual(im.getpixel((0, 0)), (20, 30, 40))
+        # the odd column is averaged on its own
+        self.assertEqual(im.getpixel((1, 1)), (200, 100, 0))
+
+    def test_argb32(self):
+        # a premultiplied half transparent pixel next to a transparent one
+        data = bytes([0, 0, 128, 128, 0, 0, 0, 0] * 2)
+        half, width, height = mipmap.halve_pixels(data, 2, 2, 8, alpha=True)
+        self.assertEqual((width, height), (1, 1))
+        self.assertEqual(half, bytes([0, 0, 64, 64]))
+
+
+class TestNetpbm(unit.TestCase):
+    """Tests writing the pixels of cairo surfaces as pam and ppm"""
+
+    def setUp(self):
+        # 2 x 2 RGB24 pixels in the byte order of cairo, the rows are padded to
+        # 12 bytes and the unused byte is 0
+        pixels = [[(10, 20, 30), (40, 50, 60)], [(70, 80, 90), (1, 2, 3)]]
+        rows = []
+        for row in pixels:
+            if sys.byteorder == "little":
+                data = b"".join(bytes([b, g, r, 0]) for r, g, b in row)
+            else:
+                data = b"".join(bytes([0, r, g, b]) for r, g, b in row)
+            rows.append(data + b"\x07" * 4)
+        self.data = bytearray(b"".join(rows))
+
+    def test_pam(self):
+        out = io.BytesIO()
+        netpbm.write_pam(self.data, 2, 2, 12, out, opaque=True)
+        header = (
+            "P7\nWIDTH 2\nHEIGHT 2\nDEPTH 4\nMAXVAL 255\n"
+            f"TUPLTYPE {netpbm.PAM_TUPLTYPE}\nENDHDR\n"
+        ).encode("ascii")
+        pam = out.getvalue()
+        self.assertEqual(pam[: len(header)], header)
+        pixels = pam[len(header) :]
+        # the padding of the rows is dropped, the unused byte is opaque
+        self.assertEqual(len(pixels), 16)
+        alpha = netpbm.PAM_TUPLTYPE.index("A")
+        self.assertEqual(pixels[alpha::4], b"\xff" * 4)
+        red = netpbm.PAM_TUPLTYPE.index("R")
+        self.assertEqual(pixels[red::4], bytes([10, 40, 70, 1]))
+        self.assertEqual(self.data[12 + 8 : 24], b"\x07" * 4)
+
+    def test_ppm(self):
+        out = io.BytesIO()
+        netpbm.write_ppm(self.data, 2, 2, 12, out)
+        out.seek(0)
+        with Image.open(out) as im:
+            self.assertEqual(im.mode, "RGB")
+            self.assertEqual(im.size, (2, 2))
+            rgb = bytes([10, 20, 30, 40, 50, 60, 70, 80, 90, 1, 2, 3])
+            self.assertEqual(im.tobytes(), rgb)
+
+
+@unit.skipIf(draw is None, "needs cairo")
+class TestDraw(unit.TestCase):
+    """Tests the grids of images on pages of draw.py"""
+
+    def test_parse_grid(self):
+        self.assertEqual(draw.parse_grid("3x4"), (3, 4))
+        self.assertEqual(draw.parse_grid("2X1"), (2, 1))
+        self.assertRaises(ValueError, lambda: draw.parse_grid("0x2"))
+        self.assertRaises(ValueError, lambda: draw.parse_grid("abc"))
+
+    def test_output_format(self):
+        self.assertEqual(draw.output_format("page.PAM"), "pam")
+        self.assertEqual(draw.output_format("page.jpg"), "png")
+        self.assertEqual(draw.output_format("-", "ppm"), "ppm")
+
+    def test_page_name(self):
+        self.assertEqual(draw.page_name("sheet.png", 0, 1), "sheet.png")
+        self.assertEqual(draw.page_name("sheet.png", 0, 3), "sheet-1.png")
+        self.assertEqual(draw.page_name("out/sheet.ppm", 2, 3), "out/sheet-3.ppm")
+        # all pages go to stdout
+        self.assertEqual(draw.page_name("-", 1, 3), "-")
+
+    def test_compose(self):
+        with tempfile.TemporaryDirectory() as directory:
+            files = []
+            for i, color in enumerate(["red", "green", "blue", "white", "black"]):
+                fn = os.path.join(directory, f"{i}.png")
+                Image.new("RGB", (20, 10), color).save(fn)
+                files.append(fn)
+            output = os.path.join(directory, "sheet.png")
+            pages = draw.compose(files, 100, 80, 2, 2, margin=4, output=output)
+            self.assertEqual(pages, 2)
+            for page in (1, 2):
+                with Image.open(os.path.join(directory, f"sheet-{page}.png")) as im:
+                    self.assertEqual(im.size, (100, 80))
+            # the cells of the second page that have no image stay white
+            with Image.open(os.path.join(directory, "sheet-2.png")) as im:
+                self.assertEqual(im.convert("RGB").getpixel((25, 20)), (0, 0, 0))
+                self.assertEqual(im.convert("RGB").getpixel((75, 60)), (255, 255, 255))
+            self.assertRaises(
+                ValueError, lambda: draw.compose(files, 10, 10, 2, 2, margin=5)
+            )
+
+
+class TestPngWriter(unit.TestCase):
+    """Tests that the incrementally written pngs decode to the same pixels"""
+
+    def test_round_trip(self):
+        rng = random.Random(1)
+        for mode in ("1", "L", "RGB", "RGBA"):
+            channels = len(Image.new(mode, (1, 1)).getbands())
+            pixels = bytes(rng.randrange(256) for _ in range(37 * 23 * channels))
+            im = Image.frombytes("L" if mode == "1" else mode, (37, 23), pixels)
+            im = im.convert(mode)
+            data = im.tobytes()
+            out = io.BytesIO()
+            writer = PngWriter(out, 37, 23, mode=mode, dpi=300)
+            row_bytes = writer.row_bytes
+            writer.write_rows(data[: 10 * row_bytes])
+            writer.write_rows(data[10 * row_bytes :])
+            writer.close()
+
+            out.seek(0)
+            with Image.open(out) as decoded:
+                self.assertEqual(decoded.mode, mode)
+                self.assertEqual(decoded.tobytes(), data, mode)
+                self.assertAlmostEqual(decoded.info["dpi"][0], 300, places=1)
+
+    def test_palette(self):
+        palette = bytes(v for v in range(256) for _ in range(3))
+        out = io.BytesIO()
+        writer = PngWriter(out, 4, 1, mode="P", palette=palette)
+        writer.write_rows(bytes([0, 85, 170, 255]))
+        writer.close()
+        out.seek(0)
+        with Image.open(out) as decoded:
+            self.assertEqual(decoded.convert("L").tobytes(), bytes([0, 85, 170, 255]))
+            self.assertNotIn("dpi", decoded.info)
+        self.assertRaises(ValueError, lambda: PngWriter(out, 1, 1, mode="P"))
+
+
+class TestLibrary(unit.TestCase):
+    """Tests the index of the worksheets"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.library = library.Library(os.path.join(self.tmpdir.name, "lib.sqlite"))
+        d = {"word": "boom", "path": "tree.png", "distractors": [["b", 1, 2]] * 3}
+        self.json_fn = self.write("boom.json", json.dumps(d).encode("utf8"))
+        sheet = {
+            "path": "cat.png",
+            "name": "",
+            "word": "cat",
+            "word_x": 0.0,
+            "word_y": 0.0,
+            "img_x": 0.0,
+            "img_y": 0.0,
+            "font": "",
+            "distractor_font": "",
+            "show_path": False,
+            "close_path": False,
+            "exclusion_path": [],
+            "distractors": [Distractor("c", Point2D(1, 2))],
+        }
+        self.binary_fn = self.write("cat" + binformat.EXTENSION, binformat.dumps(sheet))
+        self.write("notes.json", b"[]")
+
+    def tearDown(self):
+        self.library.close()
+        self.tmpdir.cleanup()
+
+    def write(self, name, data):
+        fn = os.path.join(self.tmpdir.name, name)
+        with open(fn, "wb") as out:
+            out.write(data)
+        return fn
+
+    def test_summarize(self):
+        with open(self.json_fn, "rb") as content:
+            self.assertEqual(library.summarize(content.read()), ("boom", "tree.png", 3))
+        with open(self.binary_fn, "rb") as content:
+            self.assertEqual(library.summarize(content.read()), ("cat", "cat.png", 1))
+
+    def test_scan_and_search(self):
+        self.assertEqual(self.library.scan(self.tmpdir.name), 2)
+        self.assertEqual({e.word for e in self.library.search()}, {"boom", "cat"})
+        configs = [e.config for e in self.library.search("tree")]
+        self.assertEqual(configs, [self.json_fn])
+
+        os.unlink(self.binary_fn)
+        self.assertEqual(self.library.scan(self.tmpdir.name), 1)
+        self.assertEqual([e.word for e in self.library.search()], ["boom"])
+        self.library.remove(self.json_fn)
+        self.assertEqual(self.library.search(), [])
+
+    def test_scan_wildcards(self):
+        # _ is part of the name of a directory, not a pattern
+        with open(self.json_fn, "rb") as content:
+            data = content.read()
+        for directory in ("a_b", "axb"):
+            os.mkdir(os.path.join(self.tmpdir.name, directory))
+        self.write(os.path.join("a_b", "sheet.json"), data)
+        other = self.write(os.path.join("axb", "other.json"), data)
+        self.assertEqual(self.library.scan(self.tmpdir.name), 4)
+        os.unlink(other)
+        self.assertEqual(self.library.scan(os.path.join(self.tmpdir.name, "a_b")), 1)
+        self.assertIn(other, [e.config for e in self.library.search()])
+
+    def test_scan_in_background(self):
+        scanned, done = [], []
+        library.update_thumbnails_in_background(
+            self.library.fn, done.append, self.tmpdir.name, scanned.append
+        ).join()
+        self.assertEqual(scanned, [2])
+        self.assertEqual(len(done), 1)
+        self.assertEqual(len(self.library.search()), 2)
+
+    def test_thumbnails(self):
+        self.library.add(self.json_fn)
+        ((config, content_hash),) = self.library.stale_thumbnails()
+        self.library.set_thumbnail(config, content_hash, b"png")
+        self.assertEqual(self.library.stale_thumbnails(), [])
+        self.assertEqual(self.library.search()[0].thumbnail, b"png")
+
+        # a changed config needs a new thumbnail
+        d = {"word": "bam", "path": "", "distractors": []}
+        self.write("boom.json", json.dumps(d).encode("utf8"))
+        os.utime(self.json_fn, (0, 0))
+        self.library.add(self.json_fn)
+        self.assertEqual(len(self.library.stale_thumbnails()), 1)
+
+
+class TestHistory(unit.TestCase):
+    """Tests the persistent snapshots of the history"""
+
+    def test_chunked(self):
+        items = list(range(100))
+        chunked = Chunked.from_iterable(items)
+        appended = chunked.append(100)
+        self.assertEqual(list(appended), items + [100])
+        self.assertEqual(list(chunked), items, "the original is not modified")
+        self.assertIs(appended._chunks[0], chunked._chunks[0])
+        changed = chunked.set(40, -1)
+        self.assertEqual(changed[40], -1)
+        self.assertEqual(chunked[40], 40)
+        deleted = changed.delete(0).delete(-1)
+        self.assertEqual(list(deleted), items[1:40] + [-1] + items[41:99])
+        self.assertEqual(deleted[38], 39)
+        self.assertRaises(IndexError, lambda: deleted[98])
+
+    def test_apply(self):
+        state = State(
+            path="",
+            img_surf=None,
+            word="",
+            font="",
+            distractor_font="",
+            word_x=0,
+            word_y=0,
+            img_x=0,
+            img_y=0,
+            img_scale_factor=0.5,
+            show_path=False,
+            close_path=False,
+            paper=(210, 297),
+            dpi=300,
+            line_art={"greyscale": False},
+            distractors=Chunked(),
+            exclusion_path=Chunked(),
+        )
+        self.assertIs(state.apply({"op": "set", "field": "word", "value": ""}), state)
+        new = state.apply({"op": "set", "field": "word", "value": "boom"})
+        new = new.apply({"op": "add_distractor", "string": "a", "x": 1, "y": 2})
+        new = new.apply({"op": "move_distractor", "index": 0, "x": 3, "y": 4})
+        new = new.apply({"op": "add_path_point", "x": 5, "y": 6})
+        self.assertEqual(list(new.distractors), [("a", 3, 4)])
+        self.assertEqual(state.changes(new), {"word", "distractors", "exclusion_path"})
+        cleared = new.apply({"op": "clear_path"})
+        self.assertEqual(new.changes(cleared), {"exclusion_path"})
+        printed = new.apply({"op": "set", "field": "dpi", "value": 600})
+        self.assertEqual(new.changes(printed), {"dpi"})
+        line_art = {"op": "set", "field": "line_art", "value": {"greyscale": True}}
+        self.assertEqual(new.changes(new.apply(line_art)), {"line_art"})
+        for string in "bcd":
+            new = new.apply({"op": "add_distractor", "string": string, "x": 0, "y": 0})
+        new = new.apply({"op": "remove_distractors", "indices": [1, 3]})
+        self.assertEqual([d[0] for d in new.distractors], ["a", "c"])
+
+
+class TestEvents(unit.TestCase):
+    """Tests the delivery of changes to subscribers"""
+
+    def test_subscribe(self):
+        observable = events.Observable()
+        words, everything = [], []
+        observable.subscribe(words.append, events.WORD)
+        observable.subscribe(everything.append)
+        observable.emit(events.Change(events.WORD))
+        observable.emit(events.Change(events.DISTRACTORS, added=(0,)))
+        self.assertEqual(words, [events.Change(events.WORD)])
+        self.assertEqual(len(everything), 2)
+        self.assertEqual(everything[1].added, (0,))
+
+        observable.unsubscribe(words.append)
+        observable.emit(events.Change(events.WORD))
+        self.assertEqual(len(words), 1)
+        self.assertRaises(ValueError, lambda: observable.subscribe(print, "unknown"))
+
+    def test_span(self):
+        Change = events.Change
+        self.assertEqual(events.span(Change(events.DISTRACTORS)), (0, 0, 0))
+        # of 10 items, 1 and 5 are removed: 1 up to 5 become 1 up to 3
+        removed = Change(events.DISTRACTORS, removed=(5, 1))
+        self.assertEqual(events.span(removed), (1, 5, 3))
+        appended = Change(events.DISTRACTORS, added=(8,))
+        self.assertEqual(events.span(appended), (8, 0, 1))
+        replaced = Change(events.DISTRACTORS, added=(0, 1), removed=(0, 1, 2))
+        self.assertEqual(events.span(replaced), (0, 3, 2))
+
+    @unit.skipIf(Model is None, "needs cairo and GTK")
+    def test_list_model(self):
+        import drawimage
+
+        distractors = [Distractor(str(i), Point2D(i, i)) for i in range(10)]
+        model = Model(distractors=distractors)
+        items = drawimage.DistractorListModel(model)
+        signals = []
+
+        def on_items_changed(items, position, removed, added):
+            # the list must be in the state that the signal describes
+            strings = [
+                items.get_item(i).get_string() for i in range(items.get_n_items())
+            ]
+            signals.append((position, removed, added, strings))
+
+        items.connect("items-changed", on_items_changed)
+        model.remove_distractors([1, 5])
+        model.append_distractor(Distractor("x", Point2D(0, 0)))
+        model.replace_distractors([Distractor("y", Point2D(0, 0))])
+        self.assertEqual(
+            signals,
+            [
+                (1, 5, 3, ["0", "2", "3", "4", "6", "7", "8", "9"]),
+                (8, 0, 1, ["0", "2", "3", "4", "6", "7", "8", "9", "x"]),
+                (0, 9, 1, ["y"]),
+            ],
+        )
+
+
+class TestRenderCache(unit.TestCase):
+    """Tests storage and LRU eviction of the render cache"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_get_put(self):
+        cache = RenderCache(self.tmpdir.name, max_bytes=100)
+        self.assertIsNone(cache.get("a"))
+        cache.put("a", b"x" * 40)
+        self.assertEqual(cache.get("a"), b"x" * 40)
+        self.assertEqual(cache.report()["bytes_saved"], 40)
+        self.assertEqual(cache.hit_rate, 0.5)
+
+        reopened = RenderCache(self.tmpdir.name, max_bytes=100)
+        self.assertIn("a", reopened)
+        self.assertEqual(reopened.size, 40)
+
+    def test_eviction(self):
+        cache = RenderCache(self.tmpdir.name, max_bytes=100)
+        cache.put("a", b"a" * 40)
+        cache.put("b", b"b" * 40)
+        cache.get("a")  # b is now the least recently used
+        cache.put("c", b"c" * 40)
+        self.assertIn("a", cache)
+        self.assertNotIn("b", cache)
+        self.assertIn("c", cache)
+        self.assertEqual(cache.size, 80)
+        self.assertEqual(sorted(os.listdir(self.tmpdir.name)), ["a", "c"])
+
+    def test_interrupted_writes(self):
+        # the temporary files of atomic_write aren't entries
+        stale, recent = [
+            os.path.join(self.tmpdir.name, f"{key}x1y2{autosave.TEMP_SUFFIX}")
+            for key in ("a", "b")
+        ]
+        for fn in (stale, recent):
+            with open(fn, "wb") as out:
+                out.write(b"partial")
+        old = time.time() - rendercache.STALE_SECONDS - 1
+        os.utime(stale, (old, old))
+        cache = RenderCache(self.tmpdir.name)
+        self.assertEqual((len(cache._sizes), cache.size), (0, 0))
+        self.assertFalse(os.path.exists(stale))
+        self.assertTrue(os.path.exists(recent))
+
+
+class TestService(unit.TestCase):
+    """Tests coalescing and statistics of the render service"""
+
+    def test_percentiles(self):
+        stats = service.LatencyStats(size=100)
+        self.assertEqual(stats.percentile(50), 0.0)
+        for i in range(1, 201):
+            stats.add(float(i))
+        self.assertEqual(stats.count, 200)
+        # only the 100 most recent samples are kept
+        self.assertEqual(stats.percentile(50), 150.0)
+        self.assertEqual(stats.percentile(99), 199.0)
+        self.assertEqual(stats.report()["max"], 200.0)
+
+    def test_coalesce(self):
+        release = threading.Event()
+        calls = []
+
+        def render(payload, fmt):
+            calls.append(payload)
+            release.wait(5)
+            return fmt.encode() + payload
+
+        async def run():
+            svc = service.RenderService(2, ThreadPoolExecutor(2), render)
+            same = b'{"word": "a", "path": ""}'
+            reordered = b'{"path": "", "word": "a"}'
+            tasks = [
+                asyncio.create_task(svc.render(same, "png")),
+                asyncio.create_task(svc.render(reordered, "png")),
+                asyncio.create_task(svc.render(same, "pdf")),
+            ]
+            await asyncio.sleep(0.05)
+            self.assertEqual(svc.in_flight, 2)
+            release.set()
+            results = await asyncio.gather(*tasks)
+            self.assertEqual(svc.in_flight, 0)
+            with self.assertRaises(ValueError):
+                await svc.render(same, "gif")
+            svc.close()
+            return svc, results
+
+        svc, results = asyncio.run(run())
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(svc.coalesced, 1)
+        self.assertEqual(results[0], results[1])
+        self.assertTrue(results[2].startswith(b"pdf"))
+
+    def test_not_an_object(self):
+        async def run(payload):
+            svc = service.RenderService(1, ThreadPoolExecutor(1))
+            status, _, _ = await svc._dispatch("POST", "/render", payload)
+            svc.close()
+            return status
+
+        for payload in (b"[]", b"1"):
+            self.assertEqual(asyncio.run(run(payload)), 400)
+
+    def test_negative_length(self):
+        class Writer:
+            def __init__(self):
+                self.data = b""
+
+            def write(self, data):
+                self.data += data
+
+            async def drain(self):
+                pass
+
+            def close(self):
+                pass
+
+        async def run():
+            svc = service.RenderService(1, ThreadPoolExecutor(1), None)
+            reader = asyncio.StreamReader()
+            reader.feed_data(b"POST /render HTTP/1.0\r\nContent-Length: -1\r\n\r\n")
+            reader.feed_eof()
+            writer = Writer()
+            await svc.handle(reader, writer)
+            svc.close()
+            return writer.data
+
+        self.assertTrue(asyncio.run(run()).startswith(b"HTTP/1.0 400"))
+
+
+class TestProfiling(unit.TestCase):
+    """Tests the spans and reports of the profiler"""
+
+    def test_disabled(self):
+        profiler = profiling.Profiler()
+
+        @profiler.timed()
+        def work(x):
+            return x * 2
+
+        self.assertEqual(work(2), 4)
+        with profiler.span("block"):
+            pass
+        self.assertEqual(profiler.stats(), {})
+        self.assertEqual(profiler.chrome_trace()["traceEvents"], [])
+
+    def test_nested(self):
+        profiler = profiling.Profiler(window=4)
+        profiler.enabled = True
+
+        @profiler.timed("inner")
+        def inner():
+            pass
+
+        for _ in range(6):
+            with profiler.span("outer"):
+                inner()
+        stats = profiler.stats()
+        self.assertEqual(stats["outer"]["count"], 6)
+        self.assertEqual(sum(profiler.histogram("inner").values()), 4)
+
+        events = profiler.chrome_trace()["traceEvents"]
+        self.assertEqual(len(events), 12)
+        inner_event, outer_event = events[:2]  # the inner span ends first
+        self.assertEqual(inner_event["name"], "inner")
+        self.assertEqual(inner_event["args"]["depth"], 1)
+        self.assertEqual(outer_event["args"]["depth"], 0)
+        self.assertLessEqual(outer_event["ts"], inner_event["ts"])
+        self.assertGreaterEqual(outer_event["dur"], inner_event["dur"])
+        json.dumps(events)
+
+
+class _Cache:
+    def __init__(self, sizes: list[int]):
+        self.sizes = sizes
+
+    def used(self) -> int:
+        return sum(self.sizes)
+
+    def shrink(self, nbytes: int) -> int:
+        freed = 0
+        while freed < nbytes and self.sizes:
+            freed += self.sizes.pop(0)
+        return freed
+
+
+class TestMemory(unit.TestCase):
+    """Tests the accounting and eviction of the memory budget"""
+
+    def test_eviction_order(self):
+        budget = memory.Budget(limit=100)
+        tiles, mipmap = _Cache([30, 30]), _Cache([40])
+        image = _Cache([50])
+        budget.register("mipmap", mipmap.used, mipmap.shrink)
+        budget.register("tiles", tiles.used, tiles.shrink)
+        budget.register("image", image.used)
+        self.assertEqual(budget.usage(), {"tiles": 60, "mipmap": 40, "image": 50})
+
+        # the tiles are evicted first, the image is never evicted
+        self.assertEqual(budget.enforce(), 60)
+        self.assertEqual(budget.total(), 90)
+        with budget.allocation("export", 50):
+            self.assertEqual(budget.usage()["export"], 50)
+            self.assertEqual(budget.total(), 100)
+        self.assertNotIn("export", budget.usage())
+
+    def test_main_thread(self):
+        budget = memory.Budget(limit=10)
+        tiles, lineart = _Cache([30]), _Cache([40])
+        budget.register("tiles", tiles.used, tiles.shrink, main_thread=True)
+        budget.register("lineart", lineart.used, lineart.shrink)
+        scheduled = []
+        budget.call_soon = scheduled.append
+
+        # a worker doesn't shrink the tiles, nor the caches that follow them
+        worker = threading.Thread(target=budget.enforce)
+        worker.start()
+        worker.join()
+        worker = threading.Thread(target=budget.enforce)
+        worker.start()
+        worker.join()
+        self.assertEqual(budget.total(), 70)
+        self.assertEqual(len(scheduled), 1)
+
+        self.assertFalse(scheduled.pop()())
+        self.assertEqual(budget.usage(), {"tiles": 0, "lineart": 0})
+
+    def test_collected_owner(self):
+        budget = memory.Budget()
+        cache = _Cache([10])
+        budget.register("tiles", cache.used, cache.shrink)
+        self.assertEqual(budget.total(), 10)
+        del cache
+        self.assertEqual(budget.usage(), {})
+
+
 if __name__ == "__main__":
     unit.main()
@@ -0,0 +1,123 @@
+"""A cache of rasterized tiles of a drawing for the preview
+
+The preview only rasterizes the tiles that are visible. Tiles have a fixed
+size in pixels and are rendered at discrete zoom levels, a level shows the
+page at a scale of 2 ** level. The preview draws the tiles of the level that is
+just above its scale, so zooming between two levels reuses the tiles. The
+least recently used tiles are evicted when the cache uses too much memory,
+or when the memory budget is exceeded (see memory).
+"""
+from __future__ import annotations
+
+from collections import OrderedDict
+import math as m
+
+import cairo
+
+import memory
+import profiling
+
+TILE_SIZE = 256  # pixels
+MAX_BYTES = 64 * 1024 * 1024
+MIN_LEVEL, MAX_LEVEL = -5, 1  # from 1/32 up to twice the size of the layout
+
+TileKey = tuple[int, int, int]  # level, column, row
+
+
+def level_for_scale(scale: float) -> int:
+    """Returns the zoom level whose tiles are downscaled to show scale"""
+    level = m.ceil(m.log2(scale)) if scale > 0 else MIN_LEVEL
+    return min(MAX_LEVEL, max(MIN_LEVEL, level))
+
+
+class TileCache:
+    """Rasterizes a recording surface in tiles on demand
+
+    The tiles are dropped when another recording is used, e.g. after the
+    drawing is redrawn.
+    """
+
+    def __init__(self, tile_size: int = TILE_SIZE, max_bytes: int = MAX_BYTES):
+        self.tile_size = tile_size
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._source: cairo.Surface | None = None
+        self._tiles: OrderedDict[TileKey, cairo.ImageSurface] = OrderedDict()
+        memory.budget.register(
+            "tiles", self.memory_used, self.shrink, main_thread=True
+        )
+
+    def __len__(self) -> int:
+        return len(self._tiles)
+
+    def clear(self):
+        self._tiles.clear()
+        self.size = 0
+
+    def memory_used(self) -> int:
+        return self.size
+
+    def shrink(self, nbytes: int) -> int:
+        """Evicts the least recently used tiles until nbytes are freed"""
+        freed = 0
+        while freed < nbytes and self._tiles:
+            _, evicted = self._tiles.popitem(last=False)
+            freed += evicted.get_stride() * evicted.get_height()
+        self.size -= freed
+        return freed
+
+    def set_source(self, source: cairo.Surface | None):
+        """Use the tiles of source, the tiles of the previous source are
+        dropped.
+        """
+        if source is not self._source:
+            self.clear()
+            self._source = source
+
+    def visible(
+        self, level: int, x0: float, y0: float, x1: float, y1: float
+    ) -> list[tuple[int, int]]:
+        """Returns the columns and rows of the tiles of level that overlap
+        with the rectangle x0, y0, x1, y1 in page coordinates.
+        """
+        scale = 2.0**level / self.tile_size
+        return [
+            (column, row)
+            for row in range(max(0, m.floor(y0 * scale)), m.ceil(y1 * scale))
+            for column in range(max(0, m.floor(x0 * scale)), m.ceil(x1 * scale))
+        ]
+
+    def tile(self, level: int, column: int, row: int) -> cairo.ImageSurface:
+        """Returns the tile, it is rasterized when it isn't cached"""
+        key = level, column, row
+        tile = self._tiles.get(key)
+        if tile is not None:
+            self.hits += 1
+            self._tiles.move_to_end(key)
+            return tile
+
+        self.misses += 1
+        tile = self._render(level, column, row)
+        self._tiles[key] = tile
+        self.size += tile.get_stride() * tile.get_height()
+        while self.size > self.max_bytes and len(self._tiles) > 1:
+            _, evicted = self._tiles.popitem(last=False)
+            self.size -= evicted.get_stride() * evicted.get_height()
+        memory.budget.enforce()
+        return tile
+
+    @profiling.timed("tiles.render")
+    def _render(self, level: int, column: int, row: int) -> cairo.ImageSurface:
+        size = self.tile_size
+        tile = cairo.ImageSurface(cairo.FORMAT_RGB24, size, size)
+        cr = cairo.Context(tile)
+        cr.set_source_rgb(0.5, 0.5, 0.5)  # outside of the page
+        cr.paint()
+        if self._source:
+            cr.translate(-column * size, -row * size)
+            cr.scale(2.0**level, 2.0**level)
+            cr.set_source_surface(self._source)
+            cr.paint()
+        return tile